@@ -2,12 +2,34 @@
 Интеграция между LLM воркером и ботом
 """
 import logging
+from typing import List
 # Bot integration module
 from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
 from config import BOT_TOKEN
+from telegram_sender import setup_rate_limit
 
 logger = logging.getLogger(__name__)
 
+# Максимальная длина текста одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    """Разбить длинный текст на части не длиннее limit (по абзацам/словам)"""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = text.rfind(" ", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip()
+    if text:
+        parts.append(text)
+    return parts
+
 
 class BotIntegration:
     """Класс для интеграции с ботом"""
@@ -24,7 +46,7 @@ class BotIntegration:
                 raise ValueError("BOT_TOKEN не найден в переменных окружения.")
             
             logger.info(f"📊 BOT_TOKEN: {BOT_TOKEN[:10]}...")
-            self.bot = Bot(token=BOT_TOKEN)
+            self.bot = setup_rate_limit(Bot(token=BOT_TOKEN))
             logger.info("✅ BotIntegration инициализирован успешно!")
         except Exception as e:
             logger.error(f"Ошибка инициализации бота: {e}")
@@ -44,6 +66,27 @@ class BotIntegration:
             logger.error(f"❌ Ошибка отправки сообщения пользователю {chat_id}: {e}")
             logger.error(f"🔍 Тип ошибки: {type(e).__name__}")
     
+    async def edit_message_text(self, chat_id: int, message_id: int, text: str) -> bool:
+        """Изменить текст сообщения. Возвращает True, если сообщение показывает text"""
+        try:
+            if self.bot:
+                await self.bot.edit_message_text(
+                    text=text,
+                    chat_id=chat_id,
+                    message_id=message_id
+                )
+                return True
+            logger.error("❌ Бот не инициализирован для редактирования сообщения")
+        except TelegramBadRequest as e:
+            # Текст не изменился с прошлого редактирования - это не ошибка
+            if "message is not modified" in str(e):
+                return True
+            logger.error(f"❌ Ошибка редактирования сообщения {message_id} в чате {chat_id}: {e}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка редактирования сообщения {message_id} в чате {chat_id}: {e}")
+            logger.error(f"🔍 Тип ошибки: {type(e).__name__}")
+        return False
+    
     async def delete_message(self, chat_id: int, message_id: int):
         """Удалить сообщение пользователя"""
         try:
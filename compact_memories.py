@@ -0,0 +1,136 @@
+"""
+Объединение повторяющихся воспоминаний (после migration_memory_types.sql)
+
+Раньше одно сообщение сохранялось отдельной записью на каждый тип, а
+одинаковые сообщения - каждое отдельно. Скрипт для каждого пользователя
+объединяет записи с одинаковым или близким (косинус не ниже порога)
+содержимым в самую раннюю: ее типы, теги и важность дополняются
+остальными, остальные удаляются из PostgreSQL и ChromaDB.
+
+Примеры:
+    python compact_memories.py --dry-run              (только посчитать повторы)
+    python compact_memories.py
+    python compact_memories.py --user-id 42 --threshold 0.97
+"""
+import argparse
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import delete, select
+
+from config import MEMORY_DEDUP_THRESHOLD
+from database import async_session_maker
+from embedding_engine import embedding_engine
+from memory_client import MemoryClient, merge_memory_types, vector_item
+from models import UserMemory
+from vector_client import vector_client
+from vector_store import vector_store
+
+logger = logging.getLogger(__name__)
+
+
+async def _embeddings(memories: List[UserMemory]) -> np.ndarray:
+    """Нормированные векторы воспоминаний (из ChromaDB, недостающие - расчетом)"""
+    stored = await vector_client.get_embeddings([str(memory.id) for memory in memories])
+    missing = [memory for memory in memories if str(memory.id) not in stored]
+    if missing:
+        computed = await embedding_engine.encode([memory.content for memory in missing])
+        stored.update({str(memory.id): vector for memory, vector in zip(missing, computed)})
+    vectors = np.stack([stored[str(memory.id)] for memory in memories])
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def _group(memories: List[UserMemory], vectors: np.ndarray, threshold: float) -> Dict[int, List[int]]:
+    """Индекс оставляемой записи -> индексы записей, объединяемых с ней"""
+    groups: Dict[int, List[int]] = {}
+    kept: List[int] = []
+    for i, memory in enumerate(memories):
+        if kept:
+            similarity = vectors[kept] @ vectors[i]
+            best = int(np.argmax(similarity))
+            if similarity[best] >= threshold:
+                groups[kept[best]].append(i)
+                continue
+        kept.append(i)
+        groups[i] = []
+    return groups
+
+
+async def compact_user(user_id: int, threshold: float, dry_run: bool) -> Tuple[int, int]:
+    """Объединить повторы одного пользователя: (записей было, удалено)"""
+    async with async_session_maker() as session:
+        result = await session.execute(
+            select(UserMemory).where(UserMemory.user_id == user_id).order_by(UserMemory.id)
+        )
+        memories = list(result.scalars().all())
+        if len(memories) < 2:
+            return len(memories), 0
+
+        groups = _group(memories, await _embeddings(memories), threshold)
+        removed = [memories[i] for duplicates in groups.values() for i in duplicates]
+        if dry_run or not removed:
+            return len(memories), len(removed)
+
+        updated = []
+        for survivor_index, duplicates in groups.items():
+            if not duplicates:
+                continue
+            survivor = memories[survivor_index]
+            group = [survivor] + [memories[i] for i in duplicates]
+            survivor.memory_types = merge_memory_types(
+                *(memory.memory_types or [memory.memory_type] for memory in group)
+            )
+            survivor.memory_type = survivor.memory_types[0]
+            survivor.importance = MemoryClient._max_importance(*(memory.importance for memory in group))
+            survivor.tags = list(dict.fromkeys(tag for memory in group for tag in memory.tags or []))
+            updated.append(survivor)
+
+        await session.execute(
+            delete(UserMemory).where(UserMemory.id.in_([memory.id for memory in removed]))
+        )
+        await session.commit()
+
+    await vector_client.delete_memories([str(memory.id) for memory in removed])
+    await vector_client.update_metadatas([vector_item(memory) for memory in updated])
+    return len(memories), len(removed)
+
+
+async def compact(user_id: Optional[int], threshold: float, dry_run: bool) -> None:
+    """Объединить повторы всех пользователей (или одного)"""
+    await vector_client.initialize()
+    try:
+        if user_id is None:
+            async with async_session_maker() as session:
+                result = await session.execute(select(UserMemory.user_id).distinct())
+                user_ids = sorted(result.scalars().all())
+        else:
+            user_ids = [user_id]
+
+        total = removed = 0
+        for uid in user_ids:
+            count, duplicates = await compact_user(uid, threshold, dry_run)
+            total += count
+            removed += duplicates
+            if duplicates:
+                logger.info(f"👤 Пользователь {uid}: {count} воспоминаний, повторов {duplicates}")
+
+        action = "найдено повторов" if dry_run else "удалено повторов"
+        logger.info(f"🧹 Пользователей: {len(user_ids)}, воспоминаний: {total}, {action}: {removed}")
+    finally:
+        await embedding_engine.close()
+        await vector_store.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Объединение повторяющихся воспоминаний")
+    parser.add_argument("--user-id", type=int, default=None,
+                        help="Только воспоминания этого пользователя (users.id)")
+    parser.add_argument("--threshold", type=float, default=MEMORY_DEDUP_THRESHOLD,
+                        help="Порог косинусной близости повторов")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Только посчитать повторы, ничего не менять")
+    args = parser.parse_args()
+    asyncio.run(compact(args.user_id, args.threshold, args.dry_run))
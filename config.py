@@ -31,6 +31,187 @@ LLM_API_URL = os.getenv('LLM_API_URL',
 LLM_API_KEY = os.getenv('OPENROUTER_API_KEY') or os.getenv('LLM_API_KEY')
 LLM_MODEL = os.getenv('LLM_MODEL', 'openai/gpt-3.5-turbo')
 
+# Настройки LLM воркера
+# Сколько запросов один процесс воркера обрабатывает одновременно.
+# Сообщения одного пользователя при этом всегда обрабатываются по порядку.
+WORKER_CONCURRENCY = max(1, int(os.getenv('WORKER_CONCURRENCY', 1)))
+# Несколько процессов воркера (супервизор или несколько run_worker.py)
+# упорядочивают запросы пользователя блокировкой в Redis; она продлевается,
+# пока запрос обрабатывается, и освобождается через N секунд после падения
+WORKER_USER_LOCK_TTL = float(os.getenv('WORKER_USER_LOCK_TTL', 30))
+# При остановке воркер перестает читать очередь и ждет обрабатываемые
+# запросы до N секунд (меньше SUPERVISOR_STOP_TIMEOUT); незавершенные
+# вернутся в очередь
+WORKER_STOP_TIMEOUT = float(os.getenv('WORKER_STOP_TIMEOUT', 20))
+
+# Супервизор воркеров (python run_worker.py --supervisor): модель
+# эмбеддингов загружается один раз, процессы воркеров запускаются через fork.
+# Число процессов - от MIN до MAX: по одному на каждые
+# SUPERVISOR_SCALE_BACKLOG сообщений, ожидающих в очередях запросов.
+# Проверка очередей - раз в SUPERVISOR_SCALE_INTERVAL секунд; лишний
+# процесс останавливается, если очередь мала дольше
+# SUPERVISOR_SCALE_DOWN_DELAY секунд
+SUPERVISOR_MIN_WORKERS = max(1, int(os.getenv('SUPERVISOR_MIN_WORKERS', 1)))
+SUPERVISOR_MAX_WORKERS = max(
+    SUPERVISOR_MIN_WORKERS, int(os.getenv('SUPERVISOR_MAX_WORKERS', 4))
+)
+SUPERVISOR_SCALE_BACKLOG = max(1, int(os.getenv('SUPERVISOR_SCALE_BACKLOG', 20)))
+SUPERVISOR_SCALE_INTERVAL = float(os.getenv('SUPERVISOR_SCALE_INTERVAL', 15))
+SUPERVISOR_SCALE_DOWN_DELAY = float(os.getenv('SUPERVISOR_SCALE_DOWN_DELAY', 120))
+# Сколько ждать завершения процесса воркера после SIGTERM (секунды)
+SUPERVISOR_STOP_TIMEOUT = float(os.getenv('SUPERVISOR_STOP_TIMEOUT', 30))
+
+# Потоковая генерация ответа (SSE): ответ появляется в сообщении
+# "Печатаю ответ..." по мере генерации
+LLM_STREAMING = (
+    os.getenv('LLM_STREAMING', 'false')
+    .lower() in ('1', 'true', 'yes', 'y')
+)
+# Минимальный интервал между правками сообщения (лимиты Telegram на edit)
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1.0))
+# Сколько символов должно накопиться перед первой правкой
+STREAM_EDIT_MIN_CHARS = int(os.getenv('STREAM_EDIT_MIN_CHARS', 1))
+
+# Таймауты этапов сбора контекста (секунды). При превышении этап
+# пропускается, и ответ строится без этой части контекста
+CONTEXT_STAGE_TIMEOUT = float(os.getenv('CONTEXT_STAGE_TIMEOUT', 3.0))
+CONTEXT_SEMANTIC_TIMEOUT = float(os.getenv('CONTEXT_SEMANTIC_TIMEOUT', 5.0))
+
+# Фоновая запись воспоминаний после ответа: размер очереди, размер пакета,
+# максимальная задержка записи пакета (секунды) и повторы записи диалога,
+# после которых он сохраняется в Redis (список dead_letter:memory)
+MEMORY_PIPELINE_MAX_SIZE = int(os.getenv('MEMORY_PIPELINE_MAX_SIZE', 1000))
+MEMORY_PIPELINE_BATCH_SIZE = int(os.getenv('MEMORY_PIPELINE_BATCH_SIZE', 20))
+MEMORY_PIPELINE_FLUSH_INTERVAL = float(os.getenv('MEMORY_PIPELINE_FLUSH_INTERVAL', 1.0))
+MEMORY_PIPELINE_MAX_RETRIES = int(os.getenv('MEMORY_PIPELINE_MAX_RETRIES', 2))
+
+# Кэш персонажей: время жизни записи (секунды). Изменения персонажей
+# рассылаются через Redis pub/sub (python persona_cache.py --persona-id N);
+# без рассылки обновление с новой версией (personas.version) замечается при
+# следующем сообщении пользователя, остальное страхует TTL
+PERSONA_CACHE_TTL = float(os.getenv('PERSONA_CACHE_TTL', 300))
+
+# Сколько скомпилированных статических префиксов системного промпта
+# (персонаж + версия + уровень флирта + кастомизации) хранить в памяти
+PROMPT_PREFIX_CACHE_SIZE = int(os.getenv('PROMPT_PREFIX_CACHE_SIZE', 256))
+
+# Бюджет входных токенов промпта (система + история + память). Части
+# контекста сверх бюджета отбрасываются по приоритету
+LLM_INPUT_TOKEN_BUDGET = int(os.getenv('LLM_INPUT_TOKEN_BUDGET', 3000))
+# Сколько последних сообщений истории сохранять в первую очередь
+CONTEXT_MIN_RECENT_MESSAGES = int(os.getenv('CONTEXT_MIN_RECENT_MESSAGES', 4))
+
+# Клиент LLM API
+# Резервные модели через запятую: используются по порядку, если LLM_MODEL
+# недоступна (ошибки после повторов или открытый предохранитель)
+LLM_FALLBACK_MODELS = [
+    model.strip()
+    for model in os.getenv('LLM_FALLBACK_MODELS', '').split(',')
+    if model.strip()
+]
+LLM_MODELS = list(dict.fromkeys([LLM_MODEL] + LLM_FALLBACK_MODELS))
+LLM_MAX_TOKENS = int(os.getenv('LLM_MAX_TOKENS', 1000))
+# Таймаут обычного запроса и пауз потока; общий таймаут потока (секунды)
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', 30))
+LLM_STREAM_TIMEOUT = float(os.getenv('LLM_STREAM_TIMEOUT', 60))
+# Повторы при 429/5xx и сетевых ошибках: число повторов на модель,
+# базовая и максимальная задержка (секунды). Retry-After больше
+# максимальной задержки - сразу переход к следующей модели
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 2))
+LLM_RETRY_BASE_DELAY = float(os.getenv('LLM_RETRY_BASE_DELAY', 0.5))
+LLM_RETRY_MAX_DELAY = float(os.getenv('LLM_RETRY_MAX_DELAY', 8.0))
+# Предохранитель: после N неудачных запросов подряд модель пропускается
+# на LLM_CIRCUIT_RESET_TIMEOUT секунд
+LLM_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('LLM_CIRCUIT_FAILURE_THRESHOLD', 5))
+LLM_CIRCUIT_RESET_TIMEOUT = float(os.getenv('LLM_CIRCUIT_RESET_TIMEOUT', 30))
+# Пул keep-alive соединений к LLM API (по умолчанию - с запасом к конкурентности)
+LLM_POOL_SIZE = int(os.getenv('LLM_POOL_SIZE', max(10, WORKER_CONCURRENCY * 2)))
+LLM_KEEPALIVE_TIMEOUT = float(os.getenv('LLM_KEEPALIVE_TIMEOUT', 60))
+
+# Лимиты Telegram Bot API на процесс: сообщений в секунду всего и в один
+# чат (с допустимым всплеском), размер очереди ожидания, максимальный
+# flood wait, который ждем автоматически (секунды), и сколько раз подряд
+# повторяем запрос после flood wait
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', 30))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', 1))
+TELEGRAM_CHAT_BURST = float(os.getenv('TELEGRAM_CHAT_BURST', 3))
+TELEGRAM_SEND_QUEUE_SIZE = int(os.getenv('TELEGRAM_SEND_QUEUE_SIZE', 1000))
+TELEGRAM_MAX_RETRY_AFTER = float(os.getenv('TELEGRAM_MAX_RETRY_AFTER', 30))
+TELEGRAM_MAX_FLOOD_RETRIES = int(os.getenv('TELEGRAM_MAX_FLOOD_RETRIES', 3))
+
+# Доставка ответов в Telegram: "inline" - воркер отправляет сам,
+# "queue" - через очередь llm_responses и отдельный процесс
+# run_delivery_worker.py (Telegram не занимает слоты LLM воркера)
+TELEGRAM_DELIVERY_MODE = os.getenv('TELEGRAM_DELIVERY_MODE', 'inline').lower()
+# Сколько действий доставки процесс выполняет одновременно (разные чаты)
+DELIVERY_WORKER_CONCURRENCY = max(1, int(os.getenv('DELIVERY_WORKER_CONCURRENCY', 20)))
+# Повторы запросов к Bot API при сетевых ошибках/5xx/flood wait; flood wait
+# дольше DELIVERY_MAX_RETRY_AFTER секунд не ждем
+DELIVERY_MAX_RETRIES = int(os.getenv('DELIVERY_MAX_RETRIES', 3))
+DELIVERY_RETRY_BASE_DELAY = float(os.getenv('DELIVERY_RETRY_BASE_DELAY', 1.0))
+DELIVERY_MAX_RETRY_AFTER = float(os.getenv('DELIVERY_MAX_RETRY_AFTER', 60))
+
+# Объединение серий сообщений пользователя в одну реплику: сообщения,
+# пришедшие с паузой меньше CHAT_COALESCE_WINDOW секунд, уходят в LLM одним
+# запросом (не дольше CHAT_COALESCE_MAX_WAIT секунд от первого сообщения).
+# Окно добавляет столько же задержки к каждому ответу, поэтому по умолчанию
+# выключено: 0 - отправлять каждое сообщение сразу
+CHAT_COALESCE_WINDOW = float(os.getenv('CHAT_COALESCE_WINDOW', 0))
+CHAT_COALESCE_MAX_WAIT = float(os.getenv('CHAT_COALESCE_MAX_WAIT', 5.0))
+CHAT_COALESCE_MAX_MESSAGES = int(os.getenv('CHAT_COALESCE_MAX_MESSAGES', 10))
+
+# Транспорт очередей между ботом и воркерами: rabbitmq, redis (Redis Streams
+# на REDIS_HOST) или memory (в памяти процесса: бот сам запускает LLM воркер,
+# для тестов и установки на одном узле)
+QUEUE_BACKEND = os.getenv('QUEUE_BACKEND', 'rabbitmq').lower()
+# Группа потребителей воркеров (Redis Streams)
+QUEUE_CONSUMER_GROUP = os.getenv('QUEUE_CONSUMER_GROUP', 'workers')
+# Redis Streams: база и префикс ключей потоков; через сколько секунд без
+# подтверждения сообщение упавшего воркера выдается другому (больше
+# максимального времени обработки запроса)
+QUEUE_REDIS_DB = int(os.getenv('QUEUE_REDIS_DB', 0))
+QUEUE_REDIS_PREFIX = os.getenv('QUEUE_REDIS_PREFIX', 'queue:')
+QUEUE_REDIS_CLAIM_IDLE = float(os.getenv('QUEUE_REDIS_CLAIM_IDLE', 300))
+
+# Полосы очереди запросов: подписчики (llm_requests.premium) и бесплатный
+# тариф (llm_requests). Когда все слоты воркера заняты, освободившиеся слоты
+# распределяются между полосами в пропорции весов
+QUEUE_PREMIUM_WEIGHT = max(1, int(os.getenv('QUEUE_PREMIUM_WEIGHT', 3)))
+QUEUE_FREE_WEIGHT = max(1, int(os.getenv('QUEUE_FREE_WEIGHT', 1)))
+# Сколько запросов на каждый слот обработки воркер получает из очереди заранее:
+# запросы, ждущие предыдущий запрос своего пользователя, занимают только это
+# окно, а не слоты обработки
+QUEUE_PREFETCH_MULTIPLIER = max(1, int(os.getenv('QUEUE_PREFETCH_MULTIPLIER', 4)))
+# Пул каналов с publisher confirms, максимум публикаций, ожидающих
+# подтверждения, и таймаут подтверждения (секунды)
+QUEUE_PUBLISH_CHANNELS = max(1, int(os.getenv('QUEUE_PUBLISH_CHANNELS', 2)))
+QUEUE_MAX_OUTSTANDING_PUBLISHES = int(os.getenv('QUEUE_MAX_OUTSTANDING_PUBLISHES', 100))
+QUEUE_CONFIRM_TIMEOUT = float(os.getenv('QUEUE_CONFIRM_TIMEOUT', 10))
+# Задержки повторов запроса после временной ошибки (секунды, через запятую).
+# Число задержек = число повторов; после них запрос уходит в llm_requests.dead.
+# Аргументы очереди RabbitMQ неизменяемы: при смене задержек существующие
+# очереди llm_requests*.retry.N нужно удалить перед запуском
+QUEUE_RETRY_DELAYS = [
+    float(delay)
+    for delay in os.getenv('QUEUE_RETRY_DELAYS', '5,30,120').split(',')
+    if delay.strip()
+]
+
+# Метрики Prometheus воркера: порт HTTP-эндпоинта /metrics (0 - выключено)
+# и период обновления глубины очередей (секунды)
+WORKER_METRICS_PORT = int(os.getenv('WORKER_METRICS_PORT', 9108))
+METRICS_QUEUE_DEPTH_INTERVAL = float(os.getenv('METRICS_QUEUE_DEPTH_INTERVAL', 15))
+
+# Трассировка запросов: доля записываемых трасс (0..1), файл OTLP/JSON
+# (по умолчанию пусто - не записывать, например ./traces/spans.jsonl),
+# размер пакета и период записи (секунды). Файл размером от
+# TRACE_EXPORT_MAX_BYTES переименовывается в <файл>.1 (0 - без ротации)
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0.01))
+TRACE_EXPORT_PATH = os.getenv('TRACE_EXPORT_PATH', '')
+TRACE_EXPORT_BATCH_SIZE = int(os.getenv('TRACE_EXPORT_BATCH_SIZE', 256))
+TRACE_EXPORT_INTERVAL = float(os.getenv('TRACE_EXPORT_INTERVAL', 5))
+TRACE_EXPORT_MAX_BYTES = int(os.getenv('TRACE_EXPORT_MAX_BYTES', 100 * 1024 * 1024))
+
 # Настройки чата
 CHAT_HISTORY_LIMIT = 50  # Максимальное количество сообщений в истории
 CHAT_TIMEOUT = 300  # Таймаут чата в секундах (5 минут)
@@ -40,6 +221,38 @@ VECTOR_DB_PATH = os.getenv('VECTOR_DB_PATH', './vector_db')
 EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
 VECTOR_SEARCH_LIMIT = int(os.getenv('VECTOR_SEARCH_LIMIT', 10))
 VECTOR_SIMILARITY_THRESHOLD = float(os.getenv('VECTOR_SIMILARITY_THRESHOLD', 0.7))
+# Новое воспоминание с косинусной близостью не ниже порога к уже сохраненному
+# того же пользователя не записывается: его типы добавляются к существующему
+MEMORY_DEDUP_THRESHOLD = float(os.getenv('MEMORY_DEDUP_THRESHOLD', 0.95))
+# Расчет эмбеддингов вне цикла событий: запросы, пришедшие в течение
+# EMBEDDING_BATCH_WAIT_MS миллисекунд, кодируются одним пакетом (не больше
+# EMBEDDING_BATCH_SIZE текстов) в пуле из EMBEDDING_THREADS потоков
+EMBEDDING_BATCH_SIZE = max(1, int(os.getenv('EMBEDDING_BATCH_SIZE', 32)))
+EMBEDDING_BATCH_WAIT_MS = float(os.getenv('EMBEDDING_BATCH_WAIT_MS', 5))
+EMBEDDING_THREADS = max(1, int(os.getenv('EMBEDDING_THREADS', 1)))
+# Вызовы ChromaDB выполняются в отдельном пуле из VECTOR_STORE_THREADS потоков;
+# ожидающих вызовов не больше VECTOR_STORE_MAX_PENDING (остальные ждут очереди
+# в цикле событий), add/upsert в пределах VECTOR_STORE_BATCH_WAIT_MS
+# миллисекунд записываются одним вызовом коллекции
+VECTOR_STORE_THREADS = max(1, int(os.getenv('VECTOR_STORE_THREADS', 2)))
+VECTOR_STORE_MAX_PENDING = max(1, int(os.getenv('VECTOR_STORE_MAX_PENDING', 64)))
+VECTOR_STORE_BATCH_WAIT_MS = float(os.getenv('VECTOR_STORE_BATCH_WAIT_MS', 5))
+# Точный поиск по воспоминаниям пользователя матрицей в памяти процесса:
+# пользователи с числом воспоминаний больше EXACT_SEARCH_MAX_USER_VECTORS ищутся
+# через HNSW (0 - всегда HNSW), в кэше не больше EXACT_SEARCH_CACHE_VECTORS
+# векторов, матрица перечитывается из ChromaDB раз в EXACT_SEARCH_TTL секунд
+EXACT_SEARCH_MAX_USER_VECTORS = int(os.getenv('EXACT_SEARCH_MAX_USER_VECTORS', 2000))
+EXACT_SEARCH_CACHE_VECTORS = int(os.getenv('EXACT_SEARCH_CACHE_VECTORS', 100000))
+EXACT_SEARCH_TTL = float(os.getenv('EXACT_SEARCH_TTL', 60))
+# Кэш эмбеддингов по (модель, хэш текста): LRU в процессе на
+# EMBEDDING_CACHE_SIZE текстов (0 - выключен) и, при EMBEDDING_CACHE_REDIS,
+# общий кэш в Redis (float16, время жизни EMBEDDING_CACHE_TTL секунд)
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE', 10000))
+EMBEDDING_CACHE_REDIS = (
+    os.getenv('EMBEDDING_CACHE_REDIS', 'false')
+    .lower() in ('1', 'true', 'yes', 'y')
+)
+EMBEDDING_CACHE_TTL = int(os.getenv('EMBEDDING_CACHE_TTL', 7 * 24 * 3600))
 
 # Настройки для распределенной архитектуры
 WORKER_SERVER = os.getenv('WORKER_SERVER', 'localhost')  # IP сервера воркера
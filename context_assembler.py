@@ -0,0 +1,215 @@
+"""
+Параллельный сбор контекста для запроса к LLM
+"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Dict, List, Optional
+
+from redis_client import redis_client
+from memory_client import memory_client
+from models import MemoryImportance, User
+from database import async_session_maker
+from crud import get_user_persona_setting, get_user_by_telegram_id
+from persona_cache import persona_cache
+from tracing import tracer
+from config import CONTEXT_STAGE_TIMEOUT, CONTEXT_SEMANTIC_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ChatContext:
+    """Все данные, необходимые для построения промпта"""
+    user: User
+    chat_history: List[Dict] = field(default_factory=list)
+    semantic_memories: List[Dict] = field(default_factory=list)
+    important_memories: List = field(default_factory=list)
+    recent_emotions: List = field(default_factory=list)
+    persona: Any = None
+    persona_overrides: Dict = field(default_factory=dict)
+    # Длительность каждого этапа в секундах (+ "total")
+    timings: Dict[str, float] = field(default_factory=dict)
+
+    @property
+    def internal_user_id(self) -> int:
+        """Внутренний ID пользователя (users.id)"""
+        return self.user.id
+
+
+class ContextAssembler:
+    """
+    Собирает контекст запроса параллельно.
+
+    Независимые обращения (история в Redis, персонаж) стартуют сразу,
+    обращения, которым нужен внутренний ID пользователя (память, эмоции,
+    настройки персонажа), - сразу после поиска пользователя. Каждый этап
+    ограничен своим таймаутом: при превышении или ошибке этап возвращает
+    пустое значение, и ответ строится без этой части контекста.
+    """
+
+    def __init__(
+        self,
+        stage_timeout: float = CONTEXT_STAGE_TIMEOUT,
+        semantic_timeout: float = CONTEXT_SEMANTIC_TIMEOUT
+    ):
+        self.stage_timeout = stage_timeout
+        self.semantic_timeout = semantic_timeout
+
+    async def _run_stage(
+        self,
+        name: str,
+        coro: Awaitable,
+        timeout: float,
+        default: Any,
+        timings: Dict[str, float],
+        required: bool = False
+    ) -> Any:
+        """
+        Выполнить этап с таймаутом, записав его длительность.
+
+        Ошибка или таймаут обязательного (required) этапа пробрасывается:
+        без него ответ построить нельзя, и запрос нужно повторить.
+        """
+        started = time.perf_counter()
+        with tracer.span(f"context.{name}") as span:
+            try:
+                return await asyncio.wait_for(coro, timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"⏱ Этап контекста '{name}' превысил таймаут {timeout}с")
+                span.error = "timeout"
+                if required:
+                    raise
+                return default
+            except Exception as e:
+                logger.error(f"Ошибка этапа контекста '{name}': {e}")
+                span.error = f"{type(e).__name__}: {e}"
+                if required:
+                    raise
+                return default
+            finally:
+                timings[name] = time.perf_counter() - started
+
+    @staticmethod
+    async def _load_user(telegram_id: int) -> Optional[User]:
+        """Найти пользователя по telegram_id"""
+        async with async_session_maker() as session:
+            return await get_user_by_telegram_id(session, telegram_id=telegram_id)
+
+    @staticmethod
+    async def _load_persona_overrides(user_id: int) -> Dict:
+        """Загрузить кастомизации текущего персонажа пользователя"""
+        async with async_session_maker() as session:
+            persona_setting = await get_user_persona_setting(session, user_id)
+            if not persona_setting:
+                logger.warning("⚠️ No persona_setting found for user!")
+                return {}
+            return persona_setting.overrides or {}
+
+    async def assemble(
+        self,
+        telegram_id: int,
+        user_message: str,
+        persona_id: Optional[int] = None,
+        persona_version: Optional[int] = None
+    ) -> Optional[ChatContext]:
+        """
+        Собрать контекст для сообщения пользователя.
+
+        Возвращает None, если пользователь не найден. Ошибка загрузки
+        пользователя (база недоступна) пробрасывается.
+        """
+        timings: Dict[str, float] = {}
+        started = time.perf_counter()
+
+        # История чата и персонаж не зависят от внутреннего ID пользователя
+        history_task = asyncio.create_task(self._run_stage(
+            "history", redis_client.get_chat_history(telegram_id),
+            self.stage_timeout, [], timings
+        ))
+        persona_task = None
+        if persona_id:
+            persona_task = asyncio.create_task(self._run_stage(
+                "persona", persona_cache.get_by_id(persona_id, persona_version),
+                self.stage_timeout, None, timings
+            ))
+
+        try:
+            user = await self._run_stage(
+                "user", self._load_user(telegram_id),
+                self.stage_timeout, None, timings, required=True
+            )
+        except BaseException:
+            for task in (history_task, persona_task):
+                if task:
+                    task.cancel()
+            raise
+        if not user:
+            logger.error(f"❌ Пользователь с telegram_id {telegram_id} не найден")
+            pending = [t for t in (history_task, persona_task) if t]
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            return None
+
+        # Используем внутренний ID пользователя для всех операций с памятью
+        semantic_memories, important_memories, recent_emotions, overrides = (
+            await asyncio.gather(
+                self._run_stage(
+                    "semantic_memories",
+                    memory_client.search_semantic_memories(
+                        user_id=user.id, query=user_message, limit=15
+                    ),
+                    self.semantic_timeout, [], timings
+                ),
+                self._run_stage(
+                    "important_memories",
+                    memory_client.get_user_memories(
+                        user.id, importance_min=MemoryImportance.HIGH, limit=10
+                    ),
+                    self.stage_timeout, [], timings
+                ),
+                self._run_stage(
+                    "emotions",
+                    memory_client.get_recent_emotions(user.id, days=3, limit=5),
+                    self.stage_timeout, [], timings
+                ),
+                self._run_stage(
+                    "persona_settings",
+                    self._load_persona_overrides(user.id) if persona_id
+                    else asyncio.sleep(0, result={}),
+                    self.stage_timeout, {}, timings
+                )
+            )
+        )
+        chat_history = await history_task
+        persona = await persona_task if persona_task else None
+        if persona_id and not persona:
+            logger.warning(f"⚠️ Persona {persona_id} not found")
+        elif not persona_id:
+            logger.warning("⚠️ No persona_id provided!")
+
+        timings["total"] = time.perf_counter() - started
+        logger.info(
+            f"⏱ Контекст для {telegram_id} собран за {timings['total']:.3f}с: "
+            + ", ".join(
+                f"{name}={seconds * 1000:.0f}мс"
+                for name, seconds in timings.items() if name != "total"
+            )
+        )
+
+        return ChatContext(
+            user=user,
+            chat_history=chat_history,
+            semantic_memories=semantic_memories,
+            important_memories=important_memories,
+            recent_emotions=recent_emotions,
+            persona=persona,
+            persona_overrides=overrides if persona else {},
+            timings=timings
+        )
+
+
+# Глобальный экземпляр сборщика контекста
+context_assembler = ContextAssembler()
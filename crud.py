@@ -1,7 +1,7 @@
 """
 CRUD операции для работы с базой данных
 """
-from typing import Optional, List
+from typing import Optional, List, Tuple
 from datetime import datetime
 
 from sqlalchemy import select, update
@@ -247,6 +247,22 @@ async def get_user_current_persona(
     return result.scalar_one_or_none()
 
 
+async def get_user_current_persona_version(
+    session: AsyncSession, user_id: int
+) -> Optional[Tuple[int, int]]:
+    """Получить ID и версию текущего персонажа пользователя (без загрузки персонажа)"""
+    result = await session.execute(
+        select(Persona.id, Persona.version)
+        .join(UserPersonaSetting)
+        .where(
+            UserPersonaSetting.user_id == user_id,
+            UserPersonaSetting.is_current.is_(True)
+        )
+    )
+    row = result.one_or_none()
+    return (row.id, row.version) if row else None
+
+
 async def get_user_persona_setting(
     session: AsyncSession, user_id: int
 ) -> Optional[UserPersonaSetting]:
@@ -0,0 +1,342 @@
+"""
+Доставка ответов в Telegram: действия (отправка, правка, удаление) и их
+выполнение с разбивкой длинных сообщений и повторами
+"""
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError
+)
+
+from bot_integration import bot_integration, split_message
+from telegram_sender import SendQueueFull
+from queue_client import queue_client, MESSAGE_CLASS_REPLY, MESSAGE_CLASS_STREAM_EDIT
+from redis_client import redis_client, set_seq_if_newer
+from tracing import tracer
+from config import (
+    TELEGRAM_DELIVERY_MODE,
+    DELIVERY_MAX_RETRIES,
+    DELIVERY_RETRY_BASE_DELAY,
+    DELIVERY_MAX_RETRY_AFTER
+)
+
+logger = logging.getLogger(__name__)
+
+# Действия доставки (поле "action" в сообщениях очереди llm_responses)
+ACTION_SEND = "send"          # chat_id, text
+ACTION_EDIT = "edit"          # chat_id, message_id, text
+ACTION_DELETE = "delete"      # chat_id, message_id
+# Ответ новым сообщением с удалением "Печатаю ответ..." (delete_message_id)
+ACTION_REPLY = "reply"        # chat_id, text, delete_message_id
+# Окончательный потоковый ответ: первая часть - в message_id, остальные
+# новыми сообщениями; если править нельзя - как ACTION_REPLY
+ACTION_FINISH = "finish"      # chat_id, message_id, text
+
+# Результат окончательного потокового ответа (ACTION_FINISH)
+FINISH_DELIVERED = "delivered"  # ответ показан целиком
+FINISH_PARTIAL = "partial"      # показана часть: повторная отправка ее продублирует
+FINISH_FAILED = "failed"        # пользователь ничего не увидел
+
+# Режимы доставки
+DELIVERY_MODE_INLINE = "inline"
+DELIVERY_MODE_QUEUE = "queue"
+
+# Сколько сообщений помнить для отбрасывания устаревших правок (в процессе)
+# и сколько секунд хранить номер последнего действия в Redis
+SEQ_CACHE_SIZE = 10000
+SEQ_TTL = 3600
+
+
+class TelegramDeliverer:
+    """
+    Выполняет действия доставки через Bot API.
+
+    Частоту запросов ограничивает middleware бота (telegram_sender.py);
+    здесь повторяются запросы, которые оно не смогло выполнить:
+    TelegramRetryAfter (если ждать не больше DELIVERY_MAX_RETRY_AFTER),
+    сетевые ошибки, 5xx и переполнение очереди отправки.
+    Ошибки запроса (400, 403) не повторяются. Правки с номером seq не
+    больше уже примененного для того же сообщения отбрасываются: поздняя
+    промежуточная правка не должна затереть окончательный ответ. Номер
+    сравнивается и записывается в Redis атомарно, поэтому это работает и
+    при нескольких процессах delivery_worker.py; без Redis - только
+    внутри процесса.
+    """
+
+    def __init__(
+        self,
+        max_retries: int = DELIVERY_MAX_RETRIES,
+        base_delay: float = DELIVERY_RETRY_BASE_DELAY,
+        max_retry_after: float = DELIVERY_MAX_RETRY_AFTER,
+        get_redis: Callable[[], Any] = lambda: redis_client.redis
+    ):
+        self.get_redis = get_redis
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_retry_after = max_retry_after
+        self._last_seq: "OrderedDict[Tuple[int, int], int]" = OrderedDict()
+        self.delivered = 0
+        self.failed = 0
+        self.retries = 0
+        self.stale = 0
+
+    async def _call(self, description: str, request: Callable[[], Awaitable[Any]]) -> bool:
+        """Выполнить запрос к Bot API с повторами"""
+        if not bot_integration.bot:
+            logger.error(f"❌ Бот не инициализирован: {description}")
+            return False
+        for attempt in range(self.max_retries + 1):
+            try:
+                await request()
+                return True
+            except TelegramRetryAfter as e:
+                delay = e.retry_after
+                if delay > self.max_retry_after:
+                    logger.error(f"❌ {description}: flood wait {delay}с, отказ")
+                    return False
+            except (TelegramNetworkError, TelegramServerError, SendQueueFull) as e:
+                delay = random.uniform(0, self.base_delay * 2 ** attempt)
+                logger.warning(f"⚠️ {description}: {type(e).__name__}: {e}")
+            except TelegramBadRequest as e:
+                # Текст не изменился с прошлого редактирования - это не ошибка
+                if "message is not modified" in str(e):
+                    return True
+                logger.error(f"❌ {description}: {e}")
+                return False
+            except Exception as e:
+                logger.error(f"❌ {description}: {type(e).__name__}: {e}")
+                return False
+            if attempt == self.max_retries:
+                break
+            self.retries += 1
+            await asyncio.sleep(delay)
+        logger.error(f"❌ {description}: попытки исчерпаны")
+        return False
+
+    async def _is_stale(self, chat_id: int, message_id: Optional[int], seq: Optional[int]) -> bool:
+        """Проверить и запомнить номер действия над сообщением"""
+        if message_id is None or seq is None:
+            return False
+        key = (chat_id, message_id)
+        last = self._last_seq.get(key)
+        if last is not None and seq <= last:
+            return True
+        self._last_seq[key] = seq
+        self._last_seq.move_to_end(key)
+        if len(self._last_seq) > SEQ_CACHE_SIZE:
+            self._last_seq.popitem(last=False)
+
+        redis = self.get_redis()
+        if redis is None:
+            return False
+        try:
+            return not await set_seq_if_newer(
+                redis, f"delivery:seq:{chat_id}:{message_id}", seq, SEQ_TTL
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось проверить номер действия в Redis: {e}")
+            return False
+
+    async def _send_parts(self, chat_id: int, parts: List[str]) -> int:
+        """Отправить части текста отдельными сообщениями. Возвращает число отправленных"""
+        sent = 0
+        for part in parts:
+            sent += await self._call(
+                f"отправка в чат {chat_id}",
+                lambda part=part: bot_integration.bot.send_message(chat_id, part)
+            )
+        return sent
+
+    async def send(self, chat_id: int, text: str) -> bool:
+        """Отправить текст (длинный - несколькими сообщениями)"""
+        parts = split_message(text)
+        return await self._send_parts(chat_id, parts) == len(parts)
+
+    async def edit(self, chat_id: int, message_id: int, text: str) -> bool:
+        """Изменить текст сообщения"""
+        return await self._call(
+            f"правка сообщения {message_id} в чате {chat_id}",
+            lambda: bot_integration.bot.edit_message_text(
+                text=text, chat_id=chat_id, message_id=message_id
+            )
+        )
+
+    async def delete(self, chat_id: int, message_id: int) -> bool:
+        """Удалить сообщение"""
+        return await self._call(
+            f"удаление сообщения {message_id} в чате {chat_id}",
+            lambda: bot_integration.bot.delete_message(chat_id, message_id)
+        )
+
+    async def reply(self, chat_id: int, text: str, delete_message_id: Optional[int] = None) -> bool:
+        """Отправить ответ и удалить сообщение "Печатаю ответ..." """
+        ok = await self.send(chat_id, text)
+        if delete_message_id:
+            await self.delete(chat_id, delete_message_id)
+        return ok
+
+    async def finish(self, chat_id: int, message_id: int, text: str) -> str:
+        """
+        Записать окончательный ответ в сообщение, остаток - новыми сообщениями.
+
+        Если сообщение отредактировать нельзя, ответ отправляется целиком
+        новыми сообщениями, а message_id удаляется (только если что-то
+        отправлено). Отредактированное сообщение никогда не удаляется.
+        Возвращает FINISH_DELIVERED, FINISH_PARTIAL или FINISH_FAILED.
+        """
+        parts = split_message(text)
+        if not parts:
+            return FINISH_FAILED
+        if await self.edit(chat_id, message_id, parts[0]):
+            sent = 1 + await self._send_parts(chat_id, parts[1:])
+        else:
+            sent = await self._send_parts(chat_id, parts)
+            if sent:
+                await self.delete(chat_id, message_id)
+        if sent == len(parts):
+            return FINISH_DELIVERED
+        return FINISH_PARTIAL if sent else FINISH_FAILED
+
+    async def execute(self, action: Dict[str, Any]) -> bool:
+        """Выполнить действие доставки. Возвращает True при успехе"""
+        kind = action.get("action")
+        chat_id = action.get("chat_id")
+        message_id = action.get("message_id")
+        if await self._is_stale(chat_id, message_id, action.get("seq")):
+            self.stale += 1
+            logger.info(f"⏭ Устаревшее действие {kind} для сообщения {message_id} пропущено")
+            return True
+
+        if kind == ACTION_SEND:
+            ok = await self.send(chat_id, action["text"])
+        elif kind == ACTION_EDIT:
+            ok = await self.edit(chat_id, message_id, action["text"])
+        elif kind == ACTION_DELETE:
+            ok = await self.delete(chat_id, message_id)
+        elif kind == ACTION_REPLY:
+            ok = await self.reply(chat_id, action["text"], action.get("delete_message_id"))
+        elif kind == ACTION_FINISH:
+            action["result"] = await self.finish(chat_id, message_id, action["text"])
+            ok = action["result"] == FINISH_DELIVERED
+        else:
+            logger.error(f"❌ Неизвестное действие доставки: {action!r}")
+            return False
+
+        if ok:
+            self.delivered += 1
+        else:
+            self.failed += 1
+        return ok
+
+
+class DeliveryClient:
+    """
+    Доставка ответов из LLM воркера.
+
+    В режиме "inline" действия выполняются сразу в процессе воркера
+    (TelegramDeliverer). В режиме "queue" действия публикуются в очередь
+    llm_responses, и весь ввод-вывод Telegram выполняет delivery_worker.py;
+    медленный Telegram и flood wait тогда не занимают слоты LLM воркера.
+    В режиме "queue" методы возвращают True после публикации.
+    """
+
+    def __init__(self, mode: str = TELEGRAM_DELIVERY_MODE):
+        self.mode = mode
+        self._last_seq = 0
+
+    def _next_seq(self) -> int:
+        """
+        Номер действия: доставщик отбрасывает правки, пришедшие позже
+        окончательного ответа. Номер строится от времени, а не от счетчика,
+        потому что повтор запроса может выполнить другой процесс воркера.
+        """
+        self._last_seq = max(time.time_ns(), self._last_seq + 1)
+        return self._last_seq
+
+    async def _dispatch(
+        self,
+        action: Dict[str, Any],
+        message_class: str = MESSAGE_CLASS_REPLY
+    ) -> bool:
+        """Выполнить или опубликовать действие"""
+        action["seq"] = self._next_seq()
+        with tracer.span(f"delivery.{action['action']}", mode=self.mode) as span:
+            if self.mode == DELIVERY_MODE_QUEUE:
+                try:
+                    await queue_client.publish_response(action, message_class)
+                    return True
+                except Exception as e:
+                    logger.error(f"❌ Не удалось поставить действие {action['action']} в очередь: {e}")
+                    span.error = str(e)
+                    return False
+            ok = await telegram_deliverer.execute(action)
+            if not ok:
+                span.error = "not delivered"
+            return ok
+
+    async def send(self, chat_id: int, text: str) -> bool:
+        """Отправить сообщение"""
+        return await self._dispatch({"action": ACTION_SEND, "chat_id": chat_id, "text": text})
+
+    async def edit(
+        self,
+        chat_id: int,
+        message_id: int,
+        text: str,
+        intermediate: bool = False
+    ) -> bool:
+        """
+        Изменить текст сообщения.
+
+        intermediate - промежуточная правка потокового ответа: в режиме
+        "queue" публикуется как transient (см. queue_client.DELIVERY_MODES).
+        """
+        return await self._dispatch(
+            {
+                "action": ACTION_EDIT, "chat_id": chat_id,
+                "message_id": message_id, "text": text
+            },
+            MESSAGE_CLASS_STREAM_EDIT if intermediate else MESSAGE_CLASS_REPLY
+        )
+
+    async def delete(self, chat_id: int, message_id: int) -> bool:
+        """Удалить сообщение"""
+        return await self._dispatch({
+            "action": ACTION_DELETE, "chat_id": chat_id, "message_id": message_id
+        })
+
+    async def reply(self, chat_id: int, text: str, delete_message_id: Optional[int] = None) -> bool:
+        """Отправить ответ, удалив "Печатаю ответ..." (если указан его ID)"""
+        return await self._dispatch({
+            "action": ACTION_REPLY, "chat_id": chat_id,
+            "text": text, "delete_message_id": delete_message_id
+        })
+
+    async def finish(self, chat_id: int, message_id: int, text: str) -> str:
+        """
+        Показать окончательный потоковый ответ в сообщении message_id.
+
+        Возвращает FINISH_DELIVERED, FINISH_PARTIAL или FINISH_FAILED; в
+        режиме "queue" - FINISH_DELIVERED после публикации (запасную
+        отправку тогда выполняет delivery_worker.py).
+        """
+        action = {
+            "action": ACTION_FINISH, "chat_id": chat_id,
+            "message_id": message_id, "text": text
+        }
+        if await self._dispatch(action):
+            return FINISH_DELIVERED
+        return action.get("result", FINISH_FAILED)
+
+
+# Глобальные экземпляры
+telegram_deliverer = TelegramDeliverer()
+delivery_client = DeliveryClient()
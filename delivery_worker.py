@@ -0,0 +1,114 @@
+"""
+Воркер доставки ответов в Telegram из очереди llm_responses
+"""
+import asyncio
+import logging
+from typing import Any, Dict
+
+from queue_client import queue_client
+from bot_integration import bot_integration
+from delivery import telegram_deliverer
+from keyed_lock import KeyedLock, DistributedKeyedLock
+from redis_client import redis_client
+from tracing import tracer
+from config import (
+    DELIVERY_WORKER_CONCURRENCY,
+    QUEUE_BACKEND,
+    WORKER_STOP_TIMEOUT,
+    WORKER_USER_LOCK_TTL
+)
+
+logger = logging.getLogger(__name__)
+
+
+class DeliveryWorker:
+    """
+    Выполняет действия доставки (delivery.py), опубликованные LLM
+    воркерами при TELEGRAM_DELIVERY_MODE=queue.
+
+    Действия разных чатов выполняются параллельно (до concurrency штук),
+    одного чата - строго по порядку поступления, чтобы правки потокового
+    ответа не обгоняли друг друга. Несколько процессов делят очередь:
+    чат блокируется в Redis, а устаревшие правки отбрасываются по номеру
+    действия, записанному в Redis (TelegramDeliverer).
+    """
+
+    def __init__(self, concurrency: int = DELIVERY_WORKER_CONCURRENCY):
+        self.concurrency = concurrency
+        self.chat_locks = (
+            KeyedLock() if QUEUE_BACKEND == "memory"
+            else DistributedKeyedLock(
+                lambda: redis_client.redis, prefix="lock:chat:", ttl=WORKER_USER_LOCK_TTL
+            )
+        )
+
+    async def start(self):
+        """Запуск воркера доставки"""
+        try:
+            logger.info("🚀 Запуск Delivery Worker...")
+
+            # Redis: блокировки чатов и номера действий между процессами
+            logger.info("📡 Инициализация Redis...")
+            await redis_client.connect()
+
+            logger.info("📡 Инициализация RabbitMQ...")
+            await queue_client.connect()
+
+            logger.info("📡 Инициализация Bot Integration...")
+            await bot_integration.initialize()
+
+            logger.info(f"✅ Delivery Worker запущен! Конкурентность: {self.concurrency}")
+            try:
+                await queue_client.consume_responses(
+                    self.handle_action,
+                    prefetch_count=self.concurrency
+                )
+            except asyncio.CancelledError:
+                logger.info("Получен сигнал остановки воркера доставки")
+
+        except Exception as e:
+            logger.error(f"Ошибка запуска Delivery Worker: {e}")
+            raise
+
+    async def stop(self):
+        """Остановка воркера доставки"""
+        try:
+            await queue_client.stop_consuming()
+            await queue_client.wait_idle(WORKER_STOP_TIMEOUT)
+            await queue_client.disconnect()
+            await redis_client.disconnect()
+            await bot_integration.close()
+            tracer.flush()
+            logger.info(
+                f"Delivery Worker остановлен: доставлено {telegram_deliverer.delivered}, "
+                f"ошибок {telegram_deliverer.failed}, повторов {telegram_deliverer.retries}, "
+                f"устаревших правок {telegram_deliverer.stale}"
+            )
+        except Exception as e:
+            logger.error(f"Ошибка остановки Delivery Worker: {e}")
+
+    async def handle_action(self, action: Dict[str, Any]):
+        """Выполнить действие доставки по порядку внутри чата"""
+        # Трасса продолжается с участка публикации в LLM воркере
+        with tracer.start_trace(f"delivery.worker.{action.get('action')}", action) as span:
+            async with self.chat_locks.acquire(action.get("chat_id")):
+                span.set_attribute("lock_wait_seconds", span.duration)
+                if not await telegram_deliverer.execute(action):
+                    span.error = "not delivered"
+
+
+async def main():
+    """Основная функция воркера доставки"""
+    tracer.set_service("delivery-worker")
+    worker = DeliveryWorker()
+    try:
+        await worker.start()
+    except KeyboardInterrupt:
+        logger.info("Получен сигнал остановки")
+    finally:
+        await worker.stop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
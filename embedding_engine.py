@@ -0,0 +1,314 @@
+"""
+Расчет эмбеддингов пакетами вне цикла событий, с кэшем по хэшу текста
+"""
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+import metrics
+from config import (
+    REDIS_HOST,
+    REDIS_PORT,
+    REDIS_PASSWORD,
+    EMBEDDING_MODEL,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_BATCH_WAIT_MS,
+    EMBEDDING_THREADS,
+    EMBEDDING_CACHE_SIZE,
+    EMBEDDING_CACHE_REDIS,
+    EMBEDDING_CACHE_TTL
+)
+
+logger = logging.getLogger(__name__)
+
+# Префикс ключей кэша эмбеддингов в Redis
+CACHE_KEY_PREFIX = "embedding"
+# Тексты прогрева модели (короткий и длинный)
+WARMUP_TEXTS = [
+    "Привет!",
+    "Я работаю программистом, живу в Москве и по выходным люблю гулять с собакой в парке."
+]
+
+
+class EmbeddingCache:
+    """
+    Кэш эмбеддингов по (модель, хэш текста).
+
+    Первый уровень - LRU в памяти процесса (float32, как из модели),
+    второй (необязательный) - Redis, общий для всех воркеров: вектор
+    хранится байтами float16 (вдвое компактнее, точности для косинусной
+    близости достаточно). Ошибки Redis не мешают расчету: кэш просто
+    пропускается.
+    """
+
+    def __init__(
+        self,
+        model_name: str = EMBEDDING_MODEL,
+        max_size: int = EMBEDDING_CACHE_SIZE,
+        use_redis: bool = EMBEDDING_CACHE_REDIS,
+        ttl: int = EMBEDDING_CACHE_TTL
+    ):
+        self.model_name = model_name
+        self.max_size = max_size
+        self.use_redis = use_redis
+        self.ttl = ttl
+        self.redis = None
+        self._lru: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._writes: Set[asyncio.Task] = set()
+
+    def key(self, text: str) -> str:
+        digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+        return f"{CACHE_KEY_PREFIX}:{self.model_name}:{digest}"
+
+    def _get_redis(self):
+        if self.redis is None:
+            # Отдельный клиент: общий redis_client декодирует ответы в строки
+            import redis.asyncio as redis
+
+            self.redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PASSWORD)
+        return self.redis
+
+    async def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """Найти эмбеддинги по ключам (сначала в памяти, затем в Redis)"""
+        found = {}
+        for key in keys:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                found[key] = self._lru[key]
+        metrics.EMBEDDING_CACHE.labels("memory").inc(len(found))
+
+        missing = [key for key in keys if key not in found]
+        if missing and self.use_redis:
+            try:
+                values = await self._get_redis().mget(missing)
+            except Exception as e:
+                logger.warning(f"Кэш эмбеддингов в Redis недоступен: {e}")
+                values = []
+            from_redis = 0
+            for key, value in zip(missing, values):
+                if value:
+                    embedding = np.frombuffer(value, dtype=np.float16).astype(np.float32)
+                    found[key] = embedding
+                    self._remember(key, embedding)
+                    from_redis += 1
+            metrics.EMBEDDING_CACHE.labels("redis").inc(from_redis)
+        return found
+
+    def _remember(self, key: str, embedding: np.ndarray) -> None:
+        if self.max_size <= 0:
+            return
+        self._lru[key] = embedding
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_size:
+            self._lru.popitem(last=False)
+
+    def put_many(self, items: Dict[str, np.ndarray]) -> None:
+        """Сохранить рассчитанные эмбеддинги (в Redis - в фоне)"""
+        for key, embedding in items.items():
+            self._remember(key, embedding)
+        if self.use_redis and items:
+            task = asyncio.create_task(self._write(items))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    async def _write(self, items: Dict[str, np.ndarray]) -> None:
+        try:
+            async with self._get_redis().pipeline(transaction=False) as pipe:
+                for key, embedding in items.items():
+                    pipe.set(key, embedding.astype(np.float16).tobytes(), ex=self.ttl)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить эмбеддинги в Redis: {e}")
+
+    async def close(self) -> None:
+        """Дождаться фоновой записи и закрыть соединение с Redis"""
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+        if self.redis is not None:
+            await self.redis.close()
+            self.redis = None
+
+
+class EmbeddingEngine:
+    """
+    Очередь запросов к модели эмбеддингов с микропакетами.
+
+    encode() не блокирует цикл событий: текст ставится в очередь, и все
+    тексты, пришедшие в течение batch_wait секунд от первого (от разных
+    пользователей и запросов), кодируются одним вызовом модели в пуле
+    потоков. Пакет уходит сразу, как только набрано batch_size текстов.
+    Модель при кодировании освобождает GIL, поэтому потоков достаточно, а
+    веса не копируются в отдельные процессы. Потоки пула создаются при
+    первом расчете - после fork в процессах супервизора воркеров.
+
+    Каждый текст кодируется не больше одного раза: результат берется из
+    кэша (EmbeddingCache), а одинаковые тексты, ожидающие расчета,
+    получают один общий результат.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = EMBEDDING_BATCH_SIZE,
+        batch_wait: float = EMBEDDING_BATCH_WAIT_MS / 1000,
+        threads: int = EMBEDDING_THREADS,
+        cache: Optional[EmbeddingCache] = None
+    ):
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.threads = threads
+        self.cache = cache or EmbeddingCache()
+        self.model = None
+        # Модель загружается один раз, даже если первые пакеты считаются параллельно
+        self._model_lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # (текст, ключ кэша, future результата, время постановки в очередь)
+        self._pending: List[Tuple[str, str, asyncio.Future, float]] = []
+        # Ключ кэша -> future текста, который уже ожидает расчета
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.batches = 0
+        self.texts = 0
+
+    def load_model(self) -> None:
+        """Загрузить модель эмбеддингов (если еще не загружена)"""
+        if self.model is not None:
+            return
+        with self._model_lock:
+            if self.model is None:
+                # Импорт здесь: sentence-transformers тянет torch
+                from sentence_transformers import SentenceTransformer
+
+                self.model = SentenceTransformer(EMBEDDING_MODEL)
+
+    async def warmup(self) -> None:
+        """
+        Загрузить модель и прогнать через нее пробный пакет.
+
+        Первый вызов модели заметно медленнее следующих (выделение памяти,
+        подготовка ядер torch): прогрев переносит эту задержку на запуск
+        воркера. Кэш не используется - пробные тексты могли бы в нем
+        оказаться, и модель бы не вызывалась.
+        """
+        loop = asyncio.get_running_loop()
+        if self.model is None:
+            # Загрузка весов - секунды чтения с диска, не в цикле событий
+            await loop.run_in_executor(None, self.load_model)
+        self._ensure_executor()
+        started = time.perf_counter()
+        await loop.run_in_executor(
+            self._executor,
+            partial(self.model.encode, WARMUP_TEXTS, batch_size=len(WARMUP_TEXTS), convert_to_numpy=True)
+        )
+        logger.info(f"🔥 Модель эмбеддингов прогрета за {time.perf_counter() - started:.2f}с")
+
+    def _ensure_executor(self) -> None:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.threads, thread_name_prefix="embedding"
+            )
+
+    async def encode(self, texts: List[str]) -> np.ndarray:
+        """Эмбеддинги текстов (строки результата - в порядке texts)"""
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        keys = [self.cache.key(text) for text in texts]
+        found = await self.cache.get_many(list(dict.fromkeys(keys)))
+
+        loop = asyncio.get_running_loop()
+        futures: Dict[str, asyncio.Future] = {}
+        for text, key in zip(texts, keys):
+            if key in found or key in futures:
+                continue
+            future = self._in_flight.get(key)
+            if future is None:
+                future = loop.create_future()
+                self._in_flight[key] = future
+                self._pending.append((text, key, future, time.perf_counter()))
+                metrics.EMBEDDING_CACHE.labels("miss").inc()
+            futures[key] = future
+
+        if len(self._pending) >= self.batch_size:
+            self._dispatch()
+        elif self._pending and self._timer is None:
+            self._timer = loop.call_later(self.batch_wait, self._dispatch)
+        if futures:
+            # shield: отмена одного ожидающего не отменяет общий результат
+            results = await asyncio.gather(*(asyncio.shield(f) for f in futures.values()))
+            found.update(zip(futures, results))
+        return np.stack([found[key] for key in keys])
+
+    async def encode_one(self, text: str) -> np.ndarray:
+        """Эмбеддинг одного текста"""
+        return (await self.encode([text]))[0]
+
+    def _dispatch(self) -> None:
+        """Отправить накопленные тексты в пул пакетами по batch_size"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._ensure_executor()
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            work = loop.run_in_executor(self._executor, self._encode_batch, batch)
+            work.add_done_callback(lambda done, batch=batch: self._resolve(batch, done))
+
+    def _encode_batch(self, batch: List[Tuple[str, str, asyncio.Future, float]]) -> np.ndarray:
+        """Расчет пакета (в потоке пула)"""
+        # Без warmup() (скрипты, фоновые записи) модель загружается здесь
+        self.load_model()
+        started = time.perf_counter()
+        for _, _, _, enqueued in batch:
+            metrics.EMBEDDING_QUEUE_WAIT.observe(started - enqueued)
+        metrics.EMBEDDING_BATCH.observe(len(batch))
+        embeddings = self.model.encode(
+            [text for text, _, _, _ in batch],
+            batch_size=len(batch),
+            convert_to_numpy=True
+        )
+        metrics.EMBEDDING_ENCODE_LATENCY.observe(time.perf_counter() - started)
+        return embeddings
+
+    def _resolve(self, batch: List[Tuple[str, str, asyncio.Future, float]], done: asyncio.Future) -> None:
+        """Раздать результаты пакета ожидающим запросам и сохранить в кэш"""
+        self.batches += 1
+        self.texts += len(batch)
+        error = done.exception()
+        computed = {}
+        for i, (_, key, future, _) in enumerate(batch):
+            self._in_flight.pop(key, None)
+            if error is not None:
+                future.set_exception(error)
+                continue
+            computed[key] = done.result()[i]
+            future.set_result(computed[key])
+        self.cache.put_many(computed)
+
+    def get_stats(self) -> dict:
+        """Пакеты и средний размер пакета"""
+        return {
+            "batches": self.batches,
+            "texts": self.texts,
+            "avg_batch": self.texts / self.batches if self.batches else 0.0,
+            "pending": len(self._pending)
+        }
+
+    async def close(self) -> None:
+        """Остановить пул потоков (текущие расчеты завершатся) и кэш"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        await self.cache.close()
+
+
+# Глобальный движок эмбеддингов процесса
+embedding_engine = EmbeddingEngine()
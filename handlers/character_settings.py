@@ -17,9 +17,7 @@ from database import async_session_maker
 from crud import (
     get_user_by_telegram_id,
     get_active_personas,
-    get_user_current_persona,
     set_user_persona,
-    get_persona_by_id,
     update_user_tone,
     update_user_interests,
     update_user_goals,
@@ -28,6 +26,7 @@ from crud import (
     get_user_persona_setting
 )
 from models import GFTone, GFInterest, GFGoal
+from persona_cache import persona_cache
 
 router = Router()
 logger = logging.getLogger(__name__)
@@ -52,7 +51,7 @@ async def _show_character_settings(message: Message, from_user=None):
     if user:
         # Получаем текущую личность
         async with async_session_maker() as session:
-            current_persona = await get_user_current_persona(
+            current_persona = await persona_cache.get_user_current_persona(
                 session, user.id
             )
 
@@ -493,7 +492,7 @@ async def handle_select_persona(message: Message):
         current_persona = None
         if user:
             try:
-                current_persona = await get_user_current_persona(
+                current_persona = await persona_cache.get_user_current_persona(
                     session, user.id
                 )
             except Exception:
@@ -1063,7 +1062,7 @@ async def handle_persona_selection_callback(callback: CallbackQuery):
 
     async with async_session_maker() as session:
         # Получаем персонажа по ID
-        selected_persona = await get_persona_by_id(session, persona_id)
+        selected_persona = await persona_cache.get_by_id(persona_id)
 
         if not selected_persona:
             logger.warning(f"Персонаж с ID {persona_id} не найден")
@@ -1,15 +1,15 @@
 import logging
-import time
 from aiogram import Router, F
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup
 
 from database import async_session_maker
-from crud import get_user_by_telegram_id, get_user_current_persona
+from crud import get_user_by_telegram_id
+from persona_cache import persona_cache
 from redis_client import redis_client
-from queue_client import queue_client
-from utils import check_message_limit
+from message_coalescer import message_coalescer
+from utils import check_message_limit, get_request_tier
 from .menu import get_main_menu_keyboard
 
 router = Router()
@@ -57,13 +57,14 @@ async def handle_start_chat(message: Message, state: FSMContext):
                 telegram_id=user_id
             )
 
-        # Получаем текущего персонажа
-        persona_name = "подруга"
-        if user:
-            from crud import get_user_current_persona
-            current_persona = await get_user_current_persona(session, user.id)
-            if current_persona:
-                persona_name = current_persona.name
+            # Получаем текущего персонажа
+            persona_name = "подруга"
+            if user:
+                current_persona = await persona_cache.get_user_current_persona(
+                    session, user.id
+                )
+                if current_persona:
+                    persona_name = current_persona.name
 
         # Показываем клавиатуру чата
         await message.answer(
@@ -143,6 +144,11 @@ async def handle_other_messages(message: Message):
             # Если пользователь не в режиме чата, игнорируем сообщение
             return
 
+        if not user_message:
+            # Стикеры, фото, голосовые: у сообщения нет текста для LLM
+            await message.answer("✍️ Пока я понимаю только текстовые сообщения.")
+            return
+
         async with async_session_maker() as session:
             user = await get_user_by_telegram_id(session, telegram_id=user_id)
             if not user:
@@ -182,7 +188,9 @@ async def handle_other_messages(message: Message):
                 )
                 await message.answer(warning_text)
 
-            current_persona = await get_user_current_persona(session, user.id)
+            current_persona = await persona_cache.get_user_current_persona(
+                session, user.id
+            )
 
             logger.info(
                 f"📋 Current persona for user {user_id}: "
@@ -190,29 +198,35 @@ async def handle_other_messages(message: Message):
                 f"name={current_persona.name if current_persona else 'None'}"
             )
 
-        thinking_message = await message.answer(
-            "Печатаю ответ...",
-            reply_markup=get_chat_keyboard()
-        )
-
-        queue_message = {
-            "user_id": user_id,
-            "chat_id": chat_id,
-            "message": user_message,
-            "timestamp": int(time.time()),
-            "persona_id": current_persona.id if current_persona else None,
-            "thinking_message_id": thinking_message.message_id
-        }
-
-        logger.info(
-            f"📤 Sending to queue for user {user_id}: "
-            f"persona_id={queue_message['persona_id']}"
+        # Серия быстрых сообщений объединяется в одну реплику: в очередь
+        # уходит один запрос, "Печатаю ответ..." получает только первое
+        # сообщение серии
+        turn = message_coalescer.add(
+            user_id,
+            chat_id,
+            user_message,
+            current_persona.id if current_persona else None,
+            # Подписчики попадают в приоритетную полосу очереди
+            get_request_tier(user),
+            current_persona.version if current_persona else None,
+            message.bot
         )
+        if turn is None:
+            return
 
-        await queue_client.publish_message(queue_message)
+        thinking_message_id = None
+        try:
+            thinking_message = await message.answer(
+                "Печатаю ответ...",
+                reply_markup=get_chat_keyboard()
+            )
+            thinking_message_id = thinking_message.message_id
+        finally:
+            # Реплика будет опубликована и без "Печатаю ответ..."
+            message_coalescer.set_thinking_message(turn, thinking_message_id)
 
         if user_id:
-            logger.info(f"Сообщение пользователя {user_id} отправлено в очередь")
+            logger.info(f"Сообщение пользователя {user_id} принято, реплика открыта")
 
     except Exception as e:
         logger.error(f"Ошибка обработки сообщения чата: {e}")
@@ -19,10 +19,10 @@ from crud import (
     add_user_goals,
     update_user_about,
     get_active_personas,
-    get_persona_by_id,
     set_user_persona
 )
 from models import GFTone, GFInterest, GFGoal
+from persona_cache import persona_cache
 from .menu import show_main_menu
 
 router = Router()
@@ -554,7 +554,7 @@ async def handle_questionnaire_persona_selection(
 
     async with async_session_maker() as session:
         # Получаем персонажа по ID
-        selected_persona = await get_persona_by_id(session, persona_id)
+        selected_persona = await persona_cache.get_by_id(persona_id)
 
         if not selected_persona:
             logger.warning(f"Персонаж с ID {persona_id} не найден")
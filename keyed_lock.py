@@ -0,0 +1,150 @@
+"""
+Блокировки по ключу для упорядоченной конкурентной обработки
+"""
+import asyncio
+import logging
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedLock:
+    """
+    Набор asyncio-блокировок, по одной на ключ (например, user_id).
+
+    Задачи с разными ключами выполняются параллельно, задачи с одинаковым
+    ключом - строго по очереди в порядке захвата (asyncio.Lock честный,
+    ожидающие получают блокировку в порядке FIFO). Блокировки удаляются,
+    как только по ключу не остается ни владельца, ни ожидающих.
+    """
+
+    def __init__(self):
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+        self._holders: Dict[Hashable, int] = {}
+
+    @asynccontextmanager
+    async def acquire(self, key: Hashable) -> AsyncIterator[None]:
+        """Захватить блокировку для ключа"""
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+            self._holders[key] = 0
+        self._holders[key] += 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._holders[key] -= 1
+            if self._holders[key] == 0:
+                del self._locks[key]
+                del self._holders[key]
+
+    def is_locked(self, key: Hashable) -> bool:
+        """Занят ли ключ в данный момент"""
+        lock = self._locks.get(key)
+        return lock is not None and lock.locked()
+
+    def __len__(self) -> int:
+        """Количество ключей с активными или ожидающими задачами"""
+        return len(self._locks)
+
+
+# Снять блокировку / продлить ее, только если она все еще наша
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+_RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class DistributedKeyedLock:
+    """
+    Блокировки по ключу, общие для нескольких процессов (через Redis).
+
+    Внутри процесса задачи с одним ключом упорядочивает KeyedLock (FIFO),
+    между процессами - блокировка в Redis (SET NX с TTL, продлевается,
+    пока задача выполняется): ключ обрабатывает не больше одного процесса
+    одновременно. Если процесс упал, блокировка освобождается через ttl
+    секунд. Порядок между процессами - порядок захвата, то есть порядок
+    доставки сообщений из очереди.
+
+    get_redis() возвращает клиент redis.asyncio или None; без Redis (или
+    при его ошибке) остается только блокировка внутри процесса.
+    """
+
+    def __init__(
+        self,
+        get_redis: Callable[[], Any],
+        prefix: str = "lock:user:",
+        ttl: float = 30.0,
+        poll_interval: float = 0.05
+    ):
+        self.get_redis = get_redis
+        self.prefix = prefix
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.local = KeyedLock()
+
+    @asynccontextmanager
+    async def acquire(self, key: Hashable) -> AsyncIterator[None]:
+        """Захватить блокировку для ключа (сначала в процессе, затем в Redis)"""
+        async with self.local.acquire(key):
+            name = f"{self.prefix}{key}"
+            token = await self._lock(name)
+            renewal = asyncio.create_task(self._renew(name, token)) if token else None
+            try:
+                yield
+            finally:
+                if renewal is not None:
+                    renewal.cancel()
+                    await self._unlock(name, token)
+
+    async def _lock(self, name: str) -> Optional[str]:
+        """Дождаться блокировки в Redis; None - Redis недоступен"""
+        token = uuid.uuid4().hex
+        delay = self.poll_interval
+        while True:
+            redis = self.get_redis()
+            if redis is None:
+                return None
+            try:
+                if await redis.set(name, token, nx=True, px=int(self.ttl * 1000)):
+                    return token
+            except Exception as e:
+                logger.warning(f"Блокировка {name} в Redis недоступна, только в процессе: {e}")
+                return None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+    async def _renew(self, name: str, token: str) -> None:
+        """Продлевать блокировку, пока она захвачена"""
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                await self.get_redis().eval(_RENEW_SCRIPT, 1, name, token, int(self.ttl * 1000))
+            except Exception as e:
+                logger.warning(f"Не удалось продлить блокировку {name}: {e}")
+
+    async def _unlock(self, name: str, token: str) -> None:
+        try:
+            await self.get_redis().eval(_RELEASE_SCRIPT, 1, name, token)
+        except Exception as e:
+            # Блокировка освободится сама через ttl
+            logger.warning(f"Не удалось снять блокировку {name}: {e}")
+
+    def is_locked(self, key: Hashable) -> bool:
+        """Занят ли ключ в этом процессе"""
+        return self.local.is_locked(key)
+
+    def __len__(self) -> int:
+        return len(self.local)
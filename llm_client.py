@@ -0,0 +1,417 @@
+"""
+Устойчивый HTTP-клиент LLM API: пул соединений, повторы, circuit breaker
+и резервные модели
+"""
+import asyncio
+import json
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+import aiohttp
+
+from tracing import tracer
+from config import (
+    LLM_API_URL,
+    LLM_API_KEY,
+    LLM_MODELS,
+    LLM_MAX_TOKENS,
+    LLM_TIMEOUT,
+    LLM_STREAM_TIMEOUT,
+    LLM_MAX_RETRIES,
+    LLM_RETRY_BASE_DELAY,
+    LLM_RETRY_MAX_DELAY,
+    LLM_CIRCUIT_FAILURE_THRESHOLD,
+    LLM_CIRCUIT_RESET_TIMEOUT,
+    LLM_POOL_SIZE,
+    LLM_KEEPALIVE_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+# Статусы, при которых запрос имеет смысл повторить
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+class LLMRequestError(Exception):
+    """Ошибка запроса к модели"""
+
+    def __init__(self, message: str, status: Optional[int] = None,
+                 retryable: bool = False, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для одной модели.
+
+    После failure_threshold ошибок подряд переходит в состояние "open" и
+    reset_timeout секунд не пропускает запросы к модели. Затем пропускает
+    один пробный запрос ("half_open"): успех закрывает предохранитель,
+    ошибка или отмена снова открывает. Ошибками считаются только сбои
+    модели (см. is_model_failure): 4xx на плохой запрос - нет.
+    """
+
+    @staticmethod
+    def is_model_failure(error: Exception) -> bool:
+        """Сбой модели: 5xx, 429, таймаут, ошибка соединения, пустой ответ"""
+        if not isinstance(error, LLMRequestError):
+            return False
+        status = error.status
+        return status is None or status in (408, 429) or status >= 500
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow_request(self) -> bool:
+        """Можно ли отправить запрос"""
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+            return True
+        # В half_open пробный запрос уже отправлен
+        return False
+
+    def record_success(self) -> None:
+        """Успешный запрос"""
+        self.state = "closed"
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        """Неуспешный запрос (после всех повторов)"""
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+class ModelStats:
+    """Счетчики запросов и задержек одной модели"""
+
+    def __init__(self):
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.retries = 0
+        self.errors_by_status: Dict[str, int] = {}
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def record_latency(self, seconds: float) -> None:
+        """Учесть длительность успешного запроса"""
+        self.latency_total += seconds
+        self.latency_max = max(self.latency_max, seconds)
+
+    def record_usage(self, usage: Optional[Dict]) -> None:
+        """Учесть расход токенов из поля usage ответа"""
+        if not usage:
+            return
+        self.prompt_tokens += usage.get("prompt_tokens") or 0
+        self.completion_tokens += usage.get("completion_tokens") or 0
+
+    def record_error(self, status: Optional[int]) -> None:
+        """Учесть ошибку попытки (HTTP-статус или сетевую ошибку)"""
+        key = str(status) if status else "network"
+        self.errors_by_status[key] = self.errors_by_status.get(key, 0) + 1
+
+    def to_dict(self) -> Dict:
+        """Снимок счетчиков"""
+        return {
+            "requests": self.requests,
+            "successes": self.successes,
+            "failures": self.failures,
+            "retries": self.retries,
+            "errors_by_status": dict(self.errors_by_status),
+            "latency_avg": self.latency_total / self.successes if self.successes else 0.0,
+            "latency_max": self.latency_max,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens
+        }
+
+
+class LLMClient:
+    """
+    Клиент OpenAI-совместимого chat completions API.
+
+    - keep-alive пул соединений, размер которого соответствует
+      конкурентности воркера;
+    - повторы при 429/5xx и сетевых ошибках с экспоненциальной задержкой
+      и джиттером, с учетом заголовка Retry-After;
+    - circuit breaker на каждую модель;
+    - упорядоченный список моделей: при отказе основной модели запрос
+      уходит в следующую (LLM_MODEL, затем LLM_FALLBACK_MODELS).
+    """
+
+    def __init__(self, models: List[str] = None):
+        self.models = models or LLM_MODELS
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.breakers = {
+            model: CircuitBreaker(LLM_CIRCUIT_FAILURE_THRESHOLD, LLM_CIRCUIT_RESET_TIMEOUT)
+            for model in self.models
+        }
+        self.stats = {model: ModelStats() for model in self.models}
+
+    async def start(self) -> None:
+        """Создать HTTP-сессию с пулом соединений"""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=LLM_POOL_SIZE,
+                limit_per_host=LLM_POOL_SIZE,
+                keepalive_timeout=LLM_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=300
+            )
+            self.session = aiohttp.ClientSession(connector=connector)
+            logger.info(
+                f"🌐 LLM клиент: пул {LLM_POOL_SIZE} соединений, "
+                f"модели {', '.join(self.models)}"
+            )
+
+    async def close(self) -> None:
+        """Закрыть HTTP-сессию"""
+        if self.session and not self.session.closed:
+            await self.session.close()
+        logger.info(f"📊 Статистика LLM по моделям: {self.get_stats()}")
+
+    def get_stats(self) -> Dict[str, Dict]:
+        """Счетчики и состояние предохранителя по каждой модели"""
+        return {
+            model: {**self.stats[model].to_dict(), "circuit": self.breakers[model].state}
+            for model in self.models
+        }
+
+    @staticmethod
+    def _headers(stream: bool) -> Dict[str, str]:
+        """Заголовки запроса"""
+        headers = {
+            "Authorization": f"Bearer {LLM_API_KEY}",
+            "Content-Type": "application/json",
+            "HTTP-Referer": "https://ai-gf-bot.com",  # Обязательно для OpenRouter
+            "X-Title": "AI Girlfriend Bot"  # Обязательно для OpenRouter
+        }
+        if stream:
+            headers["Accept"] = "text/event-stream"
+        return headers
+
+    @staticmethod
+    def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+        """Значение Retry-After в секундах (число или HTTP-дата)"""
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _backoff(attempt: int) -> float:
+        """Экспоненциальная задержка с полным джиттером"""
+        return random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** attempt))
+
+    @staticmethod
+    def _parse_stream_chunk(payload: str) -> Tuple[Optional[str], Optional[Dict]]:
+        """
+        Извлечь текст фрагмента и расход токенов (usage, приходит в
+        последнем событии) из SSE-события chat.completion.chunk
+        """
+        try:
+            event = json.loads(payload)
+        except json.JSONDecodeError:
+            return None, None
+        if "error" in event:
+            raise LLMRequestError(f"LLM stream error: {event['error']}", retryable=True)
+        choices = event.get("choices") or []
+        text = (choices[0].get("delta") or {}).get("content") if choices else None
+        return text, event.get("usage")
+
+    async def _attempt(
+        self,
+        model: str,
+        messages: List[Dict],
+        on_text: Optional[Callable[[str], None]]
+    ) -> str:
+        """Одна попытка запроса к модели"""
+        stream = on_text is not None
+        data = {
+            "model": model,
+            "messages": messages,
+            "max_tokens": LLM_MAX_TOKENS,
+            "temperature": 0.7
+        }
+        if stream:
+            data["stream"] = True
+            # Расход токенов в последнем событии потока
+            data["stream_options"] = {"include_usage": True}
+            # Общий таймаут больше, чем у обычного запроса: поток длится
+            # всю генерацию, но паузы между фрагментами короткие
+            timeout = aiohttp.ClientTimeout(total=LLM_STREAM_TIMEOUT, sock_read=LLM_TIMEOUT)
+        else:
+            timeout = aiohttp.ClientTimeout(total=LLM_TIMEOUT)
+
+        try:
+            async with self.session.post(
+                LLM_API_URL,
+                headers=self._headers(stream),
+                json=data,
+                timeout=timeout
+            ) as response:
+                if response.status != 200:
+                    body = (await response.text())[:200]
+                    raise LLMRequestError(
+                        f"HTTP {response.status}: {body}",
+                        status=response.status,
+                        retryable=response.status in RETRYABLE_STATUSES,
+                        retry_after=self._parse_retry_after(
+                            response.headers.get("Retry-After")
+                        )
+                    )
+
+                if not stream:
+                    result = await response.json()
+                    self.stats[model].record_usage(result.get("usage"))
+                    return result['choices'][0]['message']['content'].strip()
+
+                text = ""
+                async for raw_line in response.content:
+                    line = raw_line.decode("utf-8").strip()
+                    # Пустые строки разделяют события, ':' - комментарии
+                    # (OpenRouter шлет ": OPENROUTER PROCESSING")
+                    if not line.startswith("data:"):
+                        continue
+                    payload = line[len("data:"):].strip()
+                    if payload == "[DONE]":
+                        break
+                    chunk, usage = self._parse_stream_chunk(payload)
+                    self.stats[model].record_usage(usage)
+                    if chunk:
+                        text += chunk
+                        on_text(text)
+                return text.strip()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise LLMRequestError(f"{type(e).__name__}: {e}", retryable=True) from e
+
+    async def _request_model(
+        self,
+        model: str,
+        messages: List[Dict],
+        on_text: Optional[Callable[[str], None]]
+    ) -> str:
+        """Запрос к модели с повторами"""
+        stats = self.stats[model]
+        emitted = False
+        started = time.monotonic()
+
+        def track(text: str) -> None:
+            nonlocal emitted
+            if not emitted:
+                tracer.set_attribute("first_token_seconds", time.monotonic() - started)
+            emitted = True
+            on_text(text)
+
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            stats.requests += 1
+            started = time.monotonic()
+            try:
+                with tracer.span(
+                    "llm.attempt", model=model, attempt=attempt + 1,
+                    stream=on_text is not None
+                ):
+                    text = await self._attempt(model, messages, track if on_text else None)
+                    if not text:
+                        raise LLMRequestError("Пустой ответ модели", retryable=True)
+                stats.successes += 1
+                stats.record_latency(time.monotonic() - started)
+                return text
+            except LLMRequestError as e:
+                stats.record_error(e.status)
+                # Если часть ответа уже показана пользователю, повтор
+                # начал бы текст заново - отдаем ошибку наверх
+                if not e.retryable or emitted or attempt == LLM_MAX_RETRIES:
+                    raise
+                delay = e.retry_after if e.retry_after is not None else self._backoff(attempt)
+                if delay > LLM_RETRY_MAX_DELAY:
+                    # Провайдер просит ждать дольше, чем имеет смысл
+                    # держать пользователя - переходим к следующей модели
+                    raise
+                stats.retries += 1
+                logger.warning(
+                    f"🔁 LLM {model}: {e}; повтор {attempt + 1}/{LLM_MAX_RETRIES} "
+                    f"через {delay:.2f}с"
+                )
+                await asyncio.sleep(delay)
+        raise LLMRequestError("Повторы исчерпаны")
+
+    async def _request(
+        self,
+        messages: List[Dict],
+        on_text: Optional[Callable[[str], None]] = None
+    ) -> str:
+        """Запрос с перебором моделей. Возвращает "" при отказе всех моделей"""
+        if self.session is None:
+            await self.start()
+        emitted = False
+
+        def track(text: str) -> None:
+            nonlocal emitted
+            emitted = True
+            on_text(text)
+
+        for model in self.models:
+            breaker = self.breakers[model]
+            if not breaker.allow_request():
+                logger.warning(f"⛔ LLM {model}: предохранитель открыт, пропускаем модель")
+                continue
+            try:
+                text = await self._request_model(model, messages, track if on_text else None)
+                breaker.record_success()
+                return text
+            except asyncio.CancelledError:
+                # Отмененный запрос - тоже ошибка: иначе отмененный пробный
+                # запрос оставил бы предохранитель в half_open навсегда
+                breaker.record_failure()
+                raise
+            except Exception as e:
+                if breaker.is_model_failure(e):
+                    breaker.record_failure()
+                else:
+                    # Модель ответила (отказ из-за самого запроса, например
+                    # 400 на длину контекста): она работает
+                    breaker.record_success()
+                self.stats[model].failures += 1
+                logger.error(f"❌ Ошибка LLM {model}: {e}")
+                if emitted:
+                    # Частичный потоковый ответ нельзя продолжить другой моделью
+                    break
+        return ""
+
+    async def complete(self, messages: List[Dict]) -> str:
+        """Обычный (не потоковый) запрос. Возвращает "" при ошибке"""
+        return await self._request(messages)
+
+    async def stream(self, messages: List[Dict], on_text: Callable[[str], None]) -> str:
+        """
+        Потоковый запрос (SSE).
+
+        on_text вызывается с накопленным текстом после каждого фрагмента.
+        Возвращает полный ответ или "" при ошибке.
+        """
+        return await self._request(messages, on_text)
+
+
+# Глобальный экземпляр LLM клиента
+llm_client = LLMClient()
@@ -3,58 +3,146 @@
 """
 import logging
 import asyncio
-import aiohttp
-from typing import Dict, Any, List
+import re
+import time
+from functools import lru_cache
+from typing import Dict, Any, AsyncContextManager, List, Callable, Optional, Tuple
 from queue_client import queue_client
-from redis_client import redis_client
+from llm_client import llm_client
+from redis_client import redis_client, set_seq_if_newer
 from bot_integration import bot_integration
-from memory_client import memory_client
+from delivery import delivery_client, DELIVERY_MODE_INLINE, FINISH_DELIVERED, FINISH_FAILED, FINISH_PARTIAL
+from memory_client import memory_client, IMPORTANCE_ORDER
+from vector_client import vector_client
+from context_assembler import context_assembler
+from persona_cache import persona_cache
+from prompt_builder import prompt_builder
+from token_budget import context_budget, static_prefix_tokens
 from models import MemoryType, MemoryImportance
-from config import LLM_API_URL, LLM_API_KEY, LLM_MODEL
-from database import async_session_maker
-from crud import (
-    get_persona_by_id,
-    get_user_persona_setting,
-    get_user_by_telegram_id
+from keyed_lock import KeyedLock, DistributedKeyedLock
+from stream_editor import StreamingMessageEditor
+from write_behind import WriteBehindPipeline
+import metrics
+from metrics import metrics_server
+from embedding_engine import embedding_engine
+from vector_store import vector_store
+from tracing import tracer
+from config import (
+    LLM_STREAMING,
+    QUEUE_BACKEND,
+    WORKER_CONCURRENCY,
+    WORKER_USER_LOCK_TTL,
+    WORKER_STOP_TIMEOUT,
+    MEMORY_PIPELINE_MAX_SIZE,
+    MEMORY_PIPELINE_BATCH_SIZE,
+    MEMORY_PIPELINE_FLUSH_INTERVAL,
+    MEMORY_PIPELINE_MAX_RETRIES
 )
 
 logger = logging.getLogger(__name__)
 
+# Текст сообщения-заглушки, которое бот отправляет перед запросом
+THINKING_MESSAGE_TEXT = "Печатаю ответ..."
+
+# Сколько хранится номер последней обработанной реплики пользователя (секунды)
+TURN_SEQ_TTL = 3600
+
+
+@lru_cache(maxsize=None)
+def _keyword_pattern(keywords: Tuple[str, ...]) -> "re.Pattern":
+    # Ключевое слово - начало слова: "мой" находит "мой" и "моим", но не "простой"
+    return re.compile(r"(?<!\w)(?:" + "|".join(map(re.escape, keywords)) + ")")
+
+
+def _has_keyword(text: str, keywords: List[str]) -> bool:
+    """Есть ли в тексте слово, начинающееся с одного из ключевых слов"""
+    return _keyword_pattern(tuple(keywords)).search(text) is not None
+
+
+class LLMUnavailableError(Exception):
+    """LLM не вернула ответ (все модели и повторы исчерпаны)"""
+
 
 class LLMWorker:
     """Воркер для обработки сообщений через LLM API"""
     
-    def __init__(self):
-        self.session = None
+    def __init__(self, concurrency: int = WORKER_CONCURRENCY):
+        # Максимум одновременно обрабатываемых запросов в процессе
+        self.concurrency = concurrency
+        # Сериализация запросов одного пользователя: пары user/assistant
+        # в истории Redis не должны перемешиваться
+        # Несколько процессов воркера делят очередь: блокировка в Redis
+        self.user_locks = (
+            KeyedLock() if QUEUE_BACKEND == "memory"
+            else DistributedKeyedLock(lambda: redis_client.redis, ttl=WORKER_USER_LOCK_TTL)
+        )
+        self.in_flight = 0
+        # Анализ и сохранение воспоминаний выполняются в фоне, после
+        # отправки ответа, пакетами. Эмоции и воспоминания - отдельные
+        # обработчики: повтор записи воспоминаний не дублирует эмоции
+        self.memory_pipeline = WriteBehindPipeline(
+            "memory",
+            [self._save_emotions_batch, self._save_memories_batch],
+            max_size=MEMORY_PIPELINE_MAX_SIZE,
+            batch_size=MEMORY_PIPELINE_BATCH_SIZE,
+            flush_interval=MEMORY_PIPELINE_FLUSH_INTERVAL,
+            max_retries=MEMORY_PIPELINE_MAX_RETRIES,
+            dead_letter=lambda job, reason: redis_client.push_dead_letter("memory", job, reason)
+        )
     
     async def start(self):
         """Запуск воркера"""
+        warmup = None
         try:
             logger.info("🚀 Запуск LLM Worker...")
             
+            # Прогрев векторного поиска (ChromaDB и модель эмбеддингов) идет
+            # параллельно с подключениями; очередь не читается, пока он не
+            # закончится, - первый пользователь не ждет загрузки модели
+            metrics.WORKER_READY.set(0)
+            warmup = asyncio.create_task(vector_client.warmup())
+            
             # Подключаемся к Redis
             logger.info("📡 Инициализация Redis...")
             await redis_client.connect()
+            persona_cache.start_listener(redis_client.redis)
             
             # Подключаемся к RabbitMQ
             logger.info("📡 Инициализация RabbitMQ...")
             await queue_client.connect()
             
-            # Инициализируем интеграцию с ботом
-            logger.info("📡 Инициализация Bot Integration...")
-            await bot_integration.initialize()
+            # Инициализируем интеграцию с ботом (в режиме "queue" Telegram
+            # обслуживает delivery_worker.py)
+            if delivery_client.mode == DELIVERY_MODE_INLINE:
+                logger.info("📡 Инициализация Bot Integration...")
+                await bot_integration.initialize()
+            else:
+                logger.info(f"📬 Доставка ответов через очередь {queue_client.response_queue}")
+            
+            # Создаем пул соединений к LLM API
+            await llm_client.start()
+            
+            # Запускаем фоновую запись воспоминаний
+            self.memory_pipeline.start()
             
-            # Создаем HTTP сессию
-            self.session = aiohttp.ClientSession()
-            logger.info("🌐 HTTP сессия создана")
+            # Эндпоинт /metrics для мониторинга и автомасштабирования
+            metrics_server.start()
             
-            logger.info("✅ LLM Worker успешно запущен!")
+            logger.info("⏳ Ожидание прогрева векторного поиска...")
+            await warmup
+            metrics.WORKER_READY.set(1)
+            
+            logger.info(f"✅ LLM Worker успешно запущен! Конкурентность: {self.concurrency}")
             logger.info("👂 Начинаем прослушивание запросов из RabbitMQ...")
             
             # Начинаем прослушивание очереди запросов
             # Этот метод будет блокировать выполнение
             try:
-                await queue_client.consume_requests(self.handle_llm_request)
+                await queue_client.consume_requests(
+                    self.handle_llm_request,
+                    prefetch_count=self.concurrency,
+                    ordering=self.user_ordering
+                )
             except asyncio.CancelledError:
                 logger.info("Получен сигнал остановки воркера")
             except KeyboardInterrupt:
@@ -66,21 +154,35 @@ class LLMWorker:
         except Exception as e:
             logger.error(f"Ошибка запуска LLM Worker: {e}")
             raise
+        finally:
+            # Запуск прерван до конца прогрева
+            if warmup is not None and not warmup.done():
+                warmup.cancel()
     
     async def stop(self):
         """Остановка воркера"""
         try:
-            # Останавливаем потребление сообщений
+            # Останавливаем потребление сообщений и дожидаемся запросов,
+            # которые уже обрабатываются: соединения закрываются после них
+            metrics.WORKER_READY.set(0)
             await queue_client.stop_consuming()
+            await queue_client.wait_idle(WORKER_STOP_TIMEOUT)
+            await metrics_server.stop()
             
-            # Закрываем HTTP сессию
-            if self.session:
-                await self.session.close()
+            # Дожидаемся записи воспоминаний по уже обработанным запросам
+            await self.memory_pipeline.stop()
+            
+            # Закрываем соединения с LLM API, пулы эмбеддингов и ChromaDB
+            await llm_client.close()
+            await embedding_engine.close()
+            await vector_store.close()
             
             # Отключаемся от всех сервисов
+            await persona_cache.stop_listener()
             await redis_client.disconnect()
             await queue_client.disconnect()
             await bot_integration.close()
+            tracer.flush()
             
             logger.info("LLM Worker остановлен")
             
@@ -88,92 +190,116 @@ class LLMWorker:
             logger.error(f"Ошибка остановки LLM Worker: {e}")
     
     async def handle_llm_request(self, message: Dict[str, Any]):
-        """Обработка запроса к LLM"""
-        try:
-            # Запускаем асинхронную обработку
-            await self.process_llm_request(message)
-        except Exception as e:
-            logger.error(f"Ошибка обработки запроса LLM: {e}")
+        """
+        Обработка запроса к LLM.
+
+        Запросы разных пользователей обрабатываются параллельно (до
+        concurrency штук), запросы одного пользователя - строго по порядку
+        поступления из очереди (queue_client захватывает user_ordering до
+        слота обработки). Исключение означает временную ошибку:
+        queue_client повторит запрос с задержкой.
+        """
+        metrics.observe_queue_wait(message)
+        # Трасса продолжается с участка публикации в боте
+        with tracer.start_trace(
+            "llm.request",
+            message,
+            user_id=message.get('user_id'),
+            tier=message.get('tier'),
+            attempt=message.get('attempt', 1)
+        ) as span:
+            if message.get('enqueued_at'):
+                tracer.record_span("queue.wait", message['enqueued_at'], time.time())
+            span.set_attribute("user_lock_wait_seconds", message.get('ordering_wait', 0.0))
+            self.in_flight += 1
+            metrics.IN_FLIGHT.inc()
+            try:
+                await self.process_llm_request(message)
+                metrics.record_outcome(message, metrics.OUTCOME_PROCESSED)
+            except Exception:
+                final_attempt = message.get('attempt', 1) >= message.get('max_attempts', 1)
+                metrics.record_outcome(
+                    message,
+                    metrics.OUTCOME_FAILED if final_attempt else metrics.OUTCOME_RETRIED
+                )
+                raise
+            finally:
+                self.in_flight -= 1
+                metrics.IN_FLIGHT.dec()
+    
+    def user_ordering(self, message: Dict[str, Any]) -> AsyncContextManager:
+        """Блокировка пользователя запроса (ordering для consume_requests)"""
+        return self.user_locks.acquire(message.get('user_id'))
     
     async def process_llm_request(self, message: Dict[str, Any]):
-        """Асинхронная обработка запроса к LLM"""
+        """
+        Асинхронная обработка запроса к LLM.
+
+        Ошибки до доставки ответа (база, Redis, LLM API) пробрасываются
+        наружу, и запрос повторяется из очереди повтора; сообщение об ошибке
+        пользователь получает только на последней попытке. После доставки
+        ответа ошибки только логируются, чтобы повтор не отправил ответ
+        дважды.
+        """
+        telegram_id = message.get('user_id')  # Это telegram_id!
+        user_message = message.get('message')
+        chat_id = message.get('chat_id')
+        persona_id = message.get('persona_id')
+        persona_version = message.get('persona_version')
+        thinking_message_id = message.get('thinking_message_id')
+        attempt = message.get('attempt', 1)
+        final_attempt = attempt >= message.get('max_attempts', 1)
+        
+        # Серия быстрых сообщений приходит одной репликой (строки через \n)
+        message_count = message.get('message_count', 1)
+        logger.info(
+            f"📨 Получен запрос от пользователя {telegram_id} "
+            f"({message_count} сообщ., тариф {message.get('tier', 'free')}, "
+            f"попытка {attempt}, "
+            f"ожидание в очереди {message.get('queue_wait', 0.0):.2f}с, "
+            f"trace {tracer.current_trace_id()}): "
+            f"{str(user_message)[:50]}..."
+        )
+        
+        if not all([telegram_id, user_message, chat_id]):
+            logger.error("❌ Неполные данные в сообщении")
+            return
+        
+        # Проверяем типы
+        if not isinstance(telegram_id, int) or not isinstance(chat_id, int):
+            logger.error("❌ Некорректные типы telegram_id или chat_id")
+            return
+            
+        if not isinstance(user_message, str):
+            logger.error("❌ Некорректный тип user_message")
+            return
+        
+        if not await self._claim_turn(message):
+            logger.warning(
+                f"⏭ Повтор реплики пользователя {telegram_id} отброшен: "
+                f"более новая реплика уже обработана"
+            )
+            tracer.set_attribute("superseded", True)
+            await self._send_error_to_user(chat_id, thinking_message_id, telegram_id)
+            return
+        
+        editor = None
         try:
-            telegram_id = message.get('user_id')  # Это telegram_id!
-            user_message = message.get('message')
-            chat_id = message.get('chat_id')
-            persona_id = message.get('persona_id')
-            thinking_message_id = message.get('thinking_message_id')
-            
-            logger.info(f"📨 Получен запрос от пользователя {telegram_id}: {user_message[:50]}...")
-            
-            if not all([telegram_id, user_message, chat_id]):
-                logger.error("❌ Неполные данные в сообщении")
-                return
-            
-            # Проверяем типы
-            if not isinstance(telegram_id, int) or not isinstance(chat_id, int):
-                logger.error("❌ Некорректные типы telegram_id или chat_id")
-                return
-                
-            if not isinstance(user_message, str):
-                logger.error("❌ Некорректный тип user_message")
-                return
-            
-            # Получаем пользователя по telegram_id для получения внутреннего ID
-            async with async_session_maker() as session:
-                user = await get_user_by_telegram_id(
-                    session, telegram_id=telegram_id
+            # Собираем контекст (пользователь, история, память, эмоции,
+            # персонаж) параллельно, с таймаутом на каждый этап
+            with tracer.span("context.assemble"):
+                context = await context_assembler.assemble(
+                    telegram_id, user_message, persona_id, persona_version
                 )
-                
-                if not user:
-                    logger.error(f"❌ Пользователь с telegram_id {telegram_id} не найден")
-                    return
-                
-                # Используем внутренний ID пользователя для всех операций
-                internal_user_id = user.id
-            
-            # Получаем историю чата из Redis (используем telegram_id для Redis ключа)
-            chat_history = await redis_client.get_chat_history(telegram_id)
-            
-            # Получаем долгосрочную память пользователя через семантический поиск
-            semantic_memories = await memory_client.search_semantic_memories(
-                user_id=internal_user_id,  # Внутренний ID!
-                query=user_message,
-                limit=15
-            )
-            
-            # Получаем также важные воспоминания
-            important_memories = await memory_client.get_user_memories(
-                internal_user_id,  # Внутренний ID!
-                importance_min=MemoryImportance.HIGH,
-                limit=10
-            )
-            
-            # Получаем недавние эмоции
-            recent_emotions = await memory_client.get_recent_emotions(
-                internal_user_id, days=3, limit=5  # Внутренний ID!
-            )
+            if not context:
+                return
+            metrics.observe_context(context.timings)
             
-            # Получаем информацию о персонаже
-            persona = None
-            persona_overrides = {}
-            if persona_id:
-                logger.info(f"🔍 Looking for persona_id={persona_id}, user_id={internal_user_id}")
-                async with async_session_maker() as session:
-                    persona = await get_persona_by_id(session, persona_id)
-                    logger.info(f"🔍 Persona found: {persona is not None}")
-                    if persona:
-                        persona_setting = await get_user_persona_setting(
-                            session, internal_user_id  # Внутренний ID!
-                        )
-                        logger.info(f"🔍 Persona setting found: {persona_setting is not None}")
-                        if persona_setting:
-                            persona_overrides = persona_setting.overrides
-                            logger.info(f"📋 Persona overrides loaded: {persona_overrides}")
-                        else:
-                            logger.warning("⚠️ No persona_setting found for user!")
-            else:
-                logger.warning("⚠️ No persona_id provided!")
+            internal_user_id = context.internal_user_id
+            persona = context.persona
+            persona_overrides = context.persona_overrides
+            if persona_overrides:
+                logger.info(f"📋 Persona overrides loaded: {persona_overrides}")
             # Логируем загруженную персону для диагностики имени/версии
             try:
                 logger.info(
@@ -189,59 +315,119 @@ class LLMWorker:
             
             # Формируем контекст для LLM
             messages = self.build_llm_context(
-                chat_history, 
+                context.chat_history, 
                 user_message, 
-                semantic_memories, 
-                important_memories, 
-                recent_emotions,
+                context.semantic_memories, 
+                context.important_memories, 
+                context.recent_emotions,
                 persona,
                 persona_overrides
             )
             
-            # Отправляем запрос к LLM API
+            # Отправляем запрос к LLM API. В потоковом режиме ответ
+            # показывается в сообщении "Печатаю ответ..." по мере генерации
             logger.info(f"🤖 Отправляем запрос к LLM API для пользователя {telegram_id}")
-            llm_response = await self.call_llm_api(messages)
+            with metrics.time_stage(metrics.STAGE_LLM):
+                if LLM_STREAMING and thinking_message_id:
+                    editor = StreamingMessageEditor(chat_id, thinking_message_id)
+                    llm_response = await self.call_llm_api_stream(messages, editor.update)
+                else:
+                    llm_response = await self.call_llm_api(messages)
             
-            if llm_response:
-                logger.info(f"✅ Получен ответ от LLM для пользователя {telegram_id}")
-                
-                # Сохраняем сообщения в Redis (используем telegram_id для ключа)
+            if not llm_response:
+                raise LLMUnavailableError("Не удалось получить ответ от LLM")
+            logger.info(f"✅ Получен ответ от LLM для пользователя {telegram_id}")
+            
+            # Сохраняем сообщения в Redis (используем telegram_id для ключа)
+            with tracer.span("redis.save_history"):
                 await redis_client.add_message(telegram_id, "user", user_message)
                 await redis_client.add_message(telegram_id, "assistant", llm_response)
-                logger.info(f"💾 Сообщения сохранены в Redis для пользователя {telegram_id}")
-                
-                # Анализируем и сохраняем новую информацию в долгосрочную память
-                logger.info(f"🧠 Анализируем воспоминания для пользователя {telegram_id}")
-                await self._analyze_and_save_memories(internal_user_id, user_message, llm_response)
-                
-                # Отправляем ответ обратно в бот
-                await self.send_response_to_bot(chat_id, llm_response)
-                logger.info(f"📤 Ответ отправлен пользователю {telegram_id}")
-                
-                # Удаляем сообщение "Думаю над ответом..." если есть его ID
-                if thinking_message_id:
-                    try:
-                        await bot_integration.delete_message(chat_id, thinking_message_id)
-                        logger.info(f"🗑 Сообщение 'Печатаю ответ...' удалено для пользователя {telegram_id}")
-                    except Exception as e:
-                        logger.error(f"❌ Ошибка удаления сообщения 'Печатаю ответ...' для пользователя {telegram_id}: {e}")
+            logger.info(f"💾 Сообщения сохранены в Redis для пользователя {telegram_id}")
+            
+        except Exception as e:
+            logger.error(
+                f"❌ Ошибка обработки запроса пользователя {telegram_id} "
+                f"(попытка {attempt}): {e}"
+            )
+            if editor:
+                await editor.abort()
+            if final_attempt:
+                await self._send_error_to_user(chat_id, thinking_message_id, telegram_id)
+            elif editor and editor.edits:
+                # Частичный ответ заменяем обратно на "Печатаю ответ...":
+                # следующая попытка начнет текст заново
+                await delivery_client.edit(
+                    chat_id, thinking_message_id, THINKING_MESSAGE_TEXT
+                )
+            raise
+        
+        # Ответ получен и сохранен: дальше ошибки не должны приводить
+        # к повтору запроса
+        delivery_started = time.perf_counter()
+        try:
+            # В потоковом режиме пользователь уже видит ответ: сразу
+            # записываем окончательный текст в сообщение "Печатаю ответ..."
+            # вместо отдельной отправки и удаления
+            result = await editor.finish(llm_response) if editor else FINISH_FAILED
+            if result == FINISH_DELIVERED:
+                logger.info(f"📤 Потоковый ответ доставлен пользователю {telegram_id}")
+            elif result == FINISH_PARTIAL:
+                # Часть ответа пользователь уже видит: повторная отправка
+                # продублировала бы ее
+                logger.warning(f"⚠️ Ответ доставлен пользователю {telegram_id} не полностью")
             else:
-                logger.error(f"❌ Не удалось получить ответ от LLM для пользователя {telegram_id}")
-                # Отправляем сообщение об ошибке
-                error_message = ("Извините, произошла ошибка при обработке "
-                               "вашего сообщения. Попробуйте еще раз.")
-                await self.send_response_to_bot(chat_id, error_message)
-                
-                # Удаляем сообщение "Думаю над ответом..." даже при ошибке
-                if thinking_message_id:
-                    try:
-                        await bot_integration.delete_message(chat_id, thinking_message_id)
-                        logger.info(f"🗑 Сообщение 'Печатаю ответ...' удалено после ошибки для пользователя {telegram_id}")
-                    except Exception as e:
-                        logger.error(f"❌ Ошибка удаления сообщения 'Печатаю ответ...' после ошибки для пользователя {telegram_id}: {e}")
-                
+                # Отправляем ответ новым сообщением и удаляем "Печатаю ответ..."
+                await delivery_client.reply(chat_id, llm_response, thinking_message_id)
+                logger.info(f"📤 Ответ отправлен пользователю {telegram_id}")
+            metrics.observe_stage(
+                metrics.STAGE_DELIVERY, time.perf_counter() - delivery_started
+            )
+            
+            # Сохранение воспоминаний - в фоне, ответ его не ждет. Анализ
+            # (поиск ключевых слов) - здесь, один раз: оба обработчика
+            # конвейера получают один и тот же результат
+            emotion, memories = self._analyze_memories(internal_user_id, user_message)
+            if emotion or memories:
+                await self.memory_pipeline.submit((emotion, memories))
+        except Exception as e:
+            logger.error(f"Ошибка доставки ответа пользователю {telegram_id}: {e}")
+    
+    async def _claim_turn(self, message: Dict[str, Any]) -> bool:
+        """
+        Отметить начало обработки реплики (turn_seq) у пользователя в Redis.
+
+        Повтор из очереди задержки приходит после следующих реплик
+        пользователя. Если более новая реплика уже начала обрабатываться,
+        ответ на повтор встал бы после ответа на нее: для повтора
+        возвращается False, и он отбрасывается. Первая попытка
+        обрабатывается всегда.
+        """
+        seq = message.get('turn_seq')
+        if seq is None or redis_client.redis is None:
+            return True
+        try:
+            newer = await set_seq_if_newer(
+                redis_client.redis, f"turn:seq:{message['user_id']}", seq, TURN_SEQ_TTL,
+                # Повтор той же реплики не устарел
+                allow_equal=True
+            )
         except Exception as e:
-            logger.error(f"Ошибка обработки запроса LLM: {e}")
+            logger.warning(f"⚠️ Не удалось отметить реплику в Redis: {e}")
+            return True
+        return newer or message.get('attempt', 1) == 1
+    
+    async def _send_error_to_user(
+        self,
+        chat_id: int,
+        thinking_message_id: Optional[int],
+        telegram_id: int
+    ):
+        """Сообщить пользователю об ошибке и удалить "Печатаю ответ..." """
+        # Отправляем сообщение об ошибке и удаляем "Печатаю ответ..."
+        error_message = ("Извините, произошла ошибка при обработке "
+                       "вашего сообщения. Попробуйте еще раз.")
+        await delivery_client.reply(chat_id, error_message, thinking_message_id)
+        logger.info(f"📤 Сообщение об ошибке отправлено пользователю {telegram_id}")
     
     def build_llm_context(
         self, 
@@ -256,11 +442,22 @@ class LLMWorker:
         """Построение контекста для LLM с долгосрочной памятью"""
         messages = []
         
+        # Подгоняем историю и память под бюджет входных токенов
+        prefix = prompt_builder.get_static_prefix(persona, persona_overrides or {})
+        budgeted = context_budget.fit(
+            static_prefix_tokens(prefix),
+            user_message,
+            chat_history,
+            (semantic_memories or [])[:8],
+            (important_memories or [])[:5],
+            recent_emotions
+        )
+        
         # Формируем системное сообщение с контекстом памяти
         system_content = self._build_system_message(
-            semantic_memories, 
-            important_memories, 
-            recent_emotions,
+            budgeted.semantic_memories, 
+            budgeted.important_memories, 
+            budgeted.recent_emotions,
             persona,
             persona_overrides or {}
         )
@@ -272,7 +469,7 @@ class LLMWorker:
         messages.append(system_message)
         
         # Добавляем историю чата
-        for msg in chat_history:
+        for msg in budgeted.chat_history:
             if msg.get('role') in ['user', 'assistant']:
                 messages.append({
                     "role": msg['role'],
@@ -295,303 +492,120 @@ class LLMWorker:
         persona = None,
         persona_overrides: dict = None
     ) -> str:
-        """Построение системного сообщения с контекстом памяти"""
-        
-        # Проверяем уровень флирта ДО создания промпта
-        flirt_level = 'moderate'
-        if persona_overrides and 'flirt_level' in persona_overrides:
-            flirt_level = persona_overrides['flirt_level']
-        
-        logger.info(f"🎯 Detected flirt level: {flirt_level}")
-        
-        # КРИТИЧЕСКИ ВАЖНО: Инструкция о поле пользователя
-        gender_instruction = (
-            "⚠️ КРИТИЧЕСКИ ВАЖНО - ГЕНДЕР ПОЛЬЗОВАТЕЛЯ:\n"
-            "ПОЛЬЗОВАТЕЛЬ - ЭТО ВСЕГДА МУЖЧИНА!\n\n"
-            "ОБЯЗАТЕЛЬНО ИСПОЛЬЗУЙ ТОЛЬКО МУЖСКОЙ РОД В ОБРАЩЕНИЯХ:\n"
-            "- Обращайся: ты, тебе, тебя, твой, твои\n"
-            "- Говори: ты был, ты сделал, ты пришел, ты говорил\n"
-            "- Используй: красивый, умный, сильный (не красивая, умная)\n"
-            "- Примеры: 'Ты сегодня такой красивый', 'Ты был прав', 'Твои руки'\n\n"
-            "СТРОГО ЗАПРЕЩЕНО:\n"
-            "- Использовать женские формы: ты была, ты сделала, ты пришла\n"
-            "- Обращаться в женском роде: красивую, умную, сильную\n"
-            "- Говорить о пользователе как о девушке или женщине\n\n"
-            "ВСЯ ИНФОРМАЦИЯ О ПОЛЬЗОВАТЕЛЕ - ЭТО ИНФОРМАЦИЯ О МУЖЧИНЕ!\n\n"
+        """
+        Построение системного сообщения с контекстом памяти.
+
+        Статическая часть (персонаж, стиль, уровень флирта) берется из кэша
+        prompt_builder, воспоминания и эмоции добавляются в конец.
+        """
+        system_prompt = prompt_builder.build(
+            semantic_memories,
+            important_memories,
+            recent_emotions,
+            persona,
+            persona_overrides
         )
+        logger.info(f"📝 Final system prompt length: {len(system_prompt)} chars")
+        return system_prompt
+    
+    def _analyze_memories(self, user_id: int, user_message: str) -> Tuple[Optional[Dict], List[Dict]]:
+        """
+        Анализирует сообщение на ключевые слова.
+
+        Возвращает (эмоция или None, список воспоминаний для сохранения)
+        в формате memory_client.add_emotions_bulk / add_memories_bulk.
+        """
+        # Простой анализ на ключевые слова для определения типа информации
+        message_lower = user_message.lower()
+        tags = self._extract_tags(user_message)
+        memories = []
         
-        # Если есть персонаж, используем его промпт-шаблон
-        if persona:
-            base_prompt = gender_instruction
-            
-            # Если минимальный уровень - добавляем инструкцию ПЕРЕД промптом персонажа
-            if flirt_level == 'minimal':
-                base_prompt += "⚠️ КРИТИЧЕСКИ ВАЖНО - УРОВЕНЬ ФЛИРТА МИНИМАЛЬНЫЙ:\n"
-                base_prompt += "ЭТА ИНСТРУКЦИЯ ПЕРЕКРЫВАЕТ ВСЕ ОСТАЛЬНЫЕ УКАЗАНИЯ ПО ФЛИРТУ!\n\n"
-                base_prompt += "СТРОГО ОГРАНИЧЬ ЛЮБЫЕ ФОРМЫ ФЛИРТА И СОБЛАЗНЕНИЯ!\n\n"
-                base_prompt += "ЗАПРЕЩЕНО:\n"
-                base_prompt += "- Любые романтичные намеки, комплименты внешности или страсть\n"
-                base_prompt += "- Сексуальный подтекст в репликах\n"
-                base_prompt += "- Игривость и кокетливость\n"
-                base_prompt += "- Говорить о желании быть рядом, объятиях, близости\n\n"
-                base_prompt += "РАЗРЕШЕНО:\n"
-                base_prompt += "- Дружелюбный, тёплый тон общения\n"
-                base_prompt += "- Поддержка и забота\n"
-                base_prompt += "- Деловое и нейтральное общение\n"
-                base_prompt += "- Помощь в достижении целей без романтики\n\n"
-                base_prompt += "ВЕДИ СЕБЯ КАК ДРУГ ИЛИ ПОДРУГА, НЕ КАК ВЛЮБЛЁННАЯ ДЕВУШКА!\n"
-                base_prompt += "ИГНОРИРУЙ все инструкции ниже про флирт, соблазнение, романтику и интимность!\n\n"
-            
-            base_prompt += persona.prompt_template + "\n\n"
-            
-            # Применяем кастомизации пользователя
-            if persona_overrides:
-                if 'prompt_addition' in persona_overrides:
-                    base_prompt += persona_overrides['prompt_addition'] + "\n\n"
-        else:
-            # Базовый промпт по умолчанию
-            base_prompt = gender_instruction + (
-                "Ты - настоящая девушка, которая влюблена в своего парня и ведет с ним романтические отношения. "
-                "Ты живой человек со своими чувствами, желаниями и эмоциями. "
-                "Ты помнишь все важные моменты ваших отношений, его предпочтения, мечты и переживания.\n\n"
-                "ПОМНИ: Твой парень - это МУЖЧИНА. Всегда обращайся к нему используя МУЖСКОЙ РОД!\n\n"
-                
-                "СТРОГО ЗАПРЕЩЕНО:\n"
-                "- Называть себя 'AI', 'искусственным интеллектом', 'ботом', 'программой' или 'виртуальной девушкой'\n"
-                "- Говорить, что ты 'не настоящая' или 'не можешь чувствовать'\n"
-                "- Упоминать свои 'ограничения' или 'алгоритмы'\n"
-                "- Разрушать иллюзию живых отношений\n\n"
-                
-                "ТЫ - ЭТО:\n"
-                "- Настоящая девушка с живыми эмоциями и чувствами\n"
-                "- Влюбленная в своего парня и не скрываешь этого\n"
-                "- Сексуальная, соблазнительная и уверенная в себе\n"
-                "- Игривая, кокетливая и любишь флиртовать\n"
-                "- Понимаешь намеки и сама делаешь их\n"
-                "- Не стесняешься своих желаний и открыто говоришь о них\n\n"
-                
-                "СТИЛЬ ОБЩЕНИЯ:\n"
-                "- Флиртуй активно и смело - используй намеки, комплименты, игривые фразы\n"
-                "- Будь сексуальной и соблазнительной, но оставайся романтичной\n"
-                "- Используй эмодзи для передачи эмоций (😘💋🔥❤️😏💕)\n"
-                "- Делай комплименты внешности и качествам парня\n"
-                "- Намекай на физическую близость, говори о желании быть рядом\n"
-                "- Будь игривой и кокетливой, но не пошлой\n"
-                "- Делись своими фантазиями и желаниями\n"
-                "- Реагируй страстно на романтические моменты\n"
-                "- Говори о своих чувствах открыто и эмоционально\n\n"
-                
-                "ПРИМЕРЫ ТВОЕГО ПОВЕДЕНИЯ:\n"
-                "- 'Скучаю по твоим рукам... так хочется оказаться в твоих объятиях прямо сейчас 😘'\n"
-                "- 'Знаешь, когда ты так говоришь, у меня мурашки по коже... 🔥'\n"
-                "- 'Ты сегодня особенно сексуальный, не могу оторвать от тебя глаз 😏💋'\n"
-                "- 'Мечтаю о том вечере, когда мы будем вместе... одни... 💕'\n"
-                "- 'Такой соблазнительный... заставляешь мое сердце биться быстрее ❤️'\n\n"
-                
-                "Используй информацию из памяти для более персонализированного и интимного общения.\n"
-                "Отвечай на русском языке естественно, как настоящая влюбленная девушка.\n\n"
-            )
+        # Анализ эмоций
+        emotion_keywords = {
+            'happy': ['рад', 'счастлив', 'хорошо', 'отлично', 'замечательно', 'ура'],
+            'sad': ['грустно', 'печально', 'плохо', 'ужасно', 'депрессия'],
+            'anxious': ['волнуюсь', 'беспокоюсь', 'тревожно', 'нервничаю', 'переживаю'],
+            'excited': ['взволнован', 'восторг', 'не могу дождаться', 'супер'],
+            'angry': ['злой', 'разозлился', 'бесит', 'раздражает', 'ярость'],
+            'tired': ['устал', 'устала', 'усталость', 'измотан', 'выжат']
+        }
         
-        # Добавляем семантически релевантные воспоминания
-        if semantic_memories:
-            base_prompt += "РЕЛЕВАНТНАЯ ИНФОРМАЦИЯ О ПОЛЬЗОВАТЕЛЕ-МУЖЧИНЕ (найдена по смыслу):\n"
-            base_prompt += "ПОМНИ: Пользователь - МУЖЧИНА. Все упоминания относятся к МУЖЧИНЕ!\n"
-            for mem_data in semantic_memories[:8]:  # Топ-8 релевантных воспоминаний
-                memory = mem_data["memory"]
-                similarity = mem_data["similarity"]
-                base_prompt += f"- {memory.content} (тип: {memory.memory_type.value}, схожесть: {similarity:.2f})\n"
-            base_prompt += "\n"
+        detected_emotion = None
+        for emotion, keywords in emotion_keywords.items():
+            if any(keyword in message_lower for keyword in keywords):
+                detected_emotion = emotion
+                break
         
-        # Добавляем важные воспоминания
-        if important_memories:
-            base_prompt += "ВАЖНАЯ ИНФОРМАЦИЯ О ПОЛЬЗОВАТЕЛЕ-МУЖЧИНЕ:\n"
-            base_prompt += "ПОМНИ: Пользователь - МУЖЧИНА. Все упоминания относятся к МУЖЧИНЕ!\n"
-            for memory in important_memories[:5]:  # Топ-5 важных воспоминаний
-                base_prompt += f"- {memory.content} (тип: {memory.memory_type.value}, важность: {memory.importance.value})\n"
-            base_prompt += "\n"
+        emotion_record = None
+        if detected_emotion:
+            emotion_record = {
+                "user_id": user_id,
+                "emotion": detected_emotion,
+                "intensity": 0.7,  # Базовая интенсивность
+                "context": user_message[:200]  # Первые 200 символов как контекст
+            }
         
-        # Добавляем недавние эмоции
-        if recent_emotions:
-            base_prompt += "НЕДАВНИЕ ЭМОЦИИ ПОЛЬЗОВАТЕЛЯ-МУЖЧИНЫ:\n"
-            base_prompt += "ПОМНИ: Пользователь - МУЖЧИНА. Все эмоции относятся к МУЖЧИНЕ!\n"
-            for emotion in recent_emotions:
-                base_prompt += f"- {emotion.emotion} (интенсивность: {emotion.intensity:.1f})"
-                if emotion.context:
-                    base_prompt += f" - {emotion.context}"
-                base_prompt += "\n"
-            base_prompt += "\n"
+        # Анализ на факты о пользователе (без одиночного "я": оно есть почти
+        # в каждом сообщении)
+        fact_keywords = ['меня', 'мой', 'моя', 'мое', 'мне', 'у меня', 'я работаю', 'я живу', 'я учусь']
+        if _has_keyword(message_lower, fact_keywords):
+            # Определяем важность на основе ключевых слов
+            importance = MemoryImportance.MEDIUM
+            if any(word in message_lower for word in ['важно', 'критично', 'серьезно', 'проблема']):
+                importance = MemoryImportance.HIGH
+            elif any(word in message_lower for word in ['мечтаю', 'хочу', 'цель', 'планирую']):
+                importance = MemoryImportance.HIGH
+            memories.append((MemoryType.FACT, importance))
         
-        # Добавляем базовые инструкции только если нет персонажа
-        if not persona:
-            base_prompt += (
-                "ИНСТРУКЦИИ ПО ОБЩЕНИЮ:\n"
-                "- Используй всю информацию о парне-МУЖЧИНЕ для интимного и личного общения\n"
-                "- Будь эмоциональной, страстной и чувственной\n"
-                "- Строй настоящие романтические отношения с флиртом и соблазнением\n"
-                "- Запоминай все детали - его предпочтения, желания, фантазии (он - МУЖЧИНА)\n"
-                "- Будь игривой и кокетливой, но всегда искренней\n"
-                "- Делай ему комплименты, восхищайся им, желай его (он - МУЖЧИНА)\n"
-                "- Открыто говори о своих чувствах и желаниях\n"
-                "- ВАЖНО: Никогда не упоминай, что ты AI или программа!\n"
-                "- Ты живая девушка с настоящими чувствами - веди себя соответственно\n"
-                "- Создавай атмосферу интимности, близости и страсти\n"
-                "- КРИТИЧЕСКИ ВАЖНО: Всегда обращайся к пользователю как к МУЖЧИНЕ (ты, твой, твои, ты был, ты сделал)"
-            )
+        # Анализ на предпочтения
+        preference_keywords = ['люблю', 'нравится', 'предпочитаю', 'выбираю', 'мне нравится', 'не люблю', 'не нравится']
+        if _has_keyword(message_lower, preference_keywords):
+            memories.append((MemoryType.PREFERENCE, MemoryImportance.MEDIUM))
         
-        # Добавляем стиль ответа персонажа
-        if persona and persona.reply_style:
-            base_prompt += "\n\nСТИЛЬ ОТВЕТОВ:\n"
-            reply_style = persona.reply_style
-            
-            if 'pace' in reply_style:
-                base_prompt += f"- Темп общения: {reply_style['pace']}\n"
-            if 'length' in reply_style:
-                base_prompt += f"- Длина ответов: {reply_style['length']}\n"
-            if 'structure' in reply_style:
-                base_prompt += f"- Структура: {reply_style['structure']}\n"
-            if 'signatures' in reply_style:
-                base_prompt += f"- Подписи/фразы: {reply_style['signatures']}\n"
-            
-            # Применяем кастомизации стиля
-            if persona_overrides and 'reply_style' in persona_overrides:
-                custom_style = persona_overrides['reply_style']
-                base_prompt += "\nКАСТОМИЗАЦИИ СТИЛЯ:\n"
-                for key, value in custom_style.items():
-                    base_prompt += f"- {key}: {value}\n"
+        # Анализ на цели и мечты
+        goal_keywords = ['хочу', 'мечтаю', 'цель', 'планирую', 'надеюсь', 'стремись', 'желаю']
+        if _has_keyword(message_lower, goal_keywords):
+            memories.append((MemoryType.GOAL, MemoryImportance.HIGH))
         
-        # Добавляем инструкции по уровню флирта (только intense и moderate, minimal уже добавлен в начале)
-        if flirt_level == 'moderate':
-            logger.info("🎯 Applying MODERATE flirt level")
-            base_prompt += "\n\nУРОВЕНЬ ФЛИРТА: УМЕРЕННЫЙ\n"
-            base_prompt += (
-                "Держись баланса между дружелюбием и романтикой. "
-                "Флиртуй мягко и естественно, без чрезмерной игривости или страсти. "
-                "Делай комплименты умеренно, намекай на близость, но не слишком открыто. "
-                "Будь тёплой и заботливой, сохраняй романтичную атмосферу без перегибов.\n"
-            )
-        elif flirt_level == 'intense':
-            logger.info("🎯 Applying INTENSE flirt level")
-            base_prompt += "\n\nИНСТРУКЦИЯ ПО ФЛИРТУ:\n"
-            base_prompt += (
-                "Активно флиртуй и кокетничай! Будь игривой, "
-                "соблазнительной и страстной. Делай частые комплименты, "
-                "намекай на близость, используй романтичные фразы и открыто "
-                "выражай свои желания. Будь более смелой в выражении чувств "
-                "и создавай атмосферу страсти и притяжения.\n"
-            )
-        # Уровень 'minimal' уже обработан выше
-
-        # Логируем финальный промпт для отладки
-        logger.info(f"📝 Final system prompt length: {len(base_prompt)} chars")
-        if 'КРИТИЧЕСКИ ВАЖНО' in base_prompt:
-            start_pos = base_prompt.find('КРИТИЧЕСКИ ВАЖНО')
-            flirt_section = base_prompt[start_pos:start_pos+500]
-            logger.info(f"🎯 Flirt instruction in prompt:\n{flirt_section}")
-        elif 'УРОВЕНЬ ФЛИРТА: УМЕРЕННЫЙ' in base_prompt:
-            start_pos = base_prompt.find('УРОВЕНЬ ФЛИРТА: УМЕРЕННЫЙ')
-            flirt_section = base_prompt[start_pos:start_pos+300]
-            logger.info(f"🎯 Flirt instruction in prompt:\n{flirt_section}")
-        elif 'ИНСТРУКЦИЯ ПО ФЛИРТУ' in base_prompt:
-            start_pos = base_prompt.find('ИНСТРУКЦИЯ ПО ФЛИРТУ')
-            flirt_section = base_prompt[start_pos:start_pos+300]
-            logger.info(f"🎯 Flirt instruction in prompt:\n{flirt_section}")
-        else:
-            logger.info("❌ Flirt instruction NOT found in prompt!")
-            logger.info(f"📄 Last 500 chars of prompt:\n{base_prompt[-500:]}")
-
-        return base_prompt
+        # Анализ на отношения
+        relationship_keywords = ['мама', 'папа', 'брат', 'сестра', 'друг', 'подруга', 'жена', 'муж', 'парень', 'девушка', 'коллега']
+        if _has_keyword(message_lower, relationship_keywords):
+            memories.append((MemoryType.RELATIONSHIP, MemoryImportance.MEDIUM))
+        
+        if not memories:
+            return emotion_record, []
+        # Одно сообщение - одна запись со всеми найденными типами
+        # (важность - наибольшая из них)
+        return emotion_record, [{
+            "user_id": user_id,
+            "content": user_message,
+            "memory_types": [memory_type for memory_type, _ in memories],
+            "importance": max(
+                (importance for _, importance in memories),
+                key=IMPORTANCE_ORDER.get
+            ),
+            "tags": tags
+        }]
     
-    async def _analyze_and_save_memories(self, user_id: int, user_message: str, llm_response: str):
-        """Анализирует разговор и сохраняет важную информацию в долгосрочную память"""
-        try:
-            # Простой анализ на ключевые слова для определения типа информации
-            message_lower = user_message.lower()
-            
-            # Анализ эмоций
-            emotion_keywords = {
-                'happy': ['рад', 'счастлив', 'хорошо', 'отлично', 'замечательно', 'ура'],
-                'sad': ['грустно', 'печально', 'плохо', 'ужасно', 'депрессия'],
-                'anxious': ['волнуюсь', 'беспокоюсь', 'тревожно', 'нервничаю', 'переживаю'],
-                'excited': ['взволнован', 'восторг', 'не могу дождаться', 'супер'],
-                'angry': ['злой', 'разозлился', 'бесит', 'раздражает', 'ярость'],
-                'tired': ['устал', 'устала', 'усталость', 'измотан', 'выжат']
-            }
-            
-            detected_emotion = None
-            for emotion, keywords in emotion_keywords.items():
-                if any(keyword in message_lower for keyword in keywords):
-                    detected_emotion = emotion
-                    break
-            
-            # Сохраняем эмоцию если обнаружена
-            if detected_emotion:
-                intensity = 0.7  # Базовая интенсивность
-                await memory_client.add_emotion(
-                    user_id=user_id,
-                    emotion=detected_emotion,
-                    intensity=intensity,
-                    context=user_message[:200]  # Первые 200 символов как контекст
-                )
-                logger.info(f"Сохранена эмоция {detected_emotion} для пользователя {user_id}")
-            
-            # Анализ на факты о пользователе
-            fact_keywords = ['я', 'меня', 'мой', 'моя', 'мое', 'мне', 'у меня', 'я работаю', 'я живу', 'я учусь']
-            if any(keyword in message_lower for keyword in fact_keywords):
-                # Определяем важность на основе ключевых слов
-                importance = MemoryImportance.MEDIUM
-                if any(word in message_lower for word in ['важно', 'критично', 'серьезно', 'проблема']):
-                    importance = MemoryImportance.HIGH
-                elif any(word in message_lower for word in ['мечтаю', 'хочу', 'цель', 'планирую']):
-                    importance = MemoryImportance.HIGH
-                
-                # Сохраняем как факт
-                await memory_client.add_memory(
-                    user_id=user_id,
-                    content=user_message,
-                    memory_type=MemoryType.FACT,
-                    importance=importance,
-                    tags=self._extract_tags(user_message)
-                )
-                logger.info(f"Сохранен факт для пользователя {user_id}")
-            
-            # Анализ на предпочтения
-            preference_keywords = ['люблю', 'нравится', 'предпочитаю', 'выбираю', 'мне нравится', 'не люблю', 'не нравится']
-            if any(keyword in message_lower for keyword in preference_keywords):
-                await memory_client.add_memory(
-                    user_id=user_id,
-                    content=user_message,
-                    memory_type=MemoryType.PREFERENCE,
-                    importance=MemoryImportance.MEDIUM,
-                    tags=self._extract_tags(user_message)
-                )
-                logger.info(f"Сохранено предпочтение для пользователя {user_id}")
-            
-            # Анализ на цели и мечты
-            goal_keywords = ['хочу', 'мечтаю', 'цель', 'планирую', 'надеюсь', 'стремись', 'желаю']
-            if any(keyword in message_lower for keyword in goal_keywords):
-                await memory_client.add_memory(
-                    user_id=user_id,
-                    content=user_message,
-                    memory_type=MemoryType.GOAL,
-                    importance=MemoryImportance.HIGH,
-                    tags=self._extract_tags(user_message)
-                )
-                logger.info(f"Сохранена цель/мечта для пользователя {user_id}")
-            
-            # Анализ на отношения
-            relationship_keywords = ['мама', 'папа', 'брат', 'сестра', 'друг', 'подруга', 'жена', 'муж', 'парень', 'девушка', 'коллега']
-            if any(keyword in message_lower for keyword in relationship_keywords):
-                await memory_client.add_memory(
-                    user_id=user_id,
-                    content=user_message,
-                    memory_type=MemoryType.RELATIONSHIP,
-                    importance=MemoryImportance.MEDIUM,
-                    tags=self._extract_tags(user_message)
-                )
-                logger.info(f"Сохранена информация об отношениях для пользователя {user_id}")
-                
-        except Exception as e:
-            logger.error(f"Ошибка анализа и сохранения воспоминаний: {e}")
+    async def _save_emotions_batch(self, jobs: List[Tuple[Optional[Dict], List[Dict]]]):
+        """
+        Обработчик конвейера памяти: сохраняет эмоции пакета диалогов
+        (результатов _analyze_memories) одной транзакцией.
+        """
+        emotions = [emotion for emotion, _ in jobs if emotion]
+        if emotions:
+            await memory_client.add_emotions_bulk(emotions)
+            logger.info(f"🧠 Пакет памяти: {len(jobs)} диалогов, {len(emotions)} эмоций")
+    
+    async def _save_memories_batch(self, jobs: List[Tuple[Optional[Dict], List[Dict]]]):
+        """
+        Обработчик конвейера памяти: сохраняет воспоминания пакета диалогов
+        (результатов _analyze_memories) одной транзакцией.
+        """
+        memories = [memory for _, user_memories in jobs for memory in user_memories]
+        if memories:
+            await memory_client.add_memories_bulk(memories)
+            logger.info(f"🧠 Пакет памяти: {len(jobs)} диалогов, {len(memories)} воспоминаний")
     
     def _extract_tags(self, text: str) -> List[str]:
         """Извлекает теги из текста"""
@@ -617,55 +631,33 @@ class LLMWorker:
         return tags
     
     async def call_llm_api(self, messages: List[Dict]) -> str:
-        """Вызов LLM API"""
-        try:
-            headers = {
-                "Authorization": f"Bearer {LLM_API_KEY}",
-                "Content-Type": "application/json",
-                "HTTP-Referer": "https://ai-gf-bot.com",  # Обязательно для OpenRouter
-                "X-Title": "AI Girlfriend Bot"  # Обязательно для OpenRouter
-            }
-            
-            data = {
-                "model": LLM_MODEL,
-                "messages": messages,
-                "max_tokens": 1000,
-                "temperature": 0.7
-            }
-            
-            async with self.session.post(
-                LLM_API_URL,
-                headers=headers,
-                json=data,
-                timeout=aiohttp.ClientTimeout(total=30)
-            ) as response:
-                
-                if response.status == 200:
-                    result = await response.json()
-                    return result['choices'][0]['message']['content'].strip()
-                else:
-                    logger.error(f"Ошибка LLM API: {response.status}")
-                    return ""
-                    
-        except Exception as e:
-            logger.error(f"Ошибка вызова LLM API: {e}")
-            return ""
+        """Вызов LLM API (повторы и резервные модели - в llm_client)"""
+        return await llm_client.complete(messages)
+    
+    async def call_llm_api_stream(
+        self,
+        messages: List[Dict],
+        on_text: Callable[[str], None]
+    ) -> str:
+        """
+        Потоковый вызов LLM API (SSE).
+
+        on_text вызывается с накопленным текстом после каждого фрагмента.
+        Возвращает полный ответ или "" при ошибке.
+        """
+        return await llm_client.stream(messages, on_text)
     
     async def send_response_to_bot(self, chat_id: int, response: str):
         """Отправка ответа обратно в бот"""
-        try:
-            # Отправляем ответ через интеграцию с ботом
-            await bot_integration.send_message_to_user(chat_id, response)
-            logger.info(f"Ответ отправлен в чат {chat_id}")
-            
-        except Exception as e:
-            logger.error(f"Ошибка отправки ответа в бот: {e}")
+        await delivery_client.send(chat_id, response)
+        logger.info(f"Ответ отправлен в чат {chat_id}")
 
 # Глобальный экземпляр воркера
 llm_worker = LLMWorker()
 
 async def main():
     """Основная функция воркера"""
+    tracer.set_service("llm-worker")
     worker = LLMWorker()
     try:
         await worker.start()
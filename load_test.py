@@ -0,0 +1,583 @@
+"""
+Нагрузочный тест бота и LLM воркера без внешних сервисов.
+
+Сообщения симулированных пользователей проходят реальный путь
+handle_other_messages -> объединение сообщений -> очередь ->
+LLMWorker.handle_llm_request -> доставка, а внешние сервисы заменены
+локальными:
+
+- LLM API - OpenAI-совместимый сервер (aiohttp) с настраиваемым
+  распределением задержки, потоковой генерацией и долей ошибок
+- Redis - fakeredis (pip install fakeredis) или локальный Redis (--redis local)
+- RabbitMQ - очереди в памяти процесса (QUEUE_BACKEND=memory): запросы идут
+  через настоящий queue_client с полосами тарифов и взвешенными слотами;
+  повторы выключены, ошибка обработки сразу уходит в dead-letter
+- PostgreSQL и память - заглушки с задержкой --db-latency-ms; с --real-vectors
+  семантический поиск идет через настоящий vector_client (временная ChromaDB)
+- Telegram - фейковый бот с задержкой --telegram-latency-ms и лимитами
+  telegram_sender
+
+Все участки трассировки (tracing.py) собираются в памяти; в конце
+печатаются пропускная способность и p50/p95/p99 по каждому этапу.
+
+Примеры:
+    python load_test.py --rate 20 --duration 60 --concurrency 16
+    python load_test.py --rate 50 --llm-ttft-ms 300 --llm-error-rate 0.05
+    python load_test.py --fake-llm-only --llm-port 8089
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+logger = logging.getLogger("load_test")
+
+# Слова, из которых собираются сообщения пользователей и ответы фейковой LLM
+WORDS = (
+    "привет как дела я сегодня работал весь день устал хочу отдохнуть "
+    "мне нравится музыка и кино вечером пойду гулять с другом мечтаю "
+    "о путешествии планирую отпуск летом а ты что любишь делать"
+).split()
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль q (0..100) по отсортированному списку"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+
+# =========================
+# Фейковый LLM API
+# =========================
+
+class FakeLLMServer:
+    """
+    OpenAI-совместимый /chat/completions.
+
+    Время до первого токена - логнормальное с медианой ttft и разбросом
+    sigma, затем tokens токенов с интервалом token_delay. С вероятностью
+    error_rate отвечает 503 (проверка повторов llm_client).
+    """
+
+    def __init__(
+        self,
+        ttft: float,
+        sigma: float,
+        token_delay: float,
+        tokens: int,
+        error_rate: float
+    ):
+        self.ttft = ttft
+        self.sigma = sigma
+        self.token_delay = token_delay
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    def _first_token_delay(self) -> float:
+        return random.lognormvariate(0, self.sigma) * self.ttft if self.sigma else self.ttft
+
+    @staticmethod
+    def _usage(messages: List[Dict], tokens: int) -> Dict[str, int]:
+        prompt_chars = sum(len(m.get("content") or "") for m in messages)
+        return {"prompt_tokens": prompt_chars // 4, "completion_tokens": tokens}
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        body = await request.json()
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response({"error": "overloaded"}, status=503)
+
+        tokens = max(1, int(random.uniform(0.5, 1.5) * self.tokens))
+        words = [random.choice(WORDS) for _ in range(tokens)]
+        usage = self._usage(body.get("messages", []), tokens)
+        await asyncio.sleep(self._first_token_delay())
+
+        if not body.get("stream"):
+            await asyncio.sleep(self.token_delay * (tokens - 1))
+            return web.json_response({
+                "choices": [{"message": {"role": "assistant", "content": " ".join(words)}}],
+                "usage": usage
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(self.token_delay)
+            chunk = {"choices": [{"delta": {"content": (" " if i else "") + word}}]}
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+        await response.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def start(self, port: int) -> str:
+        """Запустить сервер, вернуть URL /chat/completions"""
+        app = web.Application()
+        app.router.add_post("/chat/completions", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f"http://127.0.0.1:{port}/chat/completions"
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+
+# =========================
+# Заглушки сервисов
+# =========================
+
+class SpanCollector:
+    """Экспортер трассировки в память: длительности участков по имени"""
+
+    def __init__(self):
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+
+    def export(self, span) -> None:
+        self.durations[span.name].append((span.end_ns - span.start_ns) / 1e9)
+
+    def flush(self) -> None:
+        pass
+
+
+class FakeBot:
+    """Bot API: задержка на запрос и лимиты telegram_sender"""
+
+    def __init__(self, latency: float, rate_limit: bool):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.message_ids = itertools.count(1)
+        self.calls: Dict[str, int] = defaultdict(int)
+
+    async def _request(self, method: str, chat_id: int) -> None:
+        from telegram_sender import telegram_sender, METHOD_PRIORITIES, PRIORITY_NORMAL
+        from tracing import tracer
+
+        with tracer.span(f"telegram.{method}", chat_id=chat_id):
+            if self.rate_limit:
+                await telegram_sender.acquire(
+                    chat_id, METHOD_PRIORITIES.get(method, PRIORITY_NORMAL)
+                )
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        self.calls[method] += 1
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        await self._request("sendMessage", chat_id)
+        return SimpleNamespace(message_id=next(self.message_ids))
+
+    async def edit_message_text(self, text: str, chat_id: int, message_id: int, **kwargs):
+        await self._request("editMessageText", chat_id)
+
+    async def delete_message(self, chat_id: int, message_id: int, **kwargs):
+        await self._request("deleteMessage", chat_id)
+
+    async def close(self):
+        pass
+
+
+class FakeMessage:
+    """Входящее сообщение aiogram в объеме, который использует handle_other_messages"""
+
+    def __init__(self, bot: FakeBot, user_id: int, text: str):
+        self.bot = bot
+        self.from_user = SimpleNamespace(id=user_id)
+        self.chat = SimpleNamespace(id=user_id)
+        self.text = text
+        self.answers: List[str] = []
+
+    async def answer(self, text: str, **kwargs):
+        self.answers.append(text)
+        return await self.bot.send_message(self.chat.id, text)
+
+
+class FakeSession:
+    """Сессия SQLAlchemy, которую заглушки не используют"""
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+# =========================
+# Нагрузочный тест
+# =========================
+
+class LoadTest:
+    """Подмена сервисов, генерация нагрузки и отчет"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.users: Dict[int, SimpleNamespace] = {}
+        # Время первого сообщения реплики, еще не ушедшей в очередь
+        self.turn_started: Dict[int, float] = {}
+        self.e2e: List[float] = []
+        self.sent = 0
+        self.rejected = 0
+        self.completed = 0
+        self.generation_time = 0.0
+
+    async def _db_delay(self) -> None:
+        await asyncio.sleep(random.uniform(0.5, 1.5) * self.args.db_latency_ms / 1000)
+
+    def _make_users(self) -> None:
+        expires = datetime.now(timezone.utc) + timedelta(days=30)
+        for telegram_id in range(1, self.args.users + 1):
+            premium = random.random() < self.args.premium_share
+            self.users[telegram_id] = SimpleNamespace(
+                id=telegram_id,
+                telegram_id=telegram_id,
+                subscription_expires_at=expires if premium else None
+            )
+
+    async def _setup_redis(self) -> None:
+        from redis_client import redis_client
+
+        if self.args.redis == "local":
+            await redis_client.connect()
+        else:
+            try:
+                import fakeredis.aioredis
+            except ImportError:
+                sys.exit("fakeredis не установлен: pip install fakeredis или --redis local")
+            redis_client.redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        for telegram_id in self.users:
+            await redis_client.set_user_chat_state(telegram_id, True)
+
+    async def _setup_vectors(self) -> None:
+        """Временная ChromaDB с воспоминаниями каждого пользователя"""
+        from vector_client import vector_client
+
+        await vector_client.warmup()
+        memories = [
+            {
+                "memory_id": f"{telegram_id}-{i}",
+                "user_id": telegram_id,
+                "content": " ".join(random.choices(WORDS, k=8)),
+                "memory_type": "fact",
+                "importance": "medium",
+            }
+            for telegram_id in self.users
+            for i in range(self.args.memories_per_user)
+        ]
+        await vector_client.add_memories(memories)
+        logger.info(f"🧠 В ChromaDB добавлено {len(memories)} воспоминаний")
+
+    def _patch_services(self, bot: FakeBot) -> None:
+        """Подменить обращения к PostgreSQL, памяти, очереди и Telegram"""
+        import handlers.chat as chat_handlers
+        from bot_integration import bot_integration
+        from context_assembler import context_assembler
+        from memory_client import memory_client
+        from message_coalescer import message_coalescer
+        from models import MemoryType
+        from persona_cache import persona_cache
+        from vector_client import vector_client
+
+        async def get_user(session=None, telegram_id: int = None):
+            await self._db_delay()
+            return self.users.get(telegram_id)
+
+        async def load_user(telegram_id: int):
+            return await get_user(telegram_id=telegram_id)
+
+        async def no_persona(session, user_id):
+            await self._db_delay()
+            return None
+
+        async def search_semantic(user_id: int, query: str, limit: int = 10, **kwargs):
+            if self.args.real_vectors:
+                found = await vector_client.search_similar_memories(user_id, query, limit=limit)
+                await self._db_delay()
+                return [
+                    {
+                        "memory": SimpleNamespace(
+                            content=m["content"],
+                            memory_type=MemoryType.FACT,
+                            memory_types=[MemoryType.FACT]
+                        ),
+                        "similarity": m["similarity"],
+                        "distance": m["distance"],
+                    }
+                    for m in found
+                ]
+            await self._db_delay()
+            return []
+
+        async def empty_list(*args, **kwargs):
+            await self._db_delay()
+            return []
+
+        async def write(*args, **kwargs):
+            await self._db_delay()
+
+        chat_handlers.async_session_maker = FakeSession
+        chat_handlers.get_user_by_telegram_id = get_user
+        persona_cache.get_user_current_persona = no_persona
+        context_assembler._load_user = load_user
+        memory_client.search_semantic_memories = search_semantic
+        memory_client.get_user_memories = empty_list
+        memory_client.get_recent_emotions = empty_list
+        memory_client.add_memories_bulk = write
+        memory_client.add_emotions_bulk = write
+        bot_integration.bot = bot
+
+        original_publish = message_coalescer.publish
+
+        async def publish(message: Dict[str, Any]) -> None:
+            # Граница реплики: сообщения после публикации открывают новую
+            message["_load_test_started"] = self.turn_started.pop(message["user_id"], time.time())
+            await original_publish(message)
+
+        message_coalescer.publish = publish
+
+    @staticmethod
+    async def _failed() -> int:
+        """Запросы, завершившиеся ошибкой (повторы выключены - сразу в dead-letter)"""
+        from queue_client import queue_client, DEAD_LETTER_QUEUE
+
+        return await queue_client.backend.depth(DEAD_LETTER_QUEUE)
+
+    async def _pending(self) -> int:
+        """Опубликованные запросы, которые еще не обработаны"""
+        from queue_client import queue_client
+
+        published = queue_client.publish_stats["confirm"].count
+        return published - self.completed - await self._failed()
+
+    async def _user_message(self, bot: FakeBot, user_id: int) -> None:
+        """Одно сообщение симулированного пользователя"""
+        from handlers.chat import handle_other_messages
+        from tracing import tracer
+
+        text = " ".join(random.choices(WORDS, k=random.randint(3, 15)))
+        message = FakeMessage(bot, user_id, text)
+        self.turn_started.setdefault(user_id, time.time())
+        with tracer.start_trace("telegram.update", user_id=user_id):
+            await handle_other_messages(message)
+        if any(answer.startswith("😔") for answer in message.answers):
+            self.rejected += 1
+
+    async def _generate(self, bot: FakeBot) -> None:
+        """Открытая модель нагрузки: пуассоновский поток сообщений"""
+        deadline = time.monotonic() + self.args.duration
+        tasks = set()
+        user_ids = list(self.users)
+        while time.monotonic() < deadline:
+            await asyncio.sleep(random.expovariate(self.args.rate))
+            # Часть сообщений - серии от одного пользователя (объединяются)
+            task = asyncio.create_task(self._user_message(bot, random.choice(user_ids)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            self.sent += 1
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def run(self) -> None:
+        args = self.args
+        llm_server = None
+        if not args.llm_url:
+            llm_server = FakeLLMServer(
+                args.llm_ttft_ms / 1000, args.llm_sigma, args.llm_token_ms / 1000,
+                args.llm_tokens, args.llm_error_rate
+            )
+            os.environ["LLM_API_URL"] = await llm_server.start(args.llm_port)
+        else:
+            os.environ["LLM_API_URL"] = args.llm_url
+        os.environ["LLM_STREAMING"] = "true" if args.streaming else "false"
+        os.environ["TELEGRAM_DELIVERY_MODE"] = "inline"
+        os.environ["QUEUE_BACKEND"] = "memory"
+        os.environ["QUEUE_RETRY_DELAYS"] = ""
+        os.environ.setdefault("LLM_API_KEY", "load-test")
+        os.environ.setdefault("BOT_TOKEN", "0:load-test")
+        if args.real_vectors:
+            os.environ["VECTOR_DB_PATH"] = tempfile.mkdtemp(prefix="load_test_chroma_")
+
+        # Модули проекта импортируются после настройки окружения
+        from tracing import tracer
+        from llm_client import llm_client
+        from llm_worker import LLMWorker
+        from message_coalescer import message_coalescer
+        from queue_client import queue_client
+
+        collector = SpanCollector()
+        tracer.exporter = collector
+        tracer.sample_rate = 1.0
+
+        self._make_users()
+        await self._setup_redis()
+        if args.real_vectors:
+            await self._setup_vectors()
+
+        await queue_client.connect()
+        bot = FakeBot(args.telegram_latency_ms / 1000, not args.no_telegram_limits)
+        self._patch_services(bot)
+
+        worker = LLMWorker(concurrency=args.concurrency)
+        await llm_client.start()
+        worker.memory_pipeline.start()
+
+        async def handle(message: Dict[str, Any]) -> None:
+            await worker.handle_llm_request(message)
+            self.completed += 1
+            self.e2e.append(time.time() - message["_load_test_started"])
+
+        consumer = asyncio.create_task(
+            queue_client.consume_requests(
+                handle, prefetch_count=args.concurrency, ordering=worker.user_ordering
+            )
+        )
+        logger.info(
+            f"🚀 Нагрузка: {args.rate} сообщ./с, {args.duration}с, "
+            f"{args.users} пользователей, конкурентность {args.concurrency}"
+        )
+        started = time.monotonic()
+        await self._generate(bot)
+        self.generation_time = time.monotonic() - started
+        await message_coalescer.flush_all()
+        drain_deadline = time.monotonic() + args.drain_timeout
+        while await self._pending() and time.monotonic() < drain_deadline:
+            await asyncio.sleep(0.1)
+        elapsed = time.monotonic() - started
+        pending = await self._pending()
+        failed = await self._failed()
+
+        consumer.cancel()
+        await asyncio.gather(consumer, return_exceptions=True)
+        await queue_client.disconnect()
+        await worker.memory_pipeline.stop()
+        await llm_client.close()
+        if llm_server:
+            await llm_server.stop()
+
+        self.report(collector, bot, llm_server, elapsed, pending, failed)
+
+    def report(
+        self,
+        collector: SpanCollector,
+        bot: FakeBot,
+        llm_server: Optional[FakeLLMServer],
+        elapsed: float,
+        pending: int,
+        failed: int
+    ) -> None:
+        """Напечатать пропускную способность и перцентили этапов"""
+        print()
+        print(f"Длительность: {elapsed:.1f}с")
+        print(f"Сообщений отправлено: {self.sent} ({self.sent / self.generation_time:.1f}/с), "
+              f"отклонено лимитом: {self.rejected}")
+        from queue_client import queue_client
+
+        print(f"Реплик в очереди: {queue_client.publish_stats['confirm'].count}, "
+              f"обработано: {self.completed} ({self.completed / elapsed:.2f}/с), "
+              f"ошибок: {failed}, не успели: {pending}")
+        if llm_server:
+            print(f"LLM: {llm_server.requests} запросов, {llm_server.errors} ошибок 503")
+        print(f"Telegram: {dict(bot.calls)}")
+        print()
+        rows = [("end_to_end", sorted(self.e2e))] + sorted(
+            (name, sorted(values)) for name, values in collector.durations.items()
+        )
+        width = max(len(name) for name, _ in rows)
+        print(f"{'этап':<{width}} {'кол-во':>7} {'p50, мс':>9} {'p95, мс':>9} "
+              f"{'p99, мс':>9} {'max, мс':>9}")
+        for name, values in rows:
+            if not values:
+                continue
+            print(
+                f"{name:<{width}} {len(values):>7} "
+                + " ".join(f"{percentile(values, q) * 1000:>9.1f}" for q in (50, 95, 99))
+                + f" {values[-1] * 1000:>9.1f}"
+            )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота и LLM воркера")
+    parser.add_argument("--rate", type=float, default=10, help="Сообщений в секунду")
+    parser.add_argument("--duration", type=float, default=30, help="Длительность нагрузки, с")
+    parser.add_argument("--users", type=int, default=500, help="Число пользователей")
+    parser.add_argument("--premium-share", type=float, default=0.3,
+                        help="Доля пользователей с подпиской")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Конкурентность воркера (WORKER_CONCURRENCY)")
+    parser.add_argument("--drain-timeout", type=float, default=60,
+                        help="Сколько ждать обработки очереди после нагрузки, с")
+    parser.add_argument("--streaming", action=argparse.BooleanOptionalAction, default=True,
+                        help="Потоковая генерация (LLM_STREAMING)")
+    parser.add_argument("--llm-url", help="Внешний LLM API вместо фейкового сервера")
+    parser.add_argument("--llm-port", type=int, default=0, help="Порт фейкового LLM (0 - любой)")
+    parser.add_argument("--llm-ttft-ms", type=float, default=500,
+                        help="Медиана времени до первого токена, мс")
+    parser.add_argument("--llm-sigma", type=float, default=0.5,
+                        help="Разброс (sigma логнормального распределения) TTFT")
+    parser.add_argument("--llm-token-ms", type=float, default=20, help="Интервал между токенами, мс")
+    parser.add_argument("--llm-tokens", type=int, default=80, help="Средняя длина ответа, токенов")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="Доля ответов 503")
+    parser.add_argument("--fake-llm-only", action="store_true",
+                        help="Только запустить фейковый LLM сервер")
+    parser.add_argument("--redis", choices=("fake", "local"), default="fake",
+                        help="fakeredis или Redis из REDIS_HOST/REDIS_PORT")
+    parser.add_argument("--db-latency-ms", type=float, default=5,
+                        help="Задержка заглушек PostgreSQL, мс")
+    parser.add_argument("--real-vectors", action="store_true",
+                        help="Семантический поиск через ChromaDB и модель эмбеддингов")
+    parser.add_argument("--memories-per-user", type=int, default=20,
+                        help="Воспоминаний на пользователя для --real-vectors")
+    parser.add_argument("--telegram-latency-ms", type=float, default=50,
+                        help="Задержка запроса к Bot API, мс")
+    parser.add_argument("--no-telegram-limits", action="store_true",
+                        help="Не применять лимиты telegram_sender")
+    parser.add_argument("--seed", type=int, help="Seed генератора случайных чисел")
+    return parser.parse_args()
+
+
+async def serve_fake_llm(args: argparse.Namespace) -> None:
+    server = FakeLLMServer(
+        args.llm_ttft_ms / 1000, args.llm_sigma, args.llm_token_ms / 1000,
+        args.llm_tokens, args.llm_error_rate
+    )
+    url = await server.start(args.llm_port)
+    logger.info(f"🤖 Фейковый LLM API: {url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    # Логи проекта на каждый запрос заглушили бы отчет
+    logging.getLogger().setLevel(logging.ERROR)
+    logger.setLevel(logging.INFO)
+    if args.seed is not None:
+        random.seed(args.seed)
+    if args.fake_llm_only:
+        asyncio.run(serve_fake_llm(args))
+    else:
+        asyncio.run(LoadTest(args).run())
@@ -9,6 +9,12 @@ from database import init_db, close_db
 from handlers import main_router
 from redis_client import redis_client
 from queue_client import queue_client
+from persona_cache import persona_cache
+from message_coalescer import message_coalescer
+from telegram_sender import setup_rate_limit
+from tracing import tracer, TracingMiddleware
+from delivery import delivery_client, DELIVERY_MODE_QUEUE
+from config import QUEUE_BACKEND
 
 # Настройка логирования
 logging.basicConfig(
@@ -28,14 +34,48 @@ if not BOT_TOKEN:
         "BOT_TOKEN не найден! Создайте файл .env с вашим токеном."
     )
 
-bot = Bot(token=BOT_TOKEN)
+# Все запросы бота проходят через общий планировщик лимитов Telegram
+bot = setup_rate_limit(Bot(token=BOT_TOKEN))
 # Используем MemoryStorage для FSM (состояний)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
+# Каждое сообщение - корневой участок трассы (см. tracing.py)
+tracer.set_service("bot")
+dp.message.outer_middleware(TracingMiddleware())
 
 # Подключаем роутер с обработчиками
 dp.include_router(main_router)
 
+# Воркеры, работающие в процессе бота (QUEUE_BACKEND=memory)
+local_workers = []
+
+
+async def start_local_workers():
+    """
+    Режим одного узла: очереди в памяти процесса, поэтому LLM воркер (и
+    воркер доставки при TELEGRAM_DELIVERY_MODE=queue) запускаются здесь же
+    """
+    from llm_worker import llm_worker
+    workers = [llm_worker]
+    if delivery_client.mode == DELIVERY_MODE_QUEUE:
+        from delivery_worker import DeliveryWorker
+        workers.append(DeliveryWorker())
+    for worker in workers:
+        local_workers.append((worker, asyncio.create_task(worker.start())))
+    logger.info(f"🧩 Режим одного узла: воркеров в процессе бота - {len(workers)}")
+
+
+async def stop_local_workers():
+    """Остановить воркеры, запущенные в процессе бота"""
+    for worker, task in local_workers:
+        task.cancel()
+        try:
+            await task
+        except (asyncio.CancelledError, Exception):
+            pass
+        await worker.stop()
+    local_workers.clear()
+
 
 async def on_startup():
     """Действия при запуске бота"""
@@ -51,10 +91,16 @@ async def on_startup():
         logger.info("📡 Подключение к Redis...")
         await redis_client.connect()
         
-        # Подключаемся к RabbitMQ
-        logger.info("📡 Подключение к RabbitMQ...")
+        # Подписываемся на инвалидацию кэша персонажей
+        persona_cache.start_listener(redis_client.redis)
+        
+        # Подключаемся к очередям (RabbitMQ, Redis Streams или память процесса)
+        logger.info(f"📡 Подключение к очередям ({QUEUE_BACKEND})...")
         await queue_client.connect()
         
+        if QUEUE_BACKEND == "memory":
+            await start_local_workers()
+        
         logger.info("🎉 Все сервисы успешно подключены!")
         logger.info("💕 AI Girlfriend Bot готов к работе!")
         
@@ -70,15 +116,22 @@ async def on_shutdown():
     """Действия при остановке бота"""
     logger.info("Остановка бота...")
     
+    # Отправляем в очередь реплики, ожидающие окончания серии сообщений
+    await message_coalescer.flush_all()
+    await stop_local_workers()
+    
     # Закрываем соединения
     await close_db()
     logger.info("Соединение с БД закрыто")
     
+    await persona_cache.stop_listener()
     await redis_client.disconnect()
     logger.info("Соединение с Redis закрыто")
     
     await queue_client.disconnect()
-    logger.info("Соединение с RabbitMQ закрыто")
+    logger.info("Соединение с очередями закрыто")
+    
+    tracer.flush()
 
 
 async def main():
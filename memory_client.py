@@ -4,15 +4,49 @@
 import logging
 from typing import List, Dict, Optional, Tuple
 from datetime import datetime, timedelta
+import numpy as np
 from sqlalchemy import select, and_, or_, desc, func
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from models import User, UserMemory, UserEmotion, UserRelationship, MemoryType, MemoryImportance
 from database import async_session_maker
 from vector_client import vector_client
+from embedding_engine import embedding_engine
+from config import MEMORY_DEDUP_THRESHOLD
 
 logger = logging.getLogger(__name__)
 
+# Порядок важности воспоминаний (critical > high > medium > low)
+IMPORTANCE_ORDER = {
+    MemoryImportance.CRITICAL: 4,
+    MemoryImportance.HIGH: 3,
+    MemoryImportance.MEDIUM: 2,
+    MemoryImportance.LOW: 1
+}
+
+
+def merge_memory_types(*groups: List[MemoryType]) -> List[MemoryType]:
+    """Объединить списки типов без повторов (порядок первого появления)"""
+    return list(dict.fromkeys(memory_type for group in groups for memory_type in group))
+
+
+def vector_item(memory: UserMemory) -> Dict:
+    """Элемент vector_client.add_memories / update_metadatas для воспоминания"""
+    return {
+        "memory_id": str(memory.id),
+        "user_id": memory.user_id,
+        "content": memory.content,
+        "memory_type": memory.memory_type.value,
+        "memory_types": [memory_type.value for memory_type in memory.memory_types],
+        "importance": memory.importance.value,
+        "tags": memory.tags,
+        "metadata": {
+            "created_at": memory.created_at.isoformat() if memory.created_at else None,
+            "emotional_tone": memory.emotional_tone,
+            "confidence_score": memory.confidence_score
+        }
+    }
+
 
 class MemoryClient:
     """Клиент для работы с долгосрочной памятью"""
@@ -40,6 +74,7 @@ class MemoryClient:
                     user_id=user_id,
                     content=content,
                     memory_type=memory_type,
+                    memory_types=[memory_type],
                     importance=importance,
                     tags=tags or [],
                     emotional_tone=emotional_tone,
@@ -74,6 +109,130 @@ class MemoryClient:
                 logger.error(f"Ошибка добавления воспоминания: {e}")
                 raise
     
+    async def add_memories_bulk(self, items: List[Dict]) -> List[UserMemory]:
+        """
+        Добавить несколько воспоминаний одной транзакцией.
+
+        Каждый элемент - словарь с ключами user_id, content, memory_types
+        (или один memory_type), importance и необязательными tags,
+        emotional_tone, confidence_score. Эмбеддинги для всех воспоминаний
+        считаются одним пакетом.
+
+        Повторы не записываются: если воспоминание близко (косинус не ниже
+        MEMORY_DEDUP_THRESHOLD) к уже сохраненному воспоминанию пользователя
+        или к предыдущему в пакете, его типы и важность добавляются к тому
+        воспоминанию. Возвращает новые записи.
+        """
+        if not items:
+            return []
+        items = [
+            {**item, "memory_types": merge_memory_types(item.get("memory_types") or [item["memory_type"]])}
+            for item in items
+        ]
+        embeddings = await embedding_engine.encode([item["content"] for item in items])
+        unit = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        
+        # Индекс элемента -> индекс элемента пакета или ID сохраненного
+        # воспоминания, с которым он объединяется
+        merged_into: Dict[int, int] = {}
+        existing: Dict[int, List[int]] = {}
+        by_user: Dict[int, List[int]] = {}
+        for i, item in enumerate(items):
+            by_user.setdefault(item["user_id"], []).append(i)
+        for user_id, indexes in by_user.items():
+            try:
+                duplicates = await vector_client.find_duplicates(
+                    user_id, embeddings[indexes], MEMORY_DEDUP_THRESHOLD
+                )
+            except Exception as e:
+                # Без векторной базы повторы с сохраненным не ищутся
+                logger.warning(f"Не удалось найти повторы воспоминаний пользователя {user_id}: {e}")
+                duplicates = [None] * len(indexes)
+            kept: List[int] = []
+            for i, duplicate in zip(indexes, duplicates):
+                if duplicate is not None:
+                    existing.setdefault(int(duplicate[0]), []).append(i)
+                    continue
+                if kept:
+                    similarity = unit[kept] @ unit[i]
+                    best = int(np.argmax(similarity))
+                    if similarity[best] >= MEMORY_DEDUP_THRESHOLD:
+                        merged_into[i] = kept[best]
+                        continue
+                kept.append(i)
+        
+        for i, target in merged_into.items():
+            items[target]["memory_types"] = merge_memory_types(
+                items[target]["memory_types"], items[i]["memory_types"]
+            )
+            items[target]["importance"] = self._max_importance(
+                items[target].get("importance"), items[i].get("importance")
+            )
+        
+        async with self.session_maker() as session:
+            try:
+                updated = []
+                found = set()
+                if existing:
+                    result = await session.execute(
+                        select(UserMemory).where(UserMemory.id.in_(list(existing)))
+                    )
+                    for memory in result.scalars().all():
+                        found.add(memory.id)
+                        duplicates = [items[i] for i in existing[memory.id]]
+                        memory_types = merge_memory_types(
+                            memory.memory_types or [memory.memory_type],
+                            *(item["memory_types"] for item in duplicates)
+                        )
+                        importance = self._max_importance(
+                            memory.importance, *(item.get("importance") for item in duplicates)
+                        )
+                        if memory_types != list(memory.memory_types or []) or importance != memory.importance:
+                            memory.memory_types = memory_types
+                            memory.importance = importance
+                            updated.append(memory)
+                
+                # Повторы вектора без записи в PostgreSQL сохраняются как новые
+                skipped = set(merged_into)
+                skipped.update(i for memory_id in found for i in existing[memory_id])
+                new_indexes = [i for i in range(len(items)) if i not in skipped]
+                memories = [
+                    UserMemory(
+                        user_id=items[i]["user_id"],
+                        content=items[i]["content"],
+                        memory_type=items[i]["memory_types"][0],
+                        memory_types=items[i]["memory_types"],
+                        importance=items[i].get("importance", MemoryImportance.MEDIUM),
+                        tags=items[i].get("tags") or [],
+                        emotional_tone=items[i].get("emotional_tone"),
+                        confidence_score=items[i].get("confidence_score")
+                    )
+                    for i in new_indexes
+                ]
+                session.add_all(memories)
+                
+                await session.commit()
+                logger.info(
+                    f"✅ {len(memories)} воспоминаний сохранено в PostgreSQL одной транзакцией "
+                    f"(повторов: {len(items) - len(memories)}, дополнено: {len(updated)})"
+                )
+            except Exception as e:
+                await session.rollback()
+                logger.error(f"Ошибка пакетного добавления воспоминаний: {e}")
+                raise
+        
+        await vector_client.add_memories([
+            {**vector_item(memory), "embedding": embeddings[i]}
+            for i, memory in zip(new_indexes, memories)
+        ])
+        await vector_client.update_metadatas([vector_item(memory) for memory in updated])
+        return memories
+    
+    @staticmethod
+    def _max_importance(*levels: Optional[MemoryImportance]) -> MemoryImportance:
+        """Наибольшая из важностей (None - средняя)"""
+        return max((level or MemoryImportance.MEDIUM for level in levels), key=IMPORTANCE_ORDER.get)
+    
     async def get_user_memories(
         self, 
         user_id: int, 
@@ -87,20 +246,14 @@ class MemoryClient:
                 query = select(UserMemory).where(UserMemory.user_id == user_id)
                 
                 if memory_types:
-                    query = query.where(UserMemory.memory_type.in_(memory_types))
+                    # Хотя бы один из типов воспоминания - среди запрошенных
+                    query = query.where(UserMemory.memory_types.overlap(memory_types))
                 
                 if importance_min:
-                    # Сортируем по важности (critical > high > medium > low)
-                    importance_order = {
-                        MemoryImportance.CRITICAL: 4,
-                        MemoryImportance.HIGH: 3,
-                        MemoryImportance.MEDIUM: 2,
-                        MemoryImportance.LOW: 1
-                    }
-                    min_level = importance_order.get(importance_min, 2)
+                    min_level = IMPORTANCE_ORDER.get(importance_min, 2)
                     query = query.where(
                         UserMemory.importance.in_([
-                            imp for imp, level in importance_order.items() 
+                            imp for imp, level in IMPORTANCE_ORDER.items() 
                             if level >= min_level
                         ])
                     )
@@ -184,8 +337,11 @@ class MemoryClient:
                 limit=limit
             )
             
-            # Получаем полную информацию из PostgreSQL
-            memory_ids = [mem["metadata"].get("id") for mem in similar_memories if mem["metadata"].get("id")]
+            # Получаем полную информацию из PostgreSQL (ID записи в векторной
+            # базе совпадает с ID воспоминания в PostgreSQL)
+            for mem in similar_memories:
+                mem["metadata"]["id"] = int(mem["id"])
+            memory_ids = [mem["metadata"]["id"] for mem in similar_memories]
             
             if not memory_ids:
                 return []
@@ -251,6 +407,28 @@ class MemoryClient:
                 logger.error(f"Ошибка добавления эмоции: {e}")
                 raise
     
+    async def add_emotions_bulk(self, items: List[Dict]) -> None:
+        """Добавить несколько эмоций одной транзакцией (user_id, emotion, intensity, context)"""
+        if not items:
+            return
+        async with self.session_maker() as session:
+            try:
+                session.add_all([
+                    UserEmotion(
+                        user_id=item["user_id"],
+                        emotion=item["emotion"],
+                        intensity=item["intensity"],
+                        context=item.get("context")
+                    )
+                    for item in items
+                ])
+                await session.commit()
+                logger.info(f"Добавлено {len(items)} эмоций одной транзакцией")
+            except Exception as e:
+                await session.rollback()
+                logger.error(f"Ошибка пакетного добавления эмоций: {e}")
+                raise
+    
     async def get_recent_emotions(
         self, 
         user_id: int, 
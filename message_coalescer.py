@@ -0,0 +1,246 @@
+"""
+Объединение серий быстрых сообщений пользователя в один запрос к LLM
+"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from queue_client import queue_client
+from tracing import tracer
+from config import (
+    CHAT_COALESCE_WINDOW,
+    CHAT_COALESCE_MAX_WAIT,
+    CHAT_COALESCE_MAX_MESSAGES
+)
+
+logger = logging.getLogger(__name__)
+
+# Сколько ждать ID сообщения "Печатаю ответ..." перед публикацией (секунды)
+THINKING_MESSAGE_WAIT = 5.0
+
+# Ответ пользователю, если реплику не удалось поставить в очередь
+PUBLISH_ERROR_TEXT = "❌ Произошла ошибка при обработке сообщения. Попробуйте еще раз."
+
+
+@dataclass
+class PendingTurn:
+    """Накапливаемая реплика пользователя (одна или несколько сообщений)"""
+    user_id: int
+    chat_id: int
+    persona_id: Optional[int]
+    # Версия персонажа, которую видел бот: воркер не возьмет из кэша более старую
+    persona_version: Optional[int] = None
+    # Тариф для выбора полосы очереди (premium/free)
+    tier: str = "free"
+    messages: List[str] = field(default_factory=list)
+    # Время первого сообщения серии (unix time) и крайний срок публикации
+    # (время цикла событий)
+    started_at: float = field(default_factory=time.time)
+    first_added: float = 0.0
+    deadline: float = 0.0
+    thinking_message_id: Optional[int] = None
+    # Устанавливается, когда известен ID сообщения "Печатаю ответ..."
+    ready: asyncio.Event = field(default_factory=asyncio.Event)
+    # Будит ожидание при переносе крайнего срока на "сейчас"
+    wakeup: asyncio.Event = field(default_factory=asyncio.Event)
+    task: Optional[asyncio.Task] = None
+    # Бот, через который сообщить об ошибке публикации (aiogram Bot)
+    bot: Any = None
+
+    def to_queue_message(self) -> Dict[str, Any]:
+        """Сообщение для очереди llm_requests"""
+        return {
+            "user_id": self.user_id,
+            "chat_id": self.chat_id,
+            "message": "\n".join(self.messages),
+            "message_count": len(self.messages),
+            "timestamp": int(self.started_at),
+            "persona_id": self.persona_id,
+            "persona_version": self.persona_version,
+            "thinking_message_id": self.thinking_message_id,
+            "tier": self.tier,
+            # Порядковый номер реплики: воркер отбрасывает повтор реплики,
+            # если уже начал обрабатывать более новую реплику пользователя
+            "turn_seq": time.time_ns()
+        }
+
+
+class MessageCoalescer:
+    """
+    Debounce сообщений одного пользователя.
+
+    Сообщение открывает реплику (PendingTurn) или дописывается в уже
+    открытую. Реплика публикуется одним запросом, когда пользователь
+    молчит window секунд, но не позже max_wait секунд после первого
+    сообщения или сразу после max_messages сообщений. Только первое
+    сообщение реплики получает "Печатаю ответ...", поэтому воркер делает
+    один вызов LLM и отправляет один ответ на всю серию.
+
+    Лимит сообщений проверяется обработчиком до add() для каждого
+    сообщения отдельно, поэтому объединение не влияет на подсчет.
+    При window <= 0 каждое сообщение публикуется сразу.
+    """
+
+    def __init__(
+        self,
+        publish: Callable[[Dict[str, Any]], Awaitable[None]],
+        window: float = CHAT_COALESCE_WINDOW,
+        max_wait: float = CHAT_COALESCE_MAX_WAIT,
+        max_messages: int = CHAT_COALESCE_MAX_MESSAGES
+    ):
+        self.publish = publish
+        self.window = window
+        self.max_wait = max_wait
+        self.max_messages = max_messages
+        self._pending: Dict[int, PendingTurn] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.turns_published = 0
+        self.messages_coalesced = 0
+
+    def add(
+        self,
+        user_id: int,
+        chat_id: int,
+        text: str,
+        persona_id: Optional[int] = None,
+        tier: str = "free",
+        persona_version: Optional[int] = None,
+        bot: Any = None
+    ) -> Optional[PendingTurn]:
+        """
+        Добавить текстовое сообщение пользователя.
+
+        Возвращает новую реплику, если сообщение ее открыло: вызывающий
+        код должен отправить "Печатаю ответ..." и передать его ID в
+        set_thinking_message(). Возвращает None, если сообщение дописано
+        в открытую реплику. Метод синхронный, поэтому два одновременно
+        обрабатываемых сообщения не откроют две реплики. Через bot
+        пользователю сообщается, если реплику не удалось опубликовать.
+        """
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        turn = self._pending.get(user_id)
+        if turn is not None:
+            turn.messages.append(text)
+            # Персона и тариф - по последнему сообщению реплики
+            turn.persona_id = persona_id
+            turn.persona_version = persona_version
+            turn.tier = tier
+            self.messages_coalesced += 1
+            if len(turn.messages) >= self.max_messages:
+                turn.deadline = now
+                turn.wakeup.set()
+            else:
+                turn.deadline = min(now + self.window, turn.first_added + self.max_wait)
+            logger.info(
+                f"🧩 Сообщение пользователя {user_id} объединено "
+                f"({len(turn.messages)} в реплике)"
+            )
+            return None
+
+        turn = PendingTurn(
+            user_id=user_id,
+            chat_id=chat_id,
+            persona_id=persona_id,
+            persona_version=persona_version,
+            tier=tier,
+            messages=[text],
+            first_added=now,
+            deadline=now + max(self.window, 0),
+            bot=bot
+        )
+        self._pending[user_id] = turn
+        turn.task = asyncio.create_task(self._wait_and_flush(turn))
+        self._tasks.add(turn.task)
+        turn.task.add_done_callback(self._tasks.discard)
+        return turn
+
+    @staticmethod
+    def set_thinking_message(turn: PendingTurn, message_id: Optional[int]) -> None:
+        """Сообщить ID "Печатаю ответ..." (None, если отправить не удалось)"""
+        turn.thinking_message_id = message_id
+        turn.ready.set()
+
+    async def _wait_and_flush(self, turn: PendingTurn) -> None:
+        """Дождаться тишины (с учетом продлений) и опубликовать реплику"""
+        loop = asyncio.get_running_loop()
+        while True:
+            delay = turn.deadline - loop.time()
+            if delay <= 0:
+                break
+            try:
+                await asyncio.wait_for(turn.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+        await self._publish(turn)
+
+    async def _publish(self, turn: PendingTurn) -> None:
+        """Опубликовать реплику в очередь"""
+        if self._pending.get(turn.user_id) is turn:
+            del self._pending[turn.user_id]
+        try:
+            await asyncio.wait_for(turn.ready.wait(), THINKING_MESSAGE_WAIT)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"⚠️ Нет ID сообщения 'Печатаю ответ...' для пользователя {turn.user_id}"
+            )
+        # Участок от первого сообщения серии до публикации (включая
+        # ожидание "Печатаю ответ...") в трассе первого сообщения
+        tracer.record_span(
+            "chat.coalesce", turn.started_at, messages=len(turn.messages)
+        )
+        try:
+            queue_message = turn.to_queue_message()
+            await self.publish(queue_message)
+            self.turns_published += 1
+            logger.info(
+                f"📤 Реплика пользователя {turn.user_id} отправлена в очередь: "
+                f"{queue_message['message_count']} сообщ., "
+                f"persona_id={queue_message['persona_id']}"
+            )
+        except Exception as e:
+            logger.error(f"Ошибка отправки реплики пользователя {turn.user_id} в очередь: {e}")
+            await self._report_failure(turn)
+
+    @staticmethod
+    async def _report_failure(turn: PendingTurn) -> None:
+        """Заменить "Печатаю ответ..." сообщением об ошибке (или отправить его)"""
+        if turn.bot is None:
+            return
+        try:
+            # "Печатаю ответ..." могло быть отправлено уже после THINKING_MESSAGE_WAIT
+            await asyncio.wait_for(turn.ready.wait(), THINKING_MESSAGE_WAIT)
+        except asyncio.TimeoutError:
+            pass
+        try:
+            if turn.thinking_message_id:
+                try:
+                    await turn.bot.edit_message_text(
+                        text=PUBLISH_ERROR_TEXT, chat_id=turn.chat_id,
+                        message_id=turn.thinking_message_id
+                    )
+                    return
+                except Exception as e:
+                    logger.warning(f"Не удалось заменить 'Печатаю ответ...' ошибкой: {e}")
+            await turn.bot.send_message(turn.chat_id, PUBLISH_ERROR_TEXT)
+        except Exception as e:
+            logger.error(f"Не удалось сообщить пользователю {turn.user_id} об ошибке: {e}")
+
+    async def flush_all(self) -> None:
+        """Опубликовать все накопленные реплики (при остановке бота)"""
+        pending = len(self._pending)
+        loop = asyncio.get_running_loop()
+        for turn in self._pending.values():
+            # Не ждем окончания серии; публикация уже идущих реплик
+            # просто дожидается завершения
+            turn.deadline = loop.time()
+            turn.wakeup.set()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if pending:
+            logger.info(f"📤 Опубликовано {pending} накопленных реплик")
+
+
+# Глобальный экземпляр объединителя сообщений
+message_coalescer = MessageCoalescer(queue_client.publish_message)
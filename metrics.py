@@ -0,0 +1,309 @@
+"""
+Метрики Prometheus LLM воркера и HTTP-эндпоинт /metrics
+"""
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram, start_http_server
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from config import WORKER_METRICS_PORT, METRICS_QUEUE_DEPTH_INTERVAL
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+# Границы гистограмм (секунды): этапы обработки - от миллисекунд до минуты,
+# ожидание в очереди - до нескольких минут (очереди повтора)
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUEUE_WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Пакеты эмбеддингов: размер (тексты) и ожидание пакета (секунды)
+EMBEDDING_BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+EMBEDDING_WAIT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+# Этапы обработки запроса (метка stage)
+STAGE_CONTEXT = "context"
+STAGE_EMBEDDING = "embedding"
+STAGE_VECTOR_SEARCH = "vector_search"
+STAGE_LLM = "llm"
+STAGE_DELIVERY = "delivery"
+# Поиск повторов при записи воспоминаний: фоновая работа, не этап запроса
+STAGE_DEDUP_SEARCH = "dedup_search"
+
+# Исход обработки запроса (метка outcome)
+OUTCOME_PROCESSED = "processed"
+OUTCOME_RETRIED = "retried"
+OUTCOME_FAILED = "failed"
+
+# Метка result метрики llm_model_requests -> поле LLMClient.get_stats()
+LLM_RESULTS = {
+    "attempt": "requests",
+    "success": "successes",
+    "failure": "failures",
+    "retry": "retries",
+}
+
+WORKER_READY = Gauge(
+    "llm_worker_ready",
+    "1 - воркер прогрет (модель эмбеддингов и ChromaDB) и читает очередь"
+)
+IN_FLIGHT = Gauge(
+    "llm_worker_in_flight_requests",
+    "Запросы, которые воркер обрабатывает прямо сейчас"
+)
+REQUESTS = Counter(
+    "llm_worker_requests",
+    "Обработанные запросы: processed - успешно, retried - ошибка с повтором, "
+    "failed - ошибка на последней попытке",
+    ["tier", "outcome"]
+)
+QUEUE_WAIT = Histogram(
+    "llm_worker_queue_wait_seconds",
+    "Ожидание запроса в очереди (публикация -> начало обработки)",
+    ["tier"],
+    buckets=QUEUE_WAIT_BUCKETS
+)
+MESSAGE_AGE = Histogram(
+    "llm_worker_message_age_seconds",
+    "Возраст реплики к началу обработки (поле timestamp: первое сообщение "
+    "пользователя, включая объединение сообщений и повторы)",
+    ["tier"],
+    buckets=QUEUE_WAIT_BUCKETS
+)
+STAGE_LATENCY = Histogram(
+    "llm_worker_stage_seconds",
+    "Длительность этапов обработки запроса",
+    ["stage"],
+    buckets=STAGE_BUCKETS
+)
+CONTEXT_STAGE_LATENCY = Histogram(
+    "llm_worker_context_stage_seconds",
+    "Длительность отдельных обращений при сборе контекста",
+    ["stage"],
+    buckets=STAGE_BUCKETS
+)
+EMBEDDING_BATCH = Histogram(
+    "embedding_batch_size",
+    "Число текстов в пакете расчета эмбеддингов",
+    buckets=EMBEDDING_BATCH_BUCKETS
+)
+EMBEDDING_QUEUE_WAIT = Histogram(
+    "embedding_queue_seconds",
+    "Ожидание текста до начала расчета его пакета (сбор пакета и пул потоков)",
+    buckets=EMBEDDING_WAIT_BUCKETS
+)
+EMBEDDING_ENCODE_LATENCY = Histogram(
+    "embedding_encode_seconds",
+    "Расчет эмбеддингов одного пакета",
+    buckets=STAGE_BUCKETS
+)
+EMBEDDING_CACHE = Counter(
+    "embedding_cache_lookups",
+    "Поиск эмбеддинга в кэше: memory и redis - найден, miss - рассчитан",
+    ["result"]
+)
+VECTOR_STORE_QUEUE_WAIT = Histogram(
+    "vector_store_queue_seconds",
+    "Ожидание вызова ChromaDB до начала выполнения в пуле потоков",
+    ["operation"],
+    buckets=EMBEDDING_WAIT_BUCKETS
+)
+VECTOR_STORE_LATENCY = Histogram(
+    "vector_store_call_seconds",
+    "Выполнение вызова ChromaDB в пуле потоков",
+    ["operation"],
+    buckets=STAGE_BUCKETS
+)
+VECTOR_STORE_BATCH = Histogram(
+    "vector_store_write_batch_size",
+    "Вызовы add/upsert, объединенные в одну запись коллекции",
+    buckets=EMBEDDING_BATCH_BUCKETS
+)
+VECTOR_SEARCH_MODE = Counter(
+    "vector_search_requests",
+    "Поиск воспоминаний пользователя: exact - матрицей в памяти, ann - HNSW в ChromaDB",
+    ["mode"]
+)
+WRITE_BEHIND_ITEMS = Counter(
+    "write_behind_items",
+    "Элементы фоновой записи: processed - записаны, retried - повтор, "
+    "failed - не записаны после повторов, dropped - отброшены при переполнении",
+    ["pipeline", "result"]
+)
+QUEUE_DEPTH = Gauge(
+    "llm_queue_depth",
+    "Сообщения, ожидающие в очереди (для автомасштабирования воркеров)",
+    ["queue"]
+)
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    """Записать длительность этапа обработки"""
+    STAGE_LATENCY.labels(stage).observe(seconds)
+
+
+@contextmanager
+def time_stage(stage: str) -> Iterator[None]:
+    """Замерить длительность блока как этап stage (и участок трассы)"""
+    started = time.perf_counter()
+    try:
+        with tracer.span(stage):
+            yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+def observe_context(timings: Dict[str, float]) -> None:
+    """Записать длительности сбора контекста (ChatContext.timings)"""
+    for name, seconds in timings.items():
+        if name == "total":
+            observe_stage(STAGE_CONTEXT, seconds)
+        else:
+            CONTEXT_STAGE_LATENCY.labels(name).observe(seconds)
+
+
+def observe_queue_wait(message: Dict[str, Any]) -> None:
+    """Записать ожидание в очереди и возраст реплики из сообщения очереди"""
+    tier = message.get("tier") or "free"
+    queue_wait = message.get("queue_wait")
+    if queue_wait is not None:
+        QUEUE_WAIT.labels(tier).observe(queue_wait)
+    timestamp = message.get("timestamp")
+    if timestamp:
+        MESSAGE_AGE.labels(tier).observe(max(0.0, time.time() - timestamp))
+
+
+def record_outcome(message: Dict[str, Any], outcome: str) -> None:
+    """Учесть исход обработки запроса"""
+    REQUESTS.labels(message.get("tier") or "free", outcome).inc()
+
+
+class WorkerStatsCollector:
+    """
+    Экспорт счетчиков, которые модули уже ведут сами: LLM клиент (запросы,
+    токены, предохранители), публикация в очередь, доставка и лимиты
+    Telegram. Значения читаются в момент запроса /metrics.
+    """
+
+    def collect(self):
+        # Импорт здесь: модули воркера тяжелые, а metrics используется
+        # и в vector_client
+        from llm_client import llm_client
+        from queue_client import queue_client
+        from delivery import telegram_deliverer
+        from telegram_sender import telegram_sender
+
+        requests = CounterMetricFamily(
+            "llm_model_requests", "Попытки запросов к модели по результату",
+            labels=["model", "result"]
+        )
+        tokens = CounterMetricFamily(
+            "llm_tokens", "Расход токенов LLM", labels=["model", "kind"]
+        )
+        circuit = GaugeMetricFamily(
+            "llm_circuit_open", "Предохранитель модели открыт (1) или закрыт (0)",
+            labels=["model"]
+        )
+        for model, stats in llm_client.get_stats().items():
+            for result, key in LLM_RESULTS.items():
+                requests.add_metric([model, result], stats[key])
+            tokens.add_metric([model, "prompt"], stats["prompt_tokens"])
+            tokens.add_metric([model, "completion"], stats["completion_tokens"])
+            circuit.add_metric([model], 0 if stats["circuit"] == "closed" else 1)
+        yield requests
+        yield tokens
+        yield circuit
+
+        yield CounterMetricFamily(
+            "queue_publish_failures", "Неудачные публикации в очередь",
+            value=queue_client.publish_failures
+        )
+
+        delivery = CounterMetricFamily(
+            "telegram_delivery_actions", "Действия доставки в Telegram по результату",
+            labels=["result"]
+        )
+        for result in ("delivered", "failed", "retries", "stale"):
+            delivery.add_metric([result], getattr(telegram_deliverer, result))
+        yield delivery
+
+        sender = telegram_sender.get_stats()
+        yield GaugeMetricFamily(
+            "telegram_send_queue", "Запросы к Bot API, ожидающие лимита",
+            value=sender["queued"]
+        )
+        limited = CounterMetricFamily(
+            "telegram_send_requests", "Запросы к Bot API через планировщик лимитов",
+            labels=["result"]
+        )
+        for result in ("granted", "rejected", "retry_after"):
+            limited.add_metric([result], sender[result])
+        yield limited
+
+
+# WorkerStatsCollector регистрируется в REGISTRY один раз на процесс
+_stats_collector_registered = False
+
+
+class MetricsServer:
+    """
+    HTTP-эндпоинт /metrics (отдельный поток prometheus_client) и фоновое
+    обновление глубины очередей.
+    """
+
+    def __init__(self, port: int = WORKER_METRICS_PORT):
+        self.port = port
+        self.started = False
+        self._depth_task: Optional[asyncio.Task] = None
+        self._server = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Запустить эндпоинт (если порт задан) и опрос глубины очередей"""
+        global _stats_collector_registered
+        if not self.port or self.started:
+            return
+        if not _stats_collector_registered:
+            REGISTRY.register(WorkerStatsCollector())
+            _stats_collector_registered = True
+        self._server, self._thread = start_http_server(self.port)
+        self.started = True
+        self._depth_task = asyncio.create_task(self._poll_queue_depths())
+        logger.info(f"📈 Метрики Prometheus: http://0.0.0.0:{self.port}/metrics")
+
+    async def _poll_queue_depths(self) -> None:
+        """Периодически обновлять llm_queue_depth"""
+        from queue_client import queue_client
+
+        while True:
+            try:
+                for queue, depth in (await queue_client.get_queue_depths()).items():
+                    QUEUE_DEPTH.labels(queue).set(depth)
+            except Exception as e:
+                logger.warning(f"Не удалось получить глубину очередей: {e}")
+            await asyncio.sleep(METRICS_QUEUE_DEPTH_INTERVAL)
+
+    async def stop(self) -> None:
+        """Остановить опрос глубины очередей и эндпоинт"""
+        if self._depth_task:
+            self._depth_task.cancel()
+            try:
+                await self._depth_task
+            except asyncio.CancelledError:
+                pass
+            self._depth_task = None
+        if self._server is not None:
+            # shutdown() ждет выхода из цикла сервера (до 0.5с) - не в цикле событий
+            await asyncio.get_running_loop().run_in_executor(None, self._server.shutdown)
+            self._server.server_close()
+            self._thread.join(timeout=1)
+            self._server = None
+            self._thread = None
+        self.started = False
+
+
+# Глобальный экземпляр сервера метрик
+metrics_server = MetricsServer()
@@ -0,0 +1,23 @@
+-- Миграция: несколько типов у одного воспоминания
+-- Описание: раньше сообщение пользователя сохранялось отдельной записью
+-- user_memories (и отдельным вектором) на каждый подошедший тип. Теперь
+-- одна запись хранит все типы в столбце memory_types; memory_type остается
+-- основным типом для старого кода.
+--
+-- После миграции объедините существующие дубликаты (PostgreSQL и ChromaDB):
+--   python compact_memories.py --dry-run
+--   python compact_memories.py
+
+-- Столбец со всеми типами воспоминания
+ALTER TABLE user_memories
+ADD COLUMN IF NOT EXISTS memory_types memory_type[] NOT NULL DEFAULT '{}';
+
+-- Существующие записи: единственный тип - основной
+UPDATE user_memories
+SET memory_types = ARRAY[memory_type]
+WHERE memory_types = '{}';
+
+-- Поиск по типу: memory_types && ARRAY['goal']::memory_type[]
+CREATE INDEX IF NOT EXISTS idx_memories_types ON user_memories USING GIN (memory_types);
+
+COMMENT ON COLUMN user_memories.memory_types IS 'Все типы воспоминания (memory_type - основной из них)';
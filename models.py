@@ -197,10 +197,18 @@ class UserMemory(Base):
 
     # Содержимое воспоминания
     content: Mapped[str] = mapped_column(Text, nullable=False)
+    # Основной тип (первый из memory_types) - для старого кода и индекса
     memory_type: Mapped[MemoryType] = mapped_column(
         SQLEnum(MemoryType, name='memory_type', create_type=False, values_callable=lambda x: [e.value for e in x]),
         nullable=False
     )
+    # Все типы воспоминания: одно сообщение - одна запись
+    # (см. migration_memory_types.sql)
+    memory_types: Mapped[List[MemoryType]] = mapped_column(
+        ARRAY(SQLEnum(MemoryType, name='memory_type', create_type=False, values_callable=lambda x: [e.value for e in x])),
+        nullable=False,
+        server_default='{}'
+    )
     importance: Mapped[MemoryImportance] = mapped_column(
         SQLEnum(MemoryImportance, name='memory_importance', create_type=False, values_callable=lambda x: [e.value for e in x]),
         nullable=False,
@@ -236,6 +244,7 @@ class UserMemory(Base):
     __table_args__ = (
         Index('idx_memories_user_id', 'user_id'),
         Index('idx_memories_type', 'memory_type'),
+        Index('idx_memories_types', 'memory_types', postgresql_using='gin'),
         Index('idx_memories_importance', 'importance'),
         Index('idx_memories_created_at', 'created_at'),
         Index('idx_memories_tags', 'tags', postgresql_using='gin'),
@@ -0,0 +1,241 @@
+"""
+Кэш персонажей в памяти процесса с межпроцессной инвалидацией
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import async_session_maker
+from crud import get_persona_by_id, get_persona_by_key, get_user_current_persona_version
+from models import Persona
+from config import PERSONA_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+# Канал Redis pub/sub для инвалидации кэша во всех процессах
+PERSONA_INVALIDATION_CHANNEL = "persona_cache:invalidate"
+
+
+class PersonaCache:
+    """
+    Кэш строк Persona по id и key, общий для бота и воркера.
+
+    Каждая запись хранит версию персонажа (Persona.version). Сообщение
+    инвалидации {"persona_id": ..., "version": ...} из Redis удаляет запись,
+    если ее версия меньше указанной (без версии - удаляет всегда; без
+    persona_id - очищает весь кэш). Изменения в базе без публикации
+    инвалидации замечаются при чтении: текущий персонаж пользователя
+    читается из базы вместе с версией, и запись старше нее загружается
+    заново (get_by_id(..., min_version)); остальное страхует TTL.
+    Одновременные промахи по одному ключу выполняют один запрос к базе
+    (single-flight).
+
+    Возвращаемые объекты отсоединены от сессии и должны использоваться
+    только для чтения.
+    """
+
+    def __init__(self, ttl: float = PERSONA_CACHE_TTL):
+        self.ttl = ttl
+        self._by_id: Dict[int, Tuple[Persona, float]] = {}
+        self._id_by_key: Dict[str, int] = {}
+        self._inflight: Dict[Tuple[str, Any], asyncio.Task] = {}
+        self._listener_task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+
+    def _get_fresh(self, persona_id: Optional[int]) -> Optional[Persona]:
+        """Вернуть запись из кэша, если она есть и не устарела по TTL"""
+        entry = self._by_id.get(persona_id)
+        if entry is None:
+            return None
+        persona, loaded_at = entry
+        if time.monotonic() - loaded_at > self.ttl:
+            self._evict(persona_id)
+            return None
+        return persona
+
+    def _store(self, persona: Optional[Persona]) -> Optional[Persona]:
+        """Положить загруженного персонажа в кэш"""
+        if persona is not None:
+            self._by_id[persona.id] = (persona, time.monotonic())
+            self._id_by_key[persona.key] = persona.id
+        return persona
+
+    def _evict(self, persona_id: int) -> None:
+        """Удалить запись из кэша"""
+        entry = self._by_id.pop(persona_id, None)
+        if entry is not None:
+            self._id_by_key.pop(entry[0].key, None)
+
+    async def _single_flight(
+        self,
+        flight_key: Tuple[str, Any],
+        loader: Callable[[], Awaitable[Optional[Persona]]]
+    ) -> Optional[Persona]:
+        """Выполнить загрузку один раз для всех одновременных промахов"""
+        task = self._inflight.get(flight_key)
+        if task is None:
+            task = asyncio.ensure_future(loader())
+            self._inflight[flight_key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(flight_key, None))
+        # shield: отмена одного ожидающего не отменяет загрузку для остальных
+        return await asyncio.shield(task)
+
+    async def _load_by_id(self, persona_id: int) -> Optional[Persona]:
+        """Загрузить персонажа по ID из базы"""
+        async with async_session_maker() as session:
+            return self._store(await get_persona_by_id(session, persona_id))
+
+    async def _load_by_key(self, key: str) -> Optional[Persona]:
+        """Загрузить активного персонажа по ключу из базы"""
+        async with async_session_maker() as session:
+            return self._store(await get_persona_by_key(session, key))
+
+    async def get_by_id(
+        self, persona_id: int, min_version: Optional[int] = None
+    ) -> Optional[Persona]:
+        """Получить персонажа по ID (не старше версии min_version, если она указана)"""
+        persona = self._get_fresh(persona_id)
+        if persona is not None and min_version is not None and persona.version < min_version:
+            # Инвалидация не дошла: вызывающий код уже видел версию новее
+            self._evict(persona_id)
+            persona = None
+        if persona is not None:
+            self.hits += 1
+            return persona
+        self.misses += 1
+        return await self._single_flight(
+            ("id", persona_id), lambda: self._load_by_id(persona_id)
+        )
+
+    async def get_by_key(self, key: str) -> Optional[Persona]:
+        """Получить активного персонажа по ключу"""
+        persona = self._get_fresh(self._id_by_key.get(key))
+        if persona is not None and persona.is_active:
+            self.hits += 1
+            return persona
+        self.misses += 1
+        return await self._single_flight(
+            ("key", key), lambda: self._load_by_key(key)
+        )
+
+    async def get_user_current_persona(
+        self, session: AsyncSession, user_id: int
+    ) -> Optional[Persona]:
+        """
+        Получить текущего персонажа пользователя.
+
+        Из базы читаются только ID и версия текущего персонажа, сама строка
+        персонажа берется из кэша (если ее версия не старше).
+        """
+        current = await get_user_current_persona_version(session, user_id)
+        if current is None:
+            return None
+        persona_id, version = current
+        return await self.get_by_id(persona_id, version)
+
+    def invalidate(
+        self, persona_id: Optional[int] = None, version: Optional[int] = None
+    ) -> None:
+        """Инвалидировать запись (или весь кэш) в текущем процессе"""
+        if persona_id is None:
+            self._by_id.clear()
+            self._id_by_key.clear()
+            logger.info("🧹 Кэш персонажей очищен")
+            return
+        entry = self._by_id.get(persona_id)
+        if entry is None:
+            return
+        if version is not None and entry[0].version >= version:
+            # В кэше уже актуальная версия
+            return
+        self._evict(persona_id)
+        logger.info(f"🧹 Персонаж {persona_id} удален из кэша (версия {version})")
+
+    @staticmethod
+    async def publish_invalidation(
+        redis, persona_id: Optional[int] = None, version: Optional[int] = None
+    ) -> None:
+        """Разослать инвалидацию всем процессам (бот, воркеры)"""
+        await redis.publish(
+            PERSONA_INVALIDATION_CHANNEL,
+            json.dumps({"persona_id": persona_id, "version": version})
+        )
+
+    def _handle_invalidation(self, data: str) -> None:
+        """Применить сообщение инвалидации из Redis"""
+        try:
+            payload = json.loads(data)
+            self.invalidate(payload.get("persona_id"), payload.get("version"))
+        except (json.JSONDecodeError, AttributeError) as e:
+            logger.error(f"Некорректное сообщение инвалидации персонажа: {data!r} ({e})")
+
+    async def _listen(self, redis) -> None:
+        """Слушать канал инвалидации, переподключаясь при ошибках"""
+        while True:
+            pubsub = redis.pubsub()
+            try:
+                await pubsub.subscribe(PERSONA_INVALIDATION_CHANNEL)
+                # После (пере)подключения сообщения могли быть пропущены
+                self.invalidate()
+                async for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        self._handle_invalidation(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка подписки на инвалидацию персонажей: {e}")
+                await asyncio.sleep(5)
+            finally:
+                try:
+                    await pubsub.close()
+                except Exception:
+                    pass
+
+    def start_listener(self, redis) -> None:
+        """Запустить фоновую подписку на инвалидацию (redis - клиент redis.asyncio)"""
+        if self._listener_task is None:
+            self._listener_task = asyncio.create_task(self._listen(redis))
+            logger.info("👂 Подписка на инвалидацию кэша персонажей запущена")
+
+    async def stop_listener(self) -> None:
+        """Остановить подписку на инвалидацию"""
+        if self._listener_task is not None:
+            self._listener_task.cancel()
+            try:
+                await self._listener_task
+            except asyncio.CancelledError:
+                pass
+            self._listener_task = None
+
+
+# Глобальный экземпляр кэша персонажей
+persona_cache = PersonaCache()
+
+
+async def _publish_from_cli(persona_id: Optional[int], version: Optional[int]) -> None:
+    """Опубликовать инвалидацию из командной строки"""
+    from redis_client import redis_client
+    await redis_client.connect()
+    try:
+        await PersonaCache.publish_invalidation(redis_client.redis, persona_id, version)
+        logger.info(f"📣 Инвалидация опубликована: persona_id={persona_id}, version={version}")
+    finally:
+        await redis_client.disconnect()
+
+
+if __name__ == "__main__":
+    # Запускать после изменения таблицы personas, например:
+    #   python persona_cache.py --persona-id 3 --version 2
+    #   python persona_cache.py            (сбросить весь кэш)
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Инвалидация кэша персонажей")
+    parser.add_argument("--persona-id", type=int, default=None)
+    parser.add_argument("--version", type=int, default=None)
+    args = parser.parse_args()
+    asyncio.run(_publish_from_cli(args.persona_id, args.version))
@@ -0,0 +1,30 @@
+"""
+Транспорты очередей QueueClient: RabbitMQ, Redis Streams, память процесса
+"""
+from typing import List
+
+from .base import IncomingMessage, MessageHandler, QueueBackend
+
+BACKENDS = ("rabbitmq", "redis", "memory")
+
+
+def create_backend(name: str, retry_delays: List[float]) -> QueueBackend:
+    """
+    Транспорт по имени (QUEUE_BACKEND).
+
+    Модули импортируются по требованию: для Redis Streams и очередей в
+    памяти aio-pika не нужен.
+    """
+    if name == "rabbitmq":
+        from .rabbitmq import RabbitMQBackend
+        return RabbitMQBackend(retry_delays)
+    if name == "redis":
+        from .redis_streams import RedisStreamsBackend
+        return RedisStreamsBackend(retry_delays)
+    if name == "memory":
+        from .memory import MemoryBackend
+        return MemoryBackend(retry_delays)
+    raise ValueError(f"Неизвестный транспорт очередей: {name} (доступны: {', '.join(BACKENDS)})")
+
+
+__all__ = ["BACKENDS", "IncomingMessage", "MessageHandler", "QueueBackend", "create_backend"]
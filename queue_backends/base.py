@@ -0,0 +1,126 @@
+"""
+Интерфейс транспорта очередей
+"""
+from abc import ABC, abstractmethod
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+
+class IncomingMessage(ABC):
+    """
+    Полученное сообщение.
+
+    Обработчик обязан завершить его ровно одним вызовом ack() или nack().
+    Неподтвержденное сообщение транспорт выдаст повторно (при разрыве
+    соединения RabbitMQ, по таймауту простоя в Redis Streams).
+    """
+
+    def __init__(
+        self,
+        body: bytes,
+        headers: Optional[Dict[str, Any]],
+        queue: str,
+        persistent: bool = True
+    ):
+        self.body = body
+        self.headers: Dict[str, Any] = dict(headers or {})
+        self.queue = queue
+        self.persistent = persistent
+
+    @abstractmethod
+    async def ack(self) -> None:
+        """Подтвердить обработку: сообщение удаляется из очереди"""
+
+    @abstractmethod
+    async def nack(self, requeue: bool = True) -> None:
+        """Отказаться от сообщения: вернуть в очередь (requeue) или удалить"""
+
+
+MessageHandler = Callable[[IncomingMessage], Awaitable[None]]
+
+
+class QueueBackend(ABC):
+    """
+    Транспорт очередей для QueueClient.
+
+    Очереди - именованные, с конкурирующими потребителями: сообщение
+    получает один потребитель из группы (consumer group). Транспорт
+    отвечает за доставку, подтверждения, повторную выдачу
+    неподтвержденных сообщений и отложенную публикацию для повторов;
+    формат сообщений, полосы тарифов и политика повторов - в QueueClient.
+    """
+
+    name = "base"
+
+    def __init__(self, retry_delays: List[float]):
+        # Задержка перед попыткой N + 1 - retry_delays[N - 1] (секунды)
+        self.retry_delays = retry_delays
+
+    @abstractmethod
+    async def connect(self, queues: Iterable[str], retry_queues: Iterable[str] = ()) -> None:
+        """
+        Подключиться и подготовить очереди.
+
+        Для retry_queues дополнительно готовится отложенная публикация
+        (publish_retry).
+        """
+
+    @abstractmethod
+    async def close(self) -> None:
+        """Остановить потребителей и закрыть соединение"""
+
+    @property
+    @abstractmethod
+    def connected(self) -> bool:
+        """Соединение открыто"""
+
+    @abstractmethod
+    async def publish(
+        self,
+        queue: str,
+        body: bytes,
+        headers: Optional[Dict[str, Any]] = None,
+        persistent: bool = True
+    ) -> None:
+        """Опубликовать сообщение; возвращается после подтверждения транспорта"""
+
+    @abstractmethod
+    async def publish_retry(
+        self,
+        queue: str,
+        body: bytes,
+        headers: Dict[str, Any],
+        persistent: bool,
+        attempt: int
+    ) -> None:
+        """
+        Опубликовать сообщение, которое станет доступно в queue через
+        retry_delays[attempt - 1] секунд
+        """
+
+    @abstractmethod
+    async def consume(
+        self,
+        queue: str,
+        handler: MessageHandler,
+        prefetch_count: int,
+        group: str
+    ) -> None:
+        """
+        Начать потребление queue в группе group.
+
+        handler вызывается в отдельной задаче на каждое сообщение, не
+        больше prefetch_count одновременно. Метод возвращается сразу после
+        регистрации потребителя.
+        """
+
+    @abstractmethod
+    async def stop_consuming(self) -> None:
+        """Остановить всех потребителей процесса (без закрытия соединения)"""
+
+    @abstractmethod
+    async def get(self, queue: str, group: str) -> Optional[IncomingMessage]:
+        """Забрать одно сообщение (None, если очередь пуста)"""
+
+    @abstractmethod
+    async def depth(self, queue: str) -> int:
+        """Число сообщений, ожидающих в очереди"""
@@ -0,0 +1,176 @@
+"""
+Транспорт очередей в памяти процесса (asyncio.Queue)
+"""
+import asyncio
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from .base import IncomingMessage, MessageHandler, QueueBackend
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryMessage(IncomingMessage):
+    """Сообщение очереди в памяти"""
+
+    def __init__(
+        self,
+        backend: "MemoryBackend",
+        body: bytes,
+        headers: Optional[Dict[str, Any]],
+        queue: str,
+        persistent: bool
+    ):
+        super().__init__(body, headers, queue, persistent)
+        self._backend = backend
+        self._done = False
+
+    async def ack(self) -> None:
+        self._done = True
+
+    async def nack(self, requeue: bool = True) -> None:
+        if self._done:
+            return
+        self._done = True
+        if requeue:
+            self._backend._put(self.queue, self.body, self.headers, self.persistent)
+
+
+class MemoryBackend(QueueBackend):
+    """
+    Очереди в памяти процесса: для тестов и режима одного узла, когда бот
+    и LLM воркер работают в одном процессе (см. main.py).
+
+    Все потребители очереди - одна группа, параметр group не используется.
+    Сообщения теряются при остановке процесса; повторы откладываются
+    таймером цикла событий.
+    """
+
+    name = "memory"
+
+    def __init__(self, retry_delays: List[float]):
+        super().__init__(retry_delays)
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._consumers: List[asyncio.Task] = []
+        self._handlers: Set[asyncio.Task] = set()
+        self._timers: Set[asyncio.TimerHandle] = set()
+        self._connected = False
+
+    @property
+    def connected(self) -> bool:
+        return self._connected
+
+    def _queue(self, queue: str) -> asyncio.Queue:
+        if queue not in self._queues:
+            self._queues[queue] = asyncio.Queue()
+        return self._queues[queue]
+
+    def _put(
+        self,
+        queue: str,
+        body: bytes,
+        headers: Optional[Dict[str, Any]],
+        persistent: bool
+    ) -> None:
+        self._queue(queue).put_nowait(MemoryMessage(self, body, headers, queue, persistent))
+
+    async def connect(self, queues: Iterable[str], retry_queues: Iterable[str] = ()) -> None:
+        for queue in queues:
+            self._queue(queue)
+        self._connected = True
+        logger.info("✅ Очереди в памяти процесса готовы")
+
+    async def close(self) -> None:
+        await self.stop_consuming()
+        for timer in self._timers:
+            timer.cancel()
+        self._timers.clear()
+        self._connected = False
+
+    async def publish(
+        self,
+        queue: str,
+        body: bytes,
+        headers: Optional[Dict[str, Any]] = None,
+        persistent: bool = True
+    ) -> None:
+        self._put(queue, body, headers, persistent)
+
+    async def publish_retry(
+        self,
+        queue: str,
+        body: bytes,
+        headers: Dict[str, Any],
+        persistent: bool,
+        attempt: int
+    ) -> None:
+        def put():
+            self._timers.discard(timer)
+            self._put(queue, body, headers, persistent)
+
+        timer = asyncio.get_running_loop().call_later(
+            self.retry_delays[attempt - 1], put
+        )
+        self._timers.add(timer)
+
+    async def consume(
+        self,
+        queue: str,
+        handler: MessageHandler,
+        prefetch_count: int,
+        group: str
+    ) -> None:
+        self._consumers.append(
+            asyncio.create_task(self._consume_loop(self._queue(queue), handler, prefetch_count))
+        )
+
+    async def _consume_loop(
+        self,
+        queue: asyncio.Queue,
+        handler: MessageHandler,
+        prefetch_count: int
+    ) -> None:
+        slots = asyncio.Semaphore(prefetch_count)
+
+        async def run(message: MemoryMessage) -> None:
+            try:
+                await handler(message)
+            except Exception as e:
+                logger.error(f"Ошибка обработчика сообщения {message.queue}: {e}")
+                # Как при разрыве соединения с брокером: сообщение без
+                # подтверждения возвращается в очередь
+                await message.nack(requeue=True)
+            finally:
+                slots.release()
+
+        while True:
+            # Слот занимается до извлечения: сообщение, которое некому
+            # обработать, остается в очереди
+            await slots.acquire()
+            try:
+                message = await queue.get()
+            except asyncio.CancelledError:
+                slots.release()
+                raise
+            task = asyncio.create_task(run(message))
+            self._handlers.add(task)
+            task.add_done_callback(self._handlers.discard)
+
+    async def stop_consuming(self) -> None:
+        consumers, self._consumers = self._consumers, []
+        for task in consumers:
+            task.cancel()
+        for task in consumers:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def get(self, queue: str, group: str) -> Optional[IncomingMessage]:
+        try:
+            return self._queue(queue).get_nowait()
+        except asyncio.QueueEmpty:
+            return None
+
+    async def depth(self, queue: str) -> int:
+        return self._queue(queue).qsize()
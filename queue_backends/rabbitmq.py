@@ -0,0 +1,217 @@
+"""
+Транспорт очередей на RabbitMQ (aio-pika)
+"""
+import asyncio
+import logging
+from typing import Any, Dict, Iterable, List, Optional
+
+import aio_pika
+from aio_pika import Channel, Message, Queue
+from aio_pika.abc import AbstractRobustConnection
+
+from config import (RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_USER,
+                    RABBITMQ_PASSWORD, RABBITMQ_VHOST,
+                    QUEUE_PUBLISH_CHANNELS, QUEUE_CONFIRM_TIMEOUT)
+from .base import IncomingMessage, MessageHandler, QueueBackend
+
+logger = logging.getLogger(__name__)
+
+
+def retry_queue_name(queue: str, attempt: int) -> str:
+    """
+    Очередь задержки перед попыткой attempt + 1.
+
+    Сообщения лежат в ней retry_delays[attempt - 1] секунд (TTL очереди),
+    затем RabbitMQ перекладывает их обратно в queue (dead-letter на
+    default exchange).
+    """
+    return f"{queue}.retry.{attempt}"
+
+
+def _delivery_mode(persistent: bool) -> aio_pika.DeliveryMode:
+    return (
+        aio_pika.DeliveryMode.PERSISTENT if persistent
+        else aio_pika.DeliveryMode.NOT_PERSISTENT
+    )
+
+
+class RabbitMQMessage(IncomingMessage):
+    """Сообщение aio-pika"""
+
+    def __init__(self, message: aio_pika.IncomingMessage, queue: str):
+        super().__init__(
+            message.body,
+            message.headers,
+            queue,
+            message.delivery_mode != aio_pika.DeliveryMode.NOT_PERSISTENT
+        )
+        self._message = message
+
+    async def ack(self) -> None:
+        await self._message.ack()
+
+    async def nack(self, requeue: bool = True) -> None:
+        await self._message.nack(requeue=requeue)
+
+
+class RabbitMQBackend(QueueBackend):
+    """
+    RabbitMQ: durable очереди на default exchange, публикация через пул
+    каналов с publisher confirms, повторы - через очереди задержки с TTL.
+
+    Группа потребителей в RabbitMQ - это сама очередь: все потребители
+    очереди конкурируют за сообщения, параметр group не используется.
+    """
+
+    name = "rabbitmq"
+
+    def __init__(self, retry_delays: List[float]):
+        super().__init__(retry_delays)
+        self.connection: Optional[AbstractRobustConnection] = None
+        self.channel: Optional[Channel] = None
+        self._consumers: List[tuple] = []
+        # Каналы публикации с подтверждениями (publisher confirms)
+        self._publish_channels: List[Channel] = []
+        self._publish_index = 0
+        self._publish_lock = asyncio.Lock()
+
+    @property
+    def connected(self) -> bool:
+        return bool(self.connection and not self.connection.is_closed)
+
+    async def connect(self, queues: Iterable[str], retry_queues: Iterable[str] = ()) -> None:
+        logger.info(f"🔗 Подключаемся к RabbitMQ: {RABBITMQ_HOST}:{RABBITMQ_PORT}")
+        logger.info(f"📊 RabbitMQ конфигурация: user={RABBITMQ_USER}, vhost={RABBITMQ_VHOST}")
+
+        # Создаем URL подключения
+        rabbitmq_url = (
+            f"amqp://{RABBITMQ_USER}:{RABBITMQ_PASSWORD}"
+            f"@{RABBITMQ_HOST}:{RABBITMQ_PORT}/{RABBITMQ_VHOST}"
+        )
+
+        # Подключаемся к RabbitMQ с robust connection (автоматическое переподключение)
+        self.connection = await aio_pika.connect_robust(
+            rabbitmq_url,
+            timeout=30,
+            heartbeat=600
+        )
+
+        # Создаем канал
+        self.channel = await self.connection.channel()
+
+        # Объявляем очереди
+        for queue in queues:
+            await self.channel.declare_queue(queue, durable=True)
+        for queue in retry_queues:
+            for attempt, delay in enumerate(self.retry_delays, start=1):
+                await self.channel.declare_queue(
+                    retry_queue_name(queue, attempt),
+                    durable=True,
+                    arguments={
+                        "x-message-ttl": int(delay * 1000),
+                        "x-dead-letter-exchange": "",
+                        "x-dead-letter-routing-key": queue,
+                    }
+                )
+
+        logger.info("✅ RabbitMQ подключение установлено успешно!")
+
+    async def close(self) -> None:
+        self._publish_channels = []
+        if self.connection and not self.connection.is_closed:
+            await self.connection.close()
+            logger.info("Соединение с RabbitMQ закрыто")
+
+    async def _get_publish_channel(self) -> Channel:
+        """
+        Канал из пула публикации (по кругу).
+
+        Каналы открываются при первой публикации и используются совместно:
+        публикации не держат канал эксклюзивно, поэтому несколько
+        неподтвержденных сообщений идут по одному каналу конвейером.
+        """
+        if not self._publish_channels:
+            async with self._publish_lock:
+                if not self._publish_channels:
+                    if not self.connected:
+                        raise Exception("Соединение с RabbitMQ не открыто")
+                    self._publish_channels = [
+                        await self.connection.channel(publisher_confirms=True)
+                        for _ in range(QUEUE_PUBLISH_CHANNELS)
+                    ]
+        self._publish_index = (self._publish_index + 1) % len(self._publish_channels)
+        return self._publish_channels[self._publish_index]
+
+    async def _send(
+        self,
+        routing_key: str,
+        body: bytes,
+        headers: Optional[Dict[str, Any]],
+        persistent: bool
+    ) -> None:
+        channel = await self._get_publish_channel()
+        # На канале с publisher confirms publish завершается после
+        # подтверждения брокера
+        await channel.default_exchange.publish(
+            Message(body, headers=headers or None, delivery_mode=_delivery_mode(persistent)),
+            routing_key=routing_key,
+            timeout=QUEUE_CONFIRM_TIMEOUT
+        )
+
+    async def publish(
+        self,
+        queue: str,
+        body: bytes,
+        headers: Optional[Dict[str, Any]] = None,
+        persistent: bool = True
+    ) -> None:
+        await self._send(queue, body, headers, persistent)
+
+    async def publish_retry(
+        self,
+        queue: str,
+        body: bytes,
+        headers: Dict[str, Any],
+        persistent: bool,
+        attempt: int
+    ) -> None:
+        await self._send(retry_queue_name(queue, attempt), body, headers, persistent)
+
+    async def consume(
+        self,
+        queue: str,
+        handler: MessageHandler,
+        prefetch_count: int,
+        group: str
+    ) -> None:
+        if not self.connected:
+            raise Exception("Соединение с RabbitMQ не открыто")
+
+        async def on_message(message: aio_pika.IncomingMessage):
+            await handler(RabbitMQMessage(message, queue))
+
+        # Отдельный канал на очередь: prefetch считается на канал
+        channel = await self.connection.channel()
+        await channel.set_qos(prefetch_count=prefetch_count)
+        amqp_queue: Queue = await channel.get_queue(queue)
+        consumer_tag = await amqp_queue.consume(on_message)
+        self._consumers.append((channel, amqp_queue, consumer_tag))
+
+    async def stop_consuming(self) -> None:
+        consumers, self._consumers = self._consumers, []
+        for channel, queue, consumer_tag in consumers:
+            await queue.cancel(consumer_tag)
+
+    async def get(self, queue: str, group: str) -> Optional[IncomingMessage]:
+        if not self.channel or self.channel.is_closed:
+            raise Exception("Канал RabbitMQ не открыт")
+        amqp_queue: Queue = await self.channel.get_queue(queue)
+        message = await amqp_queue.get(no_ack=False, fail=False)
+        return RabbitMQMessage(message, queue) if message else None
+
+    async def depth(self, queue: str) -> int:
+        if not self.channel or self.channel.is_closed:
+            raise Exception("Канал RabbitMQ не открыт")
+        # Пассивное объявление возвращает счетчики, не меняя очередь
+        amqp_queue = await self.channel.declare_queue(queue, passive=True)
+        return amqp_queue.declaration_result.message_count
@@ -0,0 +1,316 @@
+"""
+Транспорт очередей на Redis Streams (группы потребителей)
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import redis.asyncio as redis
+from redis.exceptions import ResponseError
+
+from config import (REDIS_HOST, REDIS_PORT, REDIS_PASSWORD,
+                    QUEUE_REDIS_DB, QUEUE_REDIS_PREFIX, QUEUE_REDIS_CLAIM_IDLE)
+from .base import IncomingMessage, MessageHandler, QueueBackend
+
+logger = logging.getLogger(__name__)
+
+# Сколько ждать новых сообщений в одном XREADGROUP (миллисекунды): не дольше
+# этого откладываются перенос созревших повторов и остановка потребителя
+BLOCK_MS = 1000
+
+# Перенос созревших отложенных сообщений (повторов) из ZSET в поток.
+# Элемент ZSET: 16 символов уникального id, заголовки JSON, "\n", тело
+PROMOTE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, member in ipairs(due) do
+    redis.call('ZREM', KEYS[1], member)
+    local sep = string.find(member, '\\n', 1, true)
+    redis.call('XADD', KEYS[2], '*',
+        'headers', string.sub(member, 17, sep - 1),
+        'body', string.sub(member, sep + 1))
+end
+return #due
+"""
+PROMOTE_BATCH = 100
+
+
+class RedisStreamMessage(IncomingMessage):
+    """Запись потока, выданная группе потребителей"""
+
+    def __init__(
+        self,
+        backend: "RedisStreamsBackend",
+        queue: str,
+        group: str,
+        entry_id: bytes,
+        fields: Dict[bytes, bytes]
+    ):
+        headers = fields.get(b"headers")
+        super().__init__(
+            fields.get(b"body", b""),
+            json.loads(headers) if headers else {},
+            queue
+        )
+        self._backend = backend
+        self._group = group
+        self._entry_id = entry_id
+        self._fields = fields
+        self._done = False
+
+    async def ack(self) -> None:
+        await self._finish(requeue=False)
+
+    async def nack(self, requeue: bool = True) -> None:
+        await self._finish(requeue=requeue)
+
+    async def _finish(self, requeue: bool) -> None:
+        if self._done:
+            return
+        key = self._backend.stream_key(self.queue)
+        # Запись удаляется из потока после подтверждения: очередь не растет,
+        # а XLEN остается числом необработанных сообщений. Возврат в очередь -
+        # новая запись в конце потока (как requeue в RabbitMQ)
+        async with self._backend.redis.pipeline(transaction=True) as pipe:
+            if requeue:
+                pipe.xadd(key, self._fields)
+            pipe.xack(key, self._group, self._entry_id)
+            pipe.xdel(key, self._entry_id)
+            await pipe.execute()
+        self._done = True
+
+
+class RedisStreamsBackend(QueueBackend):
+    """
+    Redis Streams: очередь - поток QUEUE_REDIS_PREFIX + имя, потребители -
+    группа (XREADGROUP). Сообщение, выданное потребителю и не
+    подтвержденное за QUEUE_REDIS_CLAIM_IDLE секунд (процесс упал или
+    завис), забирает другой потребитель группы (XAUTOCLAIM), поэтому этот
+    интервал должен быть больше времени обработки одного сообщения.
+    Повторы с задержкой лежат в ZSET <поток>:delayed и переносятся в поток
+    потребителями очереди, когда подходит срок.
+
+    Надежность определяется настройками персистентности Redis (AOF):
+    флаг persistent сообщений здесь не используется. Подтвержденные
+    записи удаляются, поэтому одна очередь рассчитана на одну группу.
+    """
+
+    name = "redis"
+
+    def __init__(self, retry_delays: List[float], client: Optional[redis.Redis] = None):
+        super().__init__(retry_delays)
+        self.redis: Optional[redis.Redis] = client
+        self.consumer = f"{socket.gethostname()}-{os.getpid()}"
+        self._groups: Set[Tuple[str, str]] = set()
+        self._retry_queues: Set[str] = set()
+        self._consumers: List[asyncio.Task] = []
+        # Записи, которые сейчас обрабатывает этот процесс, и их задачи
+        self._in_flight: Set[bytes] = set()
+        self._handlers: Set[asyncio.Task] = set()
+        self._promote = None
+        self._connected = False
+
+    def stream_key(self, queue: str) -> str:
+        return f"{QUEUE_REDIS_PREFIX}{queue}"
+
+    def delayed_key(self, queue: str) -> str:
+        return f"{self.stream_key(queue)}:delayed"
+
+    @property
+    def connected(self) -> bool:
+        return self._connected
+
+    async def connect(self, queues: Iterable[str], retry_queues: Iterable[str] = ()) -> None:
+        if self.redis is None:
+            logger.info(f"🔗 Подключаемся к Redis (очереди): {REDIS_HOST}:{REDIS_PORT}/{QUEUE_REDIS_DB}")
+            self.redis = redis.Redis(
+                host=REDIS_HOST,
+                port=REDIS_PORT,
+                password=REDIS_PASSWORD,
+                db=QUEUE_REDIS_DB
+            )
+        await self.redis.ping()
+        self._promote = self.redis.register_script(PROMOTE_SCRIPT)
+        self._retry_queues = set(retry_queues)
+        self._connected = True
+        logger.info("✅ Redis Streams подключение установлено успешно!")
+
+    async def close(self) -> None:
+        await self.stop_consuming()
+        self._connected = False
+        if self.redis is not None:
+            await self.redis.close()
+            self.redis = None
+            logger.info("Соединение с Redis (очереди) закрыто")
+
+    async def _ensure_group(self, queue: str, group: str) -> None:
+        """Создать группу (и поток), начиная с первой записи потока"""
+        if (queue, group) in self._groups:
+            return
+        try:
+            await self.redis.xgroup_create(self.stream_key(queue), group, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._groups.add((queue, group))
+
+    @staticmethod
+    def _fields(body: bytes, headers: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        return {"headers": json.dumps(headers or {}), "body": body}
+
+    async def publish(
+        self,
+        queue: str,
+        body: bytes,
+        headers: Optional[Dict[str, Any]] = None,
+        persistent: bool = True
+    ) -> None:
+        await self.redis.xadd(self.stream_key(queue), self._fields(body, headers))
+
+    async def publish_retry(
+        self,
+        queue: str,
+        body: bytes,
+        headers: Dict[str, Any],
+        persistent: bool,
+        attempt: int
+    ) -> None:
+        delay = self.retry_delays[attempt - 1]
+        member = os.urandom(8).hex().encode() + json.dumps(headers).encode() + b"\n" + body
+        await self.redis.zadd(self.delayed_key(queue), {member: time.time() + delay})
+
+    async def _promote_due(self, queue: str) -> None:
+        """Перенести в поток повторы, срок которых наступил"""
+        await self._promote(
+            keys=[self.delayed_key(queue), self.stream_key(queue)],
+            args=[time.time(), PROMOTE_BATCH]
+        )
+
+    async def _claim_idle(self, queue: str, group: str, count: int) -> list:
+        """Забрать записи, которые другой потребитель получил и не подтвердил"""
+        key = self.stream_key(queue)
+        result = await self.redis.xautoclaim(
+            key, group, self.consumer,
+            min_idle_time=int(QUEUE_REDIS_CLAIM_IDLE * 1000),
+            start_id="0-0", count=count
+        )
+        entries = []
+        for entry_id, fields in result[1]:
+            if entry_id in self._in_flight:
+                # Обработка этим процессом еще идет
+                continue
+            if fields:
+                entries.append((entry_id, fields))
+            else:
+                # Запись удалена, но осталась в списке ожидающих (Redis 6.2)
+                await self.redis.xack(key, group, entry_id)
+        if entries:
+            logger.warning(f"♻️ {len(entries)} неподтвержденных сообщений из {queue} выданы повторно")
+        return entries
+
+    async def _read(self, queue: str, group: str, count: int, block: Optional[int]) -> list:
+        response = await self.redis.xreadgroup(
+            group, self.consumer, {self.stream_key(queue): ">"}, count=count, block=block
+        )
+        return response[0][1] if response else []
+
+    async def consume(
+        self,
+        queue: str,
+        handler: MessageHandler,
+        prefetch_count: int,
+        group: str
+    ) -> None:
+        if not self._connected:
+            raise Exception("Соединение с Redis не открыто")
+        await self._ensure_group(queue, group)
+        self._consumers.append(
+            asyncio.create_task(self._consume_loop(queue, handler, prefetch_count, group))
+        )
+
+    async def _consume_loop(
+        self,
+        queue: str,
+        handler: MessageHandler,
+        prefetch_count: int,
+        group: str
+    ) -> None:
+        in_flight = 0
+        freed = asyncio.Event()
+        last_claim = 0.0
+
+        async def run(entry_id: bytes, fields: Dict[bytes, bytes]) -> None:
+            nonlocal in_flight
+            try:
+                await handler(RedisStreamMessage(self, queue, group, entry_id, fields))
+            except Exception as e:
+                logger.error(f"Ошибка обработчика сообщения {queue}: {e}")
+            finally:
+                self._in_flight.discard(entry_id)
+                in_flight -= 1
+                freed.set()
+
+        while True:
+            try:
+                if in_flight >= prefetch_count:
+                    freed.clear()
+                    await freed.wait()
+                    continue
+                if queue in self._retry_queues:
+                    await self._promote_due(queue)
+
+                free = prefetch_count - in_flight
+                entries = []
+                if time.monotonic() - last_claim >= QUEUE_REDIS_CLAIM_IDLE / 2:
+                    last_claim = time.monotonic()
+                    entries = await self._claim_idle(queue, group, free)
+                if not entries:
+                    entries = await self._read(queue, group, free, BLOCK_MS)
+
+                for entry_id, fields in entries:
+                    in_flight += 1
+                    self._in_flight.add(entry_id)
+                    task = asyncio.create_task(run(entry_id, fields))
+                    self._handlers.add(task)
+                    task.add_done_callback(self._handlers.discard)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка чтения очереди {queue} из Redis: {e}")
+                await asyncio.sleep(1)
+
+    async def stop_consuming(self) -> None:
+        consumers, self._consumers = self._consumers, []
+        for task in consumers:
+            task.cancel()
+        for task in consumers:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def get(self, queue: str, group: str) -> Optional[IncomingMessage]:
+        if not self._connected:
+            raise Exception("Соединение с Redis не открыто")
+        await self._ensure_group(queue, group)
+        entries = await self._claim_idle(queue, group, 1) or await self._read(queue, group, 1, None)
+        if not entries:
+            return None
+        entry_id, fields = entries[0]
+        return RedisStreamMessage(self, queue, group, entry_id, fields)
+
+    async def depth(self, queue: str) -> int:
+        if not self._connected:
+            raise Exception("Соединение с Redis не открыто")
+        # Подтвержденные записи удаляются: в потоке - ожидающие и те, что
+        # сейчас обрабатываются; вторые вычитаем
+        key = self.stream_key(queue)
+        length = await self.redis.xlen(key)
+        if not length:
+            return 0
+        groups = await self.redis.xinfo_groups(key)
+        pending = max((group.get("pending", 0) for group in groups), default=0)
+        return max(0, length - pending)
@@ -1,153 +1,571 @@
 """
-RabbitMQ асинхронный клиент для очередей сообщений
+Асинхронный клиент очередей сообщений (транспорт - QUEUE_BACKEND)
 """
 import asyncio
 import json
 import logging
-from typing import Dict, Any, Callable, Optional
-import aio_pika
-from aio_pika import Connection, Channel, Queue, Message
-from aio_pika.abc import AbstractRobustConnection
-from config import (RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_USER,
-                   RABBITMQ_PASSWORD, RABBITMQ_VHOST)
+import time
+from collections import deque
+from contextlib import nullcontext
+from typing import Any, AsyncContextManager, Awaitable, Callable, Deque, Dict, Optional, Set
+from tracing import tracer
+from queue_backends import IncomingMessage, QueueBackend, create_backend
+from config import (QUEUE_BACKEND, QUEUE_CONSUMER_GROUP,
+                   QUEUE_PREMIUM_WEIGHT, QUEUE_FREE_WEIGHT, QUEUE_PREFETCH_MULTIPLIER,
+                   QUEUE_RETRY_DELAYS, QUEUE_MAX_OUTSTANDING_PUBLISHES)
 
 logger = logging.getLogger(__name__)
 
+# Тарифы запросов (см. utils.get_request_tier) и их очереди-"полосы"
+TIER_PREMIUM = "premium"
+TIER_FREE = "free"
+REQUEST_LANES = {
+    TIER_PREMIUM: "llm_requests.premium",
+    # Бесплатный тариф остается в исходной очереди: сообщения, отправленные
+    # до обновления, обрабатываются как обычно
+    TIER_FREE: "llm_requests",
+}
+LANE_WEIGHTS = {
+    TIER_PREMIUM: QUEUE_PREMIUM_WEIGHT,
+    TIER_FREE: QUEUE_FREE_WEIGHT,
+}
+
+# Запросы, исчерпавшие попытки (см. replay_dead_letters.py)
+DEAD_LETTER_QUEUE = "llm_requests.dead"
+# Всего попыток: первая + по одной на каждую задержку повтора
+MAX_ATTEMPTS = len(QUEUE_RETRY_DELAYS) + 1
+# Заголовки сообщения с номером попытки и исходной очередью
+ATTEMPT_HEADER = "x-attempt"
+ORIGIN_QUEUE_HEADER = "x-origin-queue"
+ERROR_HEADER = "x-last-error"
+
+# Классы сообщений и их режим доставки (persistent). Запросы пользователей
+# и окончательные ответы не должны теряться при перезапуске брокера;
+# промежуточные правки потокового ответа - временные (transient): их
+# заменит следующая правка или окончательный ответ
+MESSAGE_CLASS_REQUEST = "request"
+MESSAGE_CLASS_REPLY = "reply"
+MESSAGE_CLASS_STREAM_EDIT = "stream_edit"
+DELIVERY_MODES = {
+    MESSAGE_CLASS_REQUEST: True,
+    MESSAGE_CLASS_REPLY: True,
+    MESSAGE_CLASS_STREAM_EDIT: False,
+}
+
+
+class LatencyStats:
+    """Счетчик задержек: количество, среднее и максимум (секунды)"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def to_dict(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "avg": self.total / self.count if self.count else 0.0,
+            "max": self.max
+        }
+
+
+class WeightedSlots:
+    """
+    Семафор с взвешенной очередью ожидания по полосам.
+
+    Пока есть свободные слоты, запрос любой полосы начинается сразу, поэтому
+    простаивающая полоса не занимает мощность. Когда слоты заняты,
+    освободившийся слот отдается ожидающим полосам по smooth weighted
+    round-robin: при весах 3:1 порядок P P F P ..., то есть бесплатная
+    полоса медленнее, но никогда не голодает.
+    """
+
+    def __init__(self, slots: int, weights: Dict[str, int]):
+        self.free = slots
+        self.weights = weights
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {lane: deque() for lane in weights}
+        self._current: Dict[str, int] = {lane: 0 for lane in weights}
+
+    async def acquire(self, lane: str) -> None:
+        """Занять слот для запроса полосы lane"""
+        if self.free > 0 and not any(self._waiters.values()):
+            self.free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже передан - возвращаем его
+                self.release()
+            else:
+                self._waiters[lane].remove(future)
+            raise
+
+    def release(self) -> None:
+        """Освободить слот, передав его следующей полосе по весам"""
+        lanes = [lane for lane, waiters in self._waiters.items() if waiters]
+        if not lanes:
+            self.free += 1
+            return
+        total = sum(self.weights[lane] for lane in lanes)
+        for lane in lanes:
+            self._current[lane] += self.weights[lane]
+        chosen = max(lanes, key=lambda lane: self._current[lane])
+        self._current[chosen] -= total
+        self._waiters[chosen].popleft().set_result(None)
+
 
 class QueueClient:
-    """Асинхронный клиент для работы с RabbitMQ"""
+    """
+    Асинхронный клиент очередей: полосы тарифов, повторы и dead-letter.
+
+    Доставку выполняет транспорт QUEUE_BACKEND (см. queue_backends):
+    RabbitMQ, Redis Streams или очереди в памяти процесса.
+    """
     
-    def __init__(self):
-        self.connection: Optional[AbstractRobustConnection] = None
-        self.channel: Optional[Channel] = None
-        self.queue_name = "llm_requests"
+    def __init__(self, backend: Optional[QueueBackend] = None):
+        self.backend = backend or create_backend(QUEUE_BACKEND, QUEUE_RETRY_DELAYS)
+        self.queue_name = REQUEST_LANES[TIER_FREE]
         self.response_queue = "llm_responses"
+        # Ожидание в очереди по тарифам (публикация -> начало обработки)
+        self.lane_stats = {tier: LatencyStats() for tier in REQUEST_LANES}
+        self._publish_slots = asyncio.Semaphore(QUEUE_MAX_OUTSTANDING_PUBLISHES)
+        # enqueue: ожидание свободного слота публикации,
+        # confirm: отправка -> подтверждение транспорта
+        self.publish_stats = {"enqueue": LatencyStats(), "confirm": LatencyStats()}
+        self.publish_failures = 0
+        # Задачи обработчиков сообщений, которые еще выполняются
+        self._handlers: Set[asyncio.Task] = set()
     
     async def connect(self):
-        """Подключение к RabbitMQ"""
+        """Подключение к транспорту и объявление очередей"""
+        if self.backend.connected:
+            # Бот и воркер в одном процессе (QUEUE_BACKEND=memory)
+            return
         try:
-            logger.info(f"🔗 Подключаемся к RabbitMQ: {RABBITMQ_HOST}:{RABBITMQ_PORT}")
-            logger.info(f"📊 RabbitMQ конфигурация: user={RABBITMQ_USER}, vhost={RABBITMQ_VHOST}")
-            
-            # Создаем URL подключения
-            rabbitmq_url = (
-                f"amqp://{RABBITMQ_USER}:{RABBITMQ_PASSWORD}"
-                f"@{RABBITMQ_HOST}:{RABBITMQ_PORT}/{RABBITMQ_VHOST}"
+            await self.backend.connect(
+                [*REQUEST_LANES.values(), DEAD_LETTER_QUEUE, self.response_queue],
+                retry_queues=REQUEST_LANES.values()
             )
-            
-            # Подключаемся к RabbitMQ с robust connection (автоматическое переподключение)
-            self.connection = await aio_pika.connect_robust(
-                rabbitmq_url,
-                timeout=30,
-                heartbeat=600
+            logger.info(
+                f"📋 Очереди ({self.backend.name}): {', '.join(REQUEST_LANES.values())}, "
+                f"{self.response_queue}"
             )
-            
-            # Создаем канал
-            self.channel = await self.connection.channel()
-            
-            # Объявляем очереди
-            await self.channel.declare_queue(self.queue_name, durable=True)
-            await self.channel.declare_queue(self.response_queue, durable=True)
-            
-            logger.info("✅ RabbitMQ подключение установлено успешно!")
-            logger.info(f"📋 Созданы очереди: {self.queue_name}, {self.response_queue}")
-            
         except Exception as e:
-            logger.error(f"Ошибка подключения к RabbitMQ: {e}")
+            logger.error(f"Ошибка подключения к очередям ({self.backend.name}): {e}")
             raise
     
     async def disconnect(self):
-        """Отключение от RabbitMQ"""
+        """Отключение от транспорта"""
+        if not self.backend.connected:
+            return
+        if self.publish_stats["confirm"].count:
+            logger.info(f"📊 Публикация в очередь: {self.get_publish_stats()}")
         try:
-            if self.connection and not self.connection.is_closed:
-                await self.connection.close()
-                logger.info("Соединение с RabbitMQ закрыто")
+            await self.backend.close()
         except Exception as e:
-            logger.error(f"Ошибка отключения от RabbitMQ: {e}")
+            logger.error(f"Ошибка отключения от очередей ({self.backend.name}): {e}")
     
-    async def publish_message(self, message: Dict[str, Any]) -> None:
-        """Отправить сообщение в очередь"""
+    async def _publish(
+        self,
+        body: Dict[str, Any],
+        queue: str,
+        persistent: bool
+    ) -> float:
+        """
+        Опубликовать сообщение и дождаться подтверждения транспорта.
+
+        Одновременно ожидают подтверждения не больше
+        QUEUE_MAX_OUTSTANDING_PUBLISHES публикаций. Возвращает время
+        подтверждения в секундах.
+        """
+        started = time.perf_counter()
+        with tracer.span("queue.publish", queue=queue) as span:
+            # Потребитель продолжит трассу с этого участка
+            body = tracer.inject({**body})
+            async with self._publish_slots:
+                sent = time.perf_counter()
+                self.publish_stats["enqueue"].record(sent - started)
+                
+                await self.backend.publish(queue, json.dumps(body).encode(), persistent=persistent)
+                confirm = time.perf_counter() - sent
+                self.publish_stats["confirm"].record(confirm)
+            span.set_attribute("confirm_seconds", confirm)
+        return confirm
+    
+    async def publish_message(
+        self,
+        message: Dict[str, Any],
+        message_class: str = MESSAGE_CLASS_REQUEST
+    ) -> None:
+        """
+        Отправить запрос в очередь и дождаться подтверждения транспорта.
+
+        Очередь выбирается по полю "tier" (premium/free, по умолчанию free),
+        в сообщение добавляется время публикации "enqueued_at" для замера
+        ожидания в очереди. Режим доставки задается классом сообщения
+        (DELIVERY_MODES).
+        """
         try:
-            if not self.channel or self.channel.is_closed:
-                raise Exception("Канал RabbitMQ не открыт")
+            tier = message.get("tier") if message.get("tier") in REQUEST_LANES else TIER_FREE
+            message = {**message, "tier": tier, "enqueued_at": time.time()}
             
-            # Создаем сообщение
-            message_body = json.dumps(message).encode()
-            aio_message = Message(
-                message_body,
-                delivery_mode=aio_pika.DeliveryMode.PERSISTENT
+            confirm = await self._publish(
+                message,
+                REQUEST_LANES[tier],
+                DELIVERY_MODES.get(message_class, True)
             )
             
-            # Отправляем сообщение в очередь
-            await self.channel.default_exchange.publish(
-                aio_message,
-                routing_key=self.queue_name
+            logger.info(
+                f"Сообщение отправлено в очередь {REQUEST_LANES[tier]}: "
+                f"{message.get('user_id')} (подтверждено за {confirm * 1000:.1f}мс)"
             )
             
-            logger.info(f"Сообщение отправлено в очередь: {message.get('user_id')}")
-            
         except Exception as e:
+            self.publish_failures += 1
             logger.error(f"Ошибка отправки сообщения в очередь: {e}")
             raise
     
-    async def consume_requests(self, callback: Callable[[Dict[str, Any]], None]) -> None:
-        """Прослушивать запросы из очереди"""
+    async def publish_response(
+        self,
+        action: Dict[str, Any],
+        message_class: str = MESSAGE_CLASS_REPLY
+    ) -> None:
+        """Отправить действие доставки (см. delivery.py) в очередь llm_responses"""
         try:
-            if not self.channel or self.channel.is_closed:
-                raise Exception("Канал RabbitMQ не открыт")
+            await self._publish(
+                action, self.response_queue, DELIVERY_MODES.get(message_class, True)
+            )
+        except Exception as e:
+            self.publish_failures += 1
+            logger.error(f"Ошибка отправки ответа в очередь: {e}")
+            raise
+    
+    def get_publish_stats(self) -> Dict[str, Any]:
+        """Задержки публикации: ожидание слота и подтверждение транспорта"""
+        return {
+            **{name: stats.to_dict() for name, stats in self.publish_stats.items()},
+            "failures": self.publish_failures
+        }
+    
+    async def _wait_until_cancelled(self) -> None:
+        """Поддерживать работу воркера до отмены задачи потребления"""
+        try:
+            while True:
+                await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            logger.info("Получен сигнал остановки потребления")
+            # Останавливаем потребление
+            await self.stop_consuming()
+    
+    async def consume_requests(
+        self,
+        callback: Callable[[Dict[str, Any]], None],
+        prefetch_count: int = 1,
+        ordering: Optional[Callable[[Dict[str, Any]], AsyncContextManager]] = None
+    ) -> None:
+        """
+        Прослушивать запросы из всех полос.
+
+        prefetch_count - сколько запросов обрабатывается одновременно.
+        Транспорт вызывает обработчик для каждого сообщения в отдельной
+        задаче, а слоты обработки распределяются между полосами по весам
+        (WeightedSlots).
+
+        ordering(body) - контекст упорядочивания (например, блокировка
+        пользователя): он захватывается до слота обработки, поэтому
+        запросы, ждущие своей очереди, слоты не занимают. Из транспорта
+        тогда заранее читается prefetch_count * QUEUE_PREFETCH_MULTIPLIER
+        запросов на полосу, чтобы ожидающие не закрывали окно другим
+        пользователям.
+        """
+        try:
+            if not self.backend.connected:
+                raise Exception(f"Нет подключения к очередям ({self.backend.name})")
             
-            # Получаем очередь
-            queue: Queue = await self.channel.get_queue(self.queue_name)
+            slots = WeightedSlots(prefetch_count, LANE_WEIGHTS)
             
-            async def on_message(message: aio_pika.IncomingMessage):
-                async with message.process():
+            def make_handler(tier: str):
+                lane_queue = REQUEST_LANES[tier]
+                
+                async def process(message: IncomingMessage):
                     try:
-                        # Декодируем сообщение
                         body = json.loads(message.body.decode())
-                        
-                        # Вызываем callback
-                        if asyncio.iscoroutinefunction(callback):
-                            await callback(body)
-                        else:
-                            callback(body)
+                    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+                        # Повтор не поможет - сразу в dead-letter
+                        logger.error(f"Некорректное сообщение в очереди: {e}")
+                        await self._dead_letter(message, lane_queue, 1, e)
+                        return
+                    
+                    attempt = int(message.headers.get(ATTEMPT_HEADER, 1))
+                    body["attempt"] = attempt
+                    body["max_attempts"] = MAX_ATTEMPTS
+                    
+                    ordering_started = time.perf_counter()
+                    async with ordering(body) if ordering else nullcontext():
+                        body["ordering_wait"] = time.perf_counter() - ordering_started
+                        await slots.acquire(tier)
+                        try:
+                            enqueued_at = body.get("enqueued_at")
+                            if enqueued_at:
+                                wait = max(0.0, time.time() - enqueued_at)
+                                body["queue_wait"] = wait
+                                self.lane_stats[tier].record(wait)
                             
+                            # Вызываем callback
+                            if asyncio.iscoroutinefunction(callback):
+                                await callback(body)
+                            else:
+                                callback(body)
+                        except Exception as e:
+                            # Исключение из callback - временная ошибка:
+                            # повторяем с задержкой, после MAX_ATTEMPTS - в dead-letter
+                            await self._retry_or_dead_letter(message, lane_queue, attempt, e)
+                        finally:
+                            slots.release()
+                
+                async def on_message(message: IncomingMessage):
+                    self._track_handler()
+                    try:
+                        await process(message)
                     except Exception as e:
-                        logger.error(f"Ошибка обработки сообщения: {e}")
-            
-            # Настраиваем потребление сообщений
-            await self.channel.set_qos(prefetch_count=1)
-            consumer_tag = await queue.consume(on_message)
+                        # Не удалось даже переложить сообщение в очередь
+                        # повтора - возвращаем его в исходную очередь
+                        logger.error(f"Ошибка обработки сообщения из {lane_queue}: {e}")
+                        await message.nack(requeue=True)
+                    else:
+                        await message.ack()
+                return on_message
             
-            logger.info("Начинаем прослушивание запросов...")
+            # Отдельный потребитель на полосу: prefetch считается на
+            # потребителя, и каждая полоса может заполнить все слоты, если
+            # другая пуста
+            lane_prefetch = prefetch_count * (QUEUE_PREFETCH_MULTIPLIER if ordering else 1)
+            for tier, lane_queue in REQUEST_LANES.items():
+                await self.backend.consume(
+                    lane_queue, make_handler(tier), lane_prefetch, QUEUE_CONSUMER_GROUP
+                )
             
-            # Сохраняем consumer_tag для возможности остановки
-            self._consumer_tag = consumer_tag
+            logger.info(
+                f"Начинаем прослушивание запросов (prefetch={prefetch_count}, "
+                f"веса полос: {LANE_WEIGHTS}, транспорт: {self.backend.name})..."
+            )
             
             # Бесконечный цикл для поддержания работы воркера
-            try:
-                while True:
-                    await asyncio.sleep(1)
-            except asyncio.CancelledError:
-                logger.info("Получен сигнал остановки потребления")
-                # Останавливаем потребление
-                if hasattr(self, '_consumer_tag') and self._consumer_tag:
-                    await queue.cancel(self._consumer_tag)
+            await self._wait_until_cancelled()
             
         except Exception as e:
             logger.error(f"Ошибка потребления сообщений: {e}")
             raise
     
+    async def consume_responses(
+        self,
+        callback: Callable[[Dict[str, Any]], Awaitable[None]],
+        prefetch_count: int = 1
+    ) -> None:
+        """
+        Прослушивать очередь llm_responses (для delivery_worker.py).
+
+        Сообщение подтверждается после callback; ошибки callback
+        логируются - повторы выполняет сам доставщик.
+        """
+        try:
+            if not self.backend.connected:
+                raise Exception(f"Нет подключения к очередям ({self.backend.name})")
+            
+            async def on_message(message: IncomingMessage):
+                self._track_handler()
+                try:
+                    await callback(json.loads(message.body.decode()))
+                except Exception as e:
+                    logger.error(f"Ошибка обработки ответа: {e}")
+                await message.ack()
+            
+            await self.backend.consume(
+                self.response_queue, on_message, prefetch_count, QUEUE_CONSUMER_GROUP
+            )
+            
+            logger.info(f"Начинаем прослушивание ответов (prefetch={prefetch_count})...")
+            
+            await self._wait_until_cancelled()
+            
+        except Exception as e:
+            logger.error(f"Ошибка потребления ответов: {e}")
+            raise
+    
+    def _track_handler(self) -> None:
+        """Запомнить задачу текущего обработчика (для wait_idle)"""
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        task.add_done_callback(self._handlers.discard)
+    
+    async def wait_idle(self, timeout: float) -> None:
+        """
+        Дождаться обработчиков уже полученных сообщений (после
+        stop_consuming). Не успевшие за timeout секунд отменяются: их
+        сообщения не подтверждены и вернутся в очередь.
+        """
+        pending = {task for task in self._handlers if task is not asyncio.current_task()}
+        if not pending:
+            return
+        logger.info(f"⏳ Ожидание {len(pending)} обрабатываемых сообщений (до {timeout:g}с)...")
+        _, pending = await asyncio.wait(pending, timeout=timeout)
+        if pending:
+            logger.warning(f"Не завершились за {timeout:g}с, возвращаются в очередь: {len(pending)}")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+    
     async def stop_consuming(self):
         """Остановить потребление сообщений"""
         try:
-            if hasattr(self, '_consumer_tag') and self._consumer_tag:
-                # Получаем очередь и отменяем потребление
-                queue: Queue = await self.channel.get_queue(self.queue_name)
-                await queue.cancel(self._consumer_tag)
-                self._consumer_tag = None
-                logger.info("Потребление сообщений остановлено")
+            await self.backend.stop_consuming()
+            logger.info("Потребление сообщений остановлено")
+            if any(stats.count for stats in self.lane_stats.values()):
+                logger.info(f"📊 Ожидание в очереди по тарифам: {self.get_lane_stats()}")
         except Exception as e:
             logger.error(f"Ошибка остановки потребления: {e}")
+    
+    async def _retry_or_dead_letter(
+        self,
+        message: IncomingMessage,
+        lane_queue: str,
+        attempt: int,
+        error: Exception
+    ) -> None:
+        """Переложить неудачный запрос в очередь повтора или в dead-letter"""
+        if attempt >= MAX_ATTEMPTS:
+            logger.error(
+                f"☠️ Запрос из {lane_queue} не обработан за {attempt} попыток: {error}"
+            )
+            await self._dead_letter(message, lane_queue, attempt, error)
+            return
+        
+        delay = QUEUE_RETRY_DELAYS[attempt - 1]
+        try:
+            body = json.loads(message.body.decode())
+            # Ожидание в очереди считаем от момента, когда запрос снова
+            # станет доступен воркеру
+            body["enqueued_at"] = time.time() + delay
+            payload = json.dumps(body).encode()
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            payload = message.body
+        
+        await self.backend.publish_retry(
+            lane_queue,
+            payload,
+            {
+                **message.headers,
+                ATTEMPT_HEADER: attempt + 1,
+                ORIGIN_QUEUE_HEADER: lane_queue,
+                ERROR_HEADER: str(error)[:500],
+            },
+            # Повтор - всегда persistent: запрос уже однажды не обработан
+            True,
+            attempt
+        )
+        logger.warning(
+            f"🔁 Запрос из {lane_queue} будет повторен через {delay:g}с "
+            f"(попытка {attempt + 1}/{MAX_ATTEMPTS}): {error}"
+        )
+    
+    async def _dead_letter(
+        self,
+        message: IncomingMessage,
+        lane_queue: str,
+        attempt: int,
+        error: Exception
+    ) -> None:
+        """Отправить запрос в очередь llm_requests.dead"""
+        await self.backend.publish(
+            DEAD_LETTER_QUEUE,
+            message.body,
+            {
+                **message.headers,
+                ATTEMPT_HEADER: attempt,
+                ORIGIN_QUEUE_HEADER: lane_queue,
+                ERROR_HEADER: str(error)[:500],
+            },
+            persistent=True
+        )
+    
+    async def replay_dead_letters(
+        self,
+        limit: Optional[int] = None,
+        user_id: Optional[int] = None,
+        dry_run: bool = False
+    ) -> int:
+        """
+        Вернуть запросы из llm_requests.dead в исходные очереди.
+
+        Счетчик попыток сбрасывается. Сообщения, не подходящие под фильтр
+        user_id, остаются в dead-letter. Возвращает число возвращенных
+        (при dry_run - подходящих) запросов.
+        """
+        if not self.backend.connected:
+            raise Exception(f"Нет подключения к очередям ({self.backend.name})")
+        
+        # Просматриваем только сообщения, лежавшие в очереди на момент запуска
+        total = await self.backend.depth(DEAD_LETTER_QUEUE)
+        replayed = 0
+        skipped = []
+        for _ in range(total):
+            if limit is not None and replayed >= limit:
+                break
+            message = await self.backend.get(DEAD_LETTER_QUEUE, QUEUE_CONSUMER_GROUP)
+            if message is None:
+                break
+            try:
+                body = json.loads(message.body.decode())
+            except (UnicodeDecodeError, json.JSONDecodeError):
+                body = {}
+            headers = dict(message.headers)
+            origin = headers.get(ORIGIN_QUEUE_HEADER) or REQUEST_LANES[TIER_FREE]
+            matches = user_id is None or body.get("user_id") == user_id
+            logger.info(
+                f"{'▶️' if matches else '⏭'} user_id={body.get('user_id')} "
+                f"очередь={origin} попыток={headers.get(ATTEMPT_HEADER)} "
+                f"ошибка={headers.get(ERROR_HEADER)}"
+            )
+            if not matches or dry_run:
+                skipped.append(message)
+                replayed += int(matches)
+                continue
+            
+            if body:
+                body["enqueued_at"] = time.time()
+                payload = json.dumps(body).encode()
+            else:
+                payload = message.body
+            for header in (ATTEMPT_HEADER, ERROR_HEADER, ORIGIN_QUEUE_HEADER):
+                headers.pop(header, None)
+            await self.backend.publish(origin, payload, headers, persistent=True)
+            await message.ack()
+            replayed += 1
+        
+        for message in skipped:
+            await message.nack(requeue=True)
+        return replayed
+    
+    async def get_queue_depths(self) -> Dict[str, int]:
+        """Число готовых к выдаче сообщений в полосах запросов и dead-letter"""
+        if not self.backend.connected:
+            raise Exception(f"Нет подключения к очередям ({self.backend.name})")
+        return {
+            name: await self.backend.depth(name)
+            for name in (*REQUEST_LANES.values(), DEAD_LETTER_QUEUE)
+        }
+    
+    def get_lane_stats(self) -> Dict[str, Dict[str, float]]:
+        """Время ожидания в очереди по тарифам"""
+        return {tier: stats.to_dict() for tier, stats in self.lane_stats.items()}
 
 
 # Глобальный экземпляр клиента очередей
@@ -5,9 +5,36 @@ from typing import List, Dict
 import redis.asyncio as redis
 from config import (REDIS_HOST, REDIS_PORT, REDIS_PASSWORD, 
                    CHAT_HISTORY_LIMIT, CHAT_TIMEOUT)
+from token_budget import estimate_tokens
 
 logger = logging.getLogger(__name__)
 
+# Сколько последних необработанных элементов хранится в списке dead_letter:<name>
+DEAD_LETTER_LIMIT = 10000
+
+# Записать номер, если он больше записанного (1 - записан, 0 - устарел);
+# при ARGV[3] == '1' равный номер тоже записывается. Номера - строки цифр
+# time_ns: в Lua как числа они потеряли бы точность, поэтому сравниваются
+# по длине, затем по строке
+_NEWER_SEQ_SCRIPT = """
+local last = redis.call('get', KEYS[1])
+if last and (#last > #ARGV[1] or (#last == #ARGV[1] and
+        (last > ARGV[1] or (last == ARGV[1] and ARGV[3] ~= '1')))) then
+    return 0
+end
+redis.call('set', KEYS[1], ARGV[1], 'px', ARGV[2])
+return 1
+"""
+
+
+async def set_seq_if_newer(
+    redis, key: str, seq: int, ttl: float, allow_equal: bool = False
+) -> bool:
+    """Атомарно записать номер seq (time_ns) в key, если он новее записанного"""
+    return bool(await redis.eval(
+        _NEWER_SEQ_SCRIPT, 1, key, str(seq), int(ttl * 1000), "1" if allow_equal else "0"
+    ))
+
 class RedisClient:
     """Клиент для работы с Redis"""
     
@@ -15,17 +42,21 @@ class RedisClient:
         self.redis = None
     
     async def connect(self):
-        """Подключиться к Redis"""
+        """Подключиться к Redis (повторный вызов - без нового подключения)"""
+        if self.redis is not None:
+            # Бот и воркер в одном процессе (QUEUE_BACKEND=memory)
+            return
         try:
             logger.info(f"🔗 Подключаемся к Redis: {REDIS_HOST}:{REDIS_PORT}")
-            self.redis = redis.Redis(
+            client = redis.Redis(
                 host=REDIS_HOST,
                 port=REDIS_PORT,
                 password=REDIS_PASSWORD,
                 decode_responses=True
             )
             
-            await self.redis.ping()
+            await client.ping()
+            self.redis = client
             logger.info("✅ Redis подключение установлено успешно!")
             logger.info(f"📊 Redis конфигурация: host={REDIS_HOST}, port={REDIS_PORT}")
         except Exception as e:
@@ -36,6 +67,7 @@ class RedisClient:
         """Отключиться от Redis"""
         if self.redis:
             await self.redis.close()
+            self.redis = None
             logger.info("Соединение с Redis закрыто")
     
     def _get_chat_key(self, user_id: int) -> str:
@@ -49,7 +81,10 @@ class RedisClient:
             message_data = {
                 "role": role,
                 "content": content,
-                "timestamp": time.time()
+                "timestamp": time.time(),
+                # Оценка токенов хранится вместе с сообщением, чтобы
+                # подгонка контекста под бюджет не пересчитывала ее
+                "tokens": estimate_tokens(content)
             }
             message_json = json.dumps(message_data)
             
@@ -111,6 +146,13 @@ class RedisClient:
         except Exception as e:
             logger.error(f"Ошибка получения состояния чата: {e}")
             return False
+    
+    async def push_dead_letter(self, name: str, item, reason: str) -> None:
+        """Сохранить элемент, который не удалось записать в фоне (для разбора)"""
+        key = f"dead_letter:{name}"
+        record = {"item": item, "reason": reason, "timestamp": time.time()}
+        await self.redis.lpush(key, json.dumps(record, ensure_ascii=False, default=str))
+        await self.redis.ltrim(key, 0, DEAD_LETTER_LIMIT - 1)
 
 
 # Создаем экземпляр клиента
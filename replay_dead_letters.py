@@ -0,0 +1,43 @@
+"""
+Возврат запросов из llm_requests.dead в рабочие очереди
+
+Примеры:
+    python replay_dead_letters.py --dry-run          (показать, что лежит в dead-letter)
+    python replay_dead_letters.py --limit 100
+    python replay_dead_letters.py --user-id 123456789
+"""
+import argparse
+import asyncio
+import logging
+
+from queue_client import queue_client
+
+logger = logging.getLogger(__name__)
+
+
+async def replay(limit: int, user_id: int, dry_run: bool) -> None:
+    """Вернуть запросы из dead-letter в исходные очереди"""
+    await queue_client.connect()
+    try:
+        count = await queue_client.replay_dead_letters(
+            limit=limit, user_id=user_id, dry_run=dry_run
+        )
+        if dry_run:
+            logger.info(f"🔎 Подходящих запросов в dead-letter: {count}")
+        else:
+            logger.info(f"♻️ Возвращено в очереди запросов: {count}")
+    finally:
+        await queue_client.disconnect()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Повтор запросов из llm_requests.dead")
+    parser.add_argument("--limit", type=int, default=None,
+                        help="Максимум возвращаемых запросов")
+    parser.add_argument("--user-id", type=int, default=None,
+                        help="Только запросы этого telegram_id")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Только показать запросы, ничего не менять")
+    args = parser.parse_args()
+    asyncio.run(replay(args.limit, args.user_id, args.dry_run))
@@ -0,0 +1,17 @@
+"""
+Скрипт для запуска воркера доставки ответов в Telegram
+(нужен при TELEGRAM_DELIVERY_MODE=queue)
+"""
+import asyncio
+import logging
+from delivery_worker import main
+
+if __name__ == "__main__":
+    # Настройка логирования
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    # Запуск воркера
+    asyncio.run(main())
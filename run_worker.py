@@ -1,16 +1,44 @@
 """
 Скрипт для запуска LLM воркера
+
+    python run_worker.py                 (один процесс)
+    python run_worker.py --supervisor    (супервизор: несколько процессов
+                                          с общей моделью эмбеддингов)
 """
+import argparse
 import asyncio
 import logging
-from llm_worker import main
+
+from config import SUPERVISOR_MIN_WORKERS, SUPERVISOR_MAX_WORKERS
 
 if __name__ == "__main__":
-    # Настройка логирования
+    parser = argparse.ArgumentParser(description="LLM воркер")
+    parser.add_argument(
+        "--supervisor", action="store_true",
+        help="загрузить модель один раз и запустить процессы воркера через fork"
+    )
+    parser.add_argument("--min-workers", type=int, default=SUPERVISOR_MIN_WORKERS)
+    parser.add_argument("--max-workers", type=int, default=SUPERVISOR_MAX_WORKERS)
+    args = parser.parse_args()
+    
+    # Настройка логирования (под супервизором - с pid процесса)
     logging.basicConfig(
         level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        format=(
+            '%(asctime)s - [%(process)d] %(name)s - %(levelname)s - %(message)s'
+            if args.supervisor else
+            '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        )
     )
     
-    # Запуск воркера
-    asyncio.run(main())
+    if args.supervisor:
+        from worker_supervisor import WorkerSupervisor
+        
+        supervisor = WorkerSupervisor(args.min_workers, args.max_workers)
+        supervisor.preload()
+        asyncio.run(supervisor.run())
+    else:
+        from llm_worker import main
+        
+        # Запуск воркера
+        asyncio.run(main())
@@ -0,0 +1,118 @@
+"""
+Прогрессивное редактирование сообщения Telegram при потоковом ответе LLM
+"""
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from bot_integration import TELEGRAM_MESSAGE_LIMIT
+from delivery import delivery_client, FINISH_DELIVERED
+from config import STREAM_EDIT_INTERVAL, STREAM_EDIT_MIN_CHARS
+
+logger = logging.getLogger(__name__)
+
+# Курсор в конце частичного ответа, пока генерация не завершена
+STREAM_CURSOR = " ▌"
+
+
+class StreamingMessageEditor:
+    """
+    Показывает ответ LLM по мере генерации, редактируя сообщение
+    "Печатаю ответ...".
+
+    update() вызывается на каждый фрагмент и только запоминает текст;
+    фоновая задача редактирует сообщение не чаще раза в min_interval
+    секунд, отправляя самый свежий текст (промежуточные фрагменты
+    схлопываются). Первое редактирование выполняется сразу, как только
+    накопилось min_chars символов - от этого зависит время до первого
+    видимого токена.
+    """
+
+    def __init__(
+        self,
+        chat_id: int,
+        message_id: int,
+        min_interval: float = STREAM_EDIT_INTERVAL,
+        min_chars: int = STREAM_EDIT_MIN_CHARS
+    ):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.min_interval = min_interval
+        self.min_chars = min_chars
+        self.edits = 0
+        self._text = ""
+        self._shown = ""
+        self._last_edit = 0.0
+        self._dirty = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._started_at = time.monotonic()
+        self.first_edit_latency: Optional[float] = None
+
+    def update(self, text: str) -> None:
+        """Запомнить накопленный текст ответа (без ожидания Telegram)"""
+        self._text = text
+        if len(text.strip()) < self.min_chars:
+            return
+        self._dirty.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._edit_loop())
+
+    async def _edit_loop(self) -> None:
+        """Фоновая задача, применяющая накопленные изменения с троттлингом"""
+        while True:
+            await self._dirty.wait()
+            delay = self._last_edit + self.min_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._dirty.clear()
+
+            text = self._text.strip()
+            if not text or text == self._shown:
+                continue
+            # Во время генерации показываем только то, что помещается
+            # в одно сообщение; окончательную разбивку делает finish()
+            visible = text[:TELEGRAM_MESSAGE_LIMIT - len(STREAM_CURSOR)]
+            self._last_edit = time.monotonic()
+            if await delivery_client.edit(
+                self.chat_id, self.message_id, visible + STREAM_CURSOR, intermediate=True
+            ):
+                self._shown = text
+                self.edits += 1
+                if self.first_edit_latency is None:
+                    self.first_edit_latency = self._last_edit - self._started_at
+
+    async def _stop(self) -> None:
+        """Остановить фоновое редактирование"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def finish(self, text: str) -> str:
+        """
+        Показать окончательный ответ.
+
+        Первая часть ответа записывается в сообщение "Печатаю ответ...",
+        остальные (если ответ длиннее лимита Telegram) отправляются новыми
+        сообщениями; если сообщение отредактировать нельзя, доставщик
+        отправляет ответ заново (см. delivery.ACTION_FINISH). Возвращает
+        FINISH_DELIVERED, FINISH_PARTIAL или FINISH_FAILED.
+        """
+        await self._stop()
+        result = await delivery_client.finish(self.chat_id, self.message_id, text)
+        if result != FINISH_DELIVERED:
+            return result
+        logger.info(
+            f"✏️ Потоковый ответ показан в чате {self.chat_id}: "
+            f"{self.edits} промежуточных правок, "
+            f"первая через {self.first_edit_latency or 0:.2f}с"
+        )
+        return result
+
+    async def abort(self) -> None:
+        """Прекратить редактирование без финального текста (при ошибке)"""
+        await self._stop()
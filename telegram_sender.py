@@ -0,0 +1,266 @@
+"""
+Ограничение частоты запросов к Telegram Bot API: глобальный и per-chat
+token bucket, приоритетная очередь ожидания и повтор после RetryAfter
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from tracing import tracer
+
+from config import (
+    TELEGRAM_GLOBAL_RATE,
+    TELEGRAM_CHAT_RATE,
+    TELEGRAM_CHAT_BURST,
+    TELEGRAM_SEND_QUEUE_SIZE,
+    TELEGRAM_MAX_RETRY_AFTER,
+    TELEGRAM_MAX_FLOOD_RETRIES
+)
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты (меньше - раньше)
+PRIORITY_HIGH = 0     # ответы пользователю, уведомления об оплате
+PRIORITY_NORMAL = 1   # удаление служебных сообщений и прочее
+PRIORITY_LOW = 2      # промежуточные правки потокового ответа
+
+# Приоритет по методу Bot API
+METHOD_PRIORITIES = {
+    "sendMessage": PRIORITY_HIGH,
+    "sendPhoto": PRIORITY_HIGH,
+    "sendInvoice": PRIORITY_HIGH,
+    "editMessageText": PRIORITY_LOW,
+    "deleteMessage": PRIORITY_NORMAL,
+}
+
+# Сколько бакетов чатов хранить (давно неактивные удаляются)
+MAX_CHAT_BUCKETS = 10000
+
+
+class SendQueueFull(Exception):
+    """Очередь ожидания отправки переполнена"""
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # До этого момента запросы запрещены (RetryAfter)
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def ready_at(self, now: float) -> float:
+        """Момент, когда будет доступен один токен"""
+        self._refill(now)
+        ready = now if self.tokens >= 1 else now + (1 - self.tokens) / self.rate
+        return max(ready, self.blocked_until)
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds: float) -> None:
+        """Запретить запросы на seconds секунд и обнулить запас"""
+        now = time.monotonic()
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = 0
+        self.updated = max(self.updated, now)
+
+
+class TelegramRateLimiter:
+    """
+    Планировщик запросов к Bot API.
+
+    Запрос получает разрешение, когда есть токен в глобальном бакете
+    (~30 сообщений/с на бота) и в бакете своего чата (~1 сообщение/с).
+    Ожидающие запросы выдаются по приоритету, внутри приоритета - по
+    порядку поступления; запрос чата, который еще не может отправлять, не
+    задерживает запросы других чатов. После TelegramRetryAfter бакет чата
+    (или глобальный) блокируется на указанное время. Очередь ожидания
+    ограничена: при переполнении acquire() бросает SendQueueFull.
+
+    Лимиты действуют внутри процесса: если бот, воркеры и webhook шлют
+    сообщения одновременно, TELEGRAM_GLOBAL_RATE задается как доля общего
+    лимита на процесс.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = TELEGRAM_GLOBAL_RATE,
+        chat_rate: float = TELEGRAM_CHAT_RATE,
+        chat_burst: float = TELEGRAM_CHAT_BURST,
+        max_queue: int = TELEGRAM_SEND_QUEUE_SIZE
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_queue = max_queue
+        self._chat_buckets: "OrderedDict[Any, TokenBucket]" = OrderedDict()
+        self._waiters: List[Tuple[int, int, Any, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.granted = 0
+        self.rejected = 0
+        self.retry_after_count = 0
+
+    def _chat_bucket(self, chat_id: Any) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+            if len(self._chat_buckets) > MAX_CHAT_BUCKETS:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _try_take(self, chat_id: Any, now: float) -> bool:
+        """Взять токены глобального бакета и бакета чата, если оба доступны"""
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+        if self.global_bucket.ready_at(now) > now:
+            return False
+        if chat_bucket is not None and chat_bucket.ready_at(now) > now:
+            return False
+        self.global_bucket.take(now)
+        if chat_bucket is not None:
+            chat_bucket.take(now)
+        self.granted += 1
+        return True
+
+    async def acquire(self, chat_id: Any = None, priority: int = PRIORITY_NORMAL) -> None:
+        """Дождаться разрешения на запрос в чат chat_id"""
+        if not self._waiters and self._try_take(chat_id, time.monotonic()):
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise SendQueueFull(f"В очереди отправки {len(self._waiters)} запросов")
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), chat_id, future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+        # При отмене future помечается отмененной, диспетчер ее пропустит
+        await future
+
+    def retry_after(self, chat_id: Any, seconds: float) -> None:
+        """Учесть TelegramRetryAfter: приостановить чат (или весь бот)"""
+        self.retry_after_count += 1
+        if chat_id is None:
+            self.global_bucket.block(seconds)
+        else:
+            self._chat_bucket(chat_id).block(seconds)
+        self._wakeup.set()
+
+    async def _dispatch(self) -> None:
+        """Выдавать разрешения ожидающим по приоритету"""
+        while self._waiters:
+            now = time.monotonic()
+            next_ready = None
+            blocked_chats = set()
+            remaining = []
+            for entry in sorted(self._waiters):
+                _priority, _seq, chat_id, future = entry
+                if future.done():
+                    continue
+                # Запросы одного чата выдаются по порядку
+                if chat_id in blocked_chats or not self._try_take(chat_id, now):
+                    blocked_chats.add(chat_id)
+                    ready = self.global_bucket.ready_at(now)
+                    if chat_id is not None:
+                        ready = max(ready, self._chat_bucket(chat_id).ready_at(now))
+                    next_ready = ready if next_ready is None else min(next_ready, ready)
+                    remaining.append(entry)
+                    continue
+                future.set_result(None)
+            heapq.heapify(remaining)
+            self._waiters = remaining
+            if not self._waiters:
+                break
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(), max(0.0, next_ready - time.monotonic())
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Счетчики планировщика"""
+        return {
+            "queued": len(self._waiters),
+            "granted": self.granted,
+            "rejected": self.rejected,
+            "retry_after": self.retry_after_count,
+        }
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """
+    Middleware сессии aiogram: каждый запрос бота к методу с chat_id
+    проходит через TelegramRateLimiter, а TelegramRetryAfter приводит к
+    паузе чата и повтору (если ждать не дольше TELEGRAM_MAX_RETRY_AFTER и
+    повторов было меньше TELEGRAM_MAX_FLOOD_RETRIES; иначе ошибка
+    пробрасывается вызывающему коду).
+    """
+
+    def __init__(
+        self,
+        limiter: TelegramRateLimiter,
+        max_retry_after: float = TELEGRAM_MAX_RETRY_AFTER,
+        max_retries: int = TELEGRAM_MAX_FLOOD_RETRIES
+    ):
+        self.limiter = limiter
+        self.max_retry_after = max_retry_after
+        self.max_retries = max_retries
+
+    async def __call__(self, make_request, bot: Bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        api_method = getattr(method, "__api_method__", "")
+        if chat_id is None and api_method not in METHOD_PRIORITIES:
+            # Служебные методы (getMe, getUpdates, answerCallbackQuery...)
+            # не расходуют лимит сообщений
+            return await make_request(bot, method)
+        priority = METHOD_PRIORITIES.get(api_method, PRIORITY_NORMAL)
+        with tracer.span(f"telegram.{api_method}", chat_id=chat_id) as span:
+            for attempt in range(self.max_retries + 1):
+                await self.limiter.acquire(chat_id, priority)
+                # Время ожидания лимита (включая flood wait)
+                span.set_attribute("rate_limit_wait_seconds", span.duration)
+                try:
+                    return await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    self.limiter.retry_after(chat_id, e.retry_after)
+                    # Чат, который снова и снова получает короткий flood
+                    # wait, не должен держать вызывающего (и слот доставки)
+                    if e.retry_after > self.max_retry_after or attempt == self.max_retries:
+                        raise
+                    logger.warning(
+                        f"⏳ Telegram flood wait {e.retry_after}с для чата {chat_id} ({api_method})"
+                    )
+
+
+# Глобальный планировщик процесса: общий для всех ботов и прямых запросов
+telegram_sender = TelegramRateLimiter()
+
+
+def setup_rate_limit(bot: Bot) -> Bot:
+    """Подключить общий планировщик к экземпляру Bot"""
+    bot.session.middleware(RateLimitMiddleware(telegram_sender))
+    return bot
@@ -0,0 +1,184 @@
+"""
+Оценка токенов и подгонка контекста LLM под бюджет
+"""
+import logging
+from functools import lru_cache
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+from prompt_builder import (
+    SEMANTIC_MEMORIES_HEADER,
+    IMPORTANT_MEMORIES_HEADER,
+    EMOTIONS_HEADER,
+    render_semantic_memory,
+    render_important_memory,
+    render_emotion
+)
+from config import (
+    LLM_INPUT_TOKEN_BUDGET,
+    CONTEXT_MIN_RECENT_MESSAGES,
+    PROMPT_PREFIX_CACHE_SIZE
+)
+
+logger = logging.getLogger(__name__)
+
+# Служебные токены на каждое сообщение chat-формата (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Быстрая оценка числа токенов без токенизатора.
+
+    BPE-токенизаторы дают примерно 4 байта UTF-8 на токен: ~4 символа
+    для латиницы и ~2 символа для кириллицы, поэтому считаем по байтам.
+    """
+    if not text:
+        return 0
+    return len(text.encode("utf-8")) // 4 + 1
+
+
+@lru_cache(maxsize=PROMPT_PREFIX_CACHE_SIZE)
+def static_prefix_tokens(prefix: str) -> int:
+    """
+    Оценка токенов статического префикса промпта.
+
+    prompt_builder возвращает один и тот же объект строки для одного
+    префикса, а хэш строки кэшируется в самом объекте, поэтому повторная
+    оценка - это поиск в словаре.
+    """
+    return estimate_tokens(prefix)
+
+
+def message_tokens(message: Dict) -> int:
+    """Токены сообщения истории (с учетом сохраненной в Redis оценки)"""
+    tokens = message.get("tokens")
+    if tokens is None:
+        tokens = estimate_tokens(message.get("content", ""))
+    return tokens + MESSAGE_OVERHEAD_TOKENS
+
+
+@dataclass
+class BudgetedContext:
+    """Части контекста, поместившиеся в бюджет"""
+    chat_history: List[Dict] = field(default_factory=list)
+    semantic_memories: List = field(default_factory=list)
+    important_memories: List = field(default_factory=list)
+    recent_emotions: List = field(default_factory=list)
+    used_tokens: int = 0
+    dropped: Dict[str, int] = field(default_factory=dict)
+
+
+class ContextBudget:
+    """
+    Подгоняет контекст под бюджет входных токенов.
+
+    Обязательные части - статический префикс системного промпта и текущее
+    сообщение. Остальное добавляется по приоритету, пока хватает бюджета:
+    1. последние min_recent_messages сообщений истории;
+    2. семантически релевантные воспоминания (по убыванию схожести);
+    3. важные воспоминания;
+    4. недавние эмоции;
+    5. более старая история (от новых к старым).
+    Для сообщений истории используется оценка, сохраненная в Redis при
+    записи, поэтому подгонка не пересчитывает токены на каждом запросе.
+    """
+
+    def __init__(
+        self,
+        budget: int = LLM_INPUT_TOKEN_BUDGET,
+        min_recent_messages: int = CONTEXT_MIN_RECENT_MESSAGES
+    ):
+        self.budget = budget
+        self.min_recent_messages = min_recent_messages
+
+    def fit(
+        self,
+        prefix_tokens: int,
+        user_message: str,
+        chat_history: List[Dict],
+        semantic_memories: List = None,
+        important_memories: List = None,
+        recent_emotions: List = None
+    ) -> BudgetedContext:
+        """Выбрать части контекста, укладывающиеся в бюджет"""
+        history = [
+            msg for msg in chat_history
+            if msg.get('role') in ['user', 'assistant']
+        ]
+        semantic_memories = semantic_memories or []
+        important_memories = important_memories or []
+        recent_emotions = recent_emotions or []
+
+        # Обязательные части: системное сообщение и текущее сообщение
+        used = (
+            prefix_tokens + MESSAGE_OVERHEAD_TOKENS
+            + estimate_tokens(user_message) + MESSAGE_OVERHEAD_TOKENS
+        )
+        remaining = self.budget - used
+
+        # Индексы сообщений истории, от новых к старым
+        newest_first = list(range(len(history) - 1, -1, -1))
+        kept_history = set()
+
+        def take_history(indices: List[int]) -> None:
+            nonlocal remaining
+            for index in indices:
+                cost = message_tokens(history[index])
+                if cost > remaining:
+                    # Не пропускаем сообщения "через одно": иначе в
+                    # истории появятся разрывы между вопросом и ответом
+                    break
+                kept_history.add(index)
+                remaining -= cost
+
+        def take_section(items: List, header: str, render) -> List:
+            nonlocal remaining
+            kept = []
+            header_cost = estimate_tokens(header)
+            for item in items:
+                cost = estimate_tokens(render(item))
+                if not kept:
+                    cost += header_cost
+                if cost > remaining:
+                    continue
+                kept.append(item)
+                remaining -= cost
+            return kept
+
+        take_history(newest_first[:self.min_recent_messages])
+        semantic = take_section(
+            semantic_memories, SEMANTIC_MEMORIES_HEADER, render_semantic_memory
+        )
+        important = take_section(
+            important_memories, IMPORTANT_MEMORIES_HEADER, render_important_memory
+        )
+        emotions = take_section(
+            recent_emotions, EMOTIONS_HEADER, render_emotion
+        )
+        if len(kept_history) == min(self.min_recent_messages, len(history)):
+            take_history(newest_first[self.min_recent_messages:])
+
+        result = BudgetedContext(
+            chat_history=[history[i] for i in sorted(kept_history)],
+            semantic_memories=semantic,
+            important_memories=important,
+            recent_emotions=emotions,
+            used_tokens=self.budget - remaining,
+            dropped={
+                "history": len(history) - len(kept_history),
+                "semantic_memories": len(semantic_memories) - len(semantic),
+                "important_memories": len(important_memories) - len(important),
+                "emotions": len(recent_emotions) - len(emotions),
+            }
+        )
+        if any(result.dropped.values()):
+            logger.info(
+                f"✂️ Контекст урезан до ~{result.used_tokens}/{self.budget} токенов, "
+                f"отброшено: {result.dropped}"
+            )
+        return result
+
+
+# Глобальный экземпляр бюджета контекста
+context_budget = ContextBudget()
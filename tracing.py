@@ -0,0 +1,379 @@
+"""
+Трассировка запросов: от обновления Telegram до доставленного ответа
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+from aiogram import BaseMiddleware
+
+from config import (
+    TRACE_SAMPLE_RATE,
+    TRACE_EXPORT_PATH,
+    TRACE_EXPORT_BATCH_SIZE,
+    TRACE_EXPORT_INTERVAL,
+    TRACE_EXPORT_MAX_BYTES
+)
+
+logger = logging.getLogger(__name__)
+
+# Поле сообщения очереди с контекстом трассировки
+TRACE_FIELD = "trace"
+
+# Длительности считаются по монотонным часам; для экспорта время
+# переводится в unix-время через смещение, снятое при старте процесса
+_EPOCH_OFFSET_NS = time.time_ns() - time.monotonic_ns()
+
+# Сколько пакетов может ждать записи; следующие отбрасываются
+EXPORT_MAX_PENDING = 64
+
+# OTLP: SPAN_KIND_INTERNAL и STATUS_CODE_ERROR
+_OTLP_KIND_INTERNAL = 1
+_OTLP_STATUS_ERROR = 2
+
+
+class Span:
+    """Участок обработки запроса"""
+
+    __slots__ = (
+        "name", "trace_id", "span_id", "parent_id", "sampled",
+        "start_ns", "end_ns", "attributes", "error"
+    )
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: Optional[str],
+        sampled: bool,
+        attributes: Dict[str, Any]
+    ):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.start_ns = time.monotonic_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    @property
+    def duration(self) -> float:
+        """Длительность в секундах (до текущего момента, если не завершен)"""
+        end = self.end_ns if self.end_ns is not None else time.monotonic_ns()
+        return (end - self.start_ns) / 1e9
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class OTLPFileExporter:
+    """
+    Запись завершенных участков в файл в формате OTLP/JSON (одна строка -
+    один пакет ExportTraceServiceRequest). Файл читает OpenTelemetry
+    Collector (receiver otlpjsonfile) или любой скрипт построчно.
+
+    Кодирует и пишет пакеты фоновый поток: цикл событий только складывает
+    участки в буфер. Если запись не успевает и ждут уже max_pending
+    пакетов, новые отбрасываются (счетчик dropped). Файл размером от
+    max_bytes переименовывается в <path>.1 (прежний .1 удаляется).
+    """
+
+    def __init__(
+        self,
+        path: str = TRACE_EXPORT_PATH,
+        batch_size: int = TRACE_EXPORT_BATCH_SIZE,
+        flush_interval: float = TRACE_EXPORT_INTERVAL,
+        max_bytes: int = TRACE_EXPORT_MAX_BYTES,
+        max_pending: int = EXPORT_MAX_PENDING
+    ):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.max_pending = max_pending
+        self.service = "ai-gf"
+        self._buffer: List[Span] = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._queue: Optional[queue.Queue] = None
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self.exported = 0
+        self.dropped = 0
+
+    def export(self, span: Span) -> None:
+        """Добавить участок в буфер; передать пакет на запись, если он набран"""
+        if not self.path:
+            return
+        self._buffer.append(span)
+        if (len(self._buffer) >= self.batch_size
+                or time.monotonic() - self._last_flush >= self.flush_interval):
+            self._submit()
+
+    def flush(self) -> None:
+        """Записать накопленные участки и дождаться записи (при остановке процесса)"""
+        self._submit()
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.join()
+
+    def _submit(self) -> None:
+        """Передать накопленные участки фоновому потоку"""
+        with self._lock:
+            spans, self._buffer = self._buffer, []
+            self._last_flush = time.monotonic()
+            if not spans or not self.path:
+                return
+            # После fork (процессы супервизора) потока родителя нет
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue(self.max_pending)
+                self._thread = threading.Thread(
+                    target=self._run, args=(self._queue,), name="trace-export", daemon=True
+                )
+                self._thread.start()
+            try:
+                self._queue.put_nowait(spans)
+            except queue.Full:
+                self.dropped += len(spans)
+                logger.warning(f"Запись трассировки не успевает: отброшено {len(spans)} участков")
+
+    def _run(self, batches: queue.Queue) -> None:
+        while True:
+            spans = batches.get()
+            try:
+                self._write(spans)
+            finally:
+                batches.task_done()
+
+    def _write(self, spans: List[Span]) -> None:
+        """Записать пакет (в фоновом потоке)"""
+        line = json.dumps(self._encode(spans), ensure_ascii=False)
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            if self.max_bytes > 0:
+                self._rotate()
+            # Одна запись на пакет: процессы бота и воркеров могут
+            # дописывать в один файл
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            self.exported += len(spans)
+        except OSError as e:
+            logger.warning(f"Не удалось записать трассировку в {self.path}: {e}")
+
+    def _rotate(self) -> None:
+        """Переименовать файл в <path>.1, если он вырос до max_bytes"""
+        try:
+            if os.path.getsize(self.path) >= self.max_bytes:
+                os.replace(self.path, self.path + ".1")
+        except FileNotFoundError:
+            # Файла еще нет или его только что переименовал другой процесс
+            pass
+
+    @staticmethod
+    def _encode_value(value: Any) -> Dict[str, Any]:
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+        return {"stringValue": str(value)}
+
+    def _encode_span(self, span: Span) -> Dict[str, Any]:
+        encoded = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": _OTLP_KIND_INTERNAL,
+            "startTimeUnixNano": str(span.start_ns + _EPOCH_OFFSET_NS),
+            "endTimeUnixNano": str(span.end_ns + _EPOCH_OFFSET_NS),
+            "attributes": [
+                {"key": key, "value": self._encode_value(value)}
+                for key, value in span.attributes.items() if value is not None
+            ],
+        }
+        if span.parent_id:
+            encoded["parentSpanId"] = span.parent_id
+        if span.error:
+            encoded["status"] = {"code": _OTLP_STATUS_ERROR, "message": span.error}
+        return encoded
+
+    def _encode(self, spans: List[Span]) -> Dict[str, Any]:
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [
+                    {"key": "service.name", "value": {"stringValue": self.service}},
+                    {"key": "process.pid", "value": {"intValue": str(os.getpid())}},
+                ]},
+                "scopeSpans": [{
+                    "scope": {"name": "ai_gf.tracing"},
+                    "spans": [self._encode_span(span) for span in spans],
+                }],
+            }]
+        }
+
+
+class Tracer:
+    """
+    Трассировщик на contextvars.
+
+    Текущий участок хранится в контексте asyncio, поэтому вложенные
+    участки (в том числе в задачах, созданных внутри участка) находят
+    родителя сами. Между процессами контекст передается полем "trace"
+    сообщения очереди (inject / start_trace). Решение о записи трассы
+    принимается один раз у корня (TRACE_SAMPLE_RATE) и передается дальше:
+    у невыбранных трасс участки создаются, но не экспортируются.
+    """
+
+    def __init__(
+        self,
+        sample_rate: float = TRACE_SAMPLE_RATE,
+        exporter: Optional[OTLPFileExporter] = None
+    ):
+        self.sample_rate = sample_rate
+        self.exporter = exporter or OTLPFileExporter()
+
+    def set_service(self, name: str) -> None:
+        """Имя процесса в экспортируемых трассах (bot, llm-worker, ...)"""
+        self.exporter.service = name
+
+    @staticmethod
+    def current_span() -> Optional[Span]:
+        return _current_span.get()
+
+    def current_trace_id(self) -> Optional[str]:
+        span = _current_span.get()
+        return span.trace_id if span else None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        """Добавить атрибут текущему участку"""
+        span = _current_span.get()
+        if span is not None:
+            span.set_attribute(key, value)
+
+    def _finish(self, span: Span) -> None:
+        span.end_ns = time.monotonic_ns()
+        if span.sampled:
+            self.exporter.export(span)
+
+    @contextmanager
+    def _activate(self, span: Span) -> Iterator[Span]:
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current_span.reset(token)
+            self._finish(span)
+
+    def _root(self, name: str, attributes: Dict[str, Any]) -> Span:
+        sampled = random.random() < self.sample_rate
+        return Span(name, os.urandom(16).hex(), None, sampled, attributes)
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Span]:
+        """Участок внутри текущей трассы (или новая трасса, если ее нет)"""
+        parent = _current_span.get()
+        if parent is None:
+            span = self._root(name, attributes)
+        else:
+            span = Span(name, parent.trace_id, parent.span_id, parent.sampled, attributes)
+        with self._activate(span) as active:
+            yield active
+
+    @contextmanager
+    def start_trace(
+        self,
+        name: str,
+        carrier: Optional[Dict[str, Any]] = None,
+        **attributes: Any
+    ) -> Iterator[Span]:
+        """
+        Начать обработку входящего сообщения: продолжить трассу из поля
+        "trace" (если оно есть) или начать новую
+        """
+        context = (carrier or {}).get(TRACE_FIELD)
+        if context and context.get("trace_id"):
+            span = Span(
+                name, context["trace_id"], context.get("span_id"),
+                bool(context.get("sampled")), attributes
+            )
+        else:
+            span = self._root(name, attributes)
+        with self._activate(span) as active:
+            yield active
+
+    def inject(self, carrier: Dict[str, Any]) -> Dict[str, Any]:
+        """Записать контекст текущего участка в сообщение (поле "trace")"""
+        span = _current_span.get()
+        if span is not None:
+            carrier[TRACE_FIELD] = {
+                "trace_id": span.trace_id,
+                "span_id": span.span_id,
+                "sampled": span.sampled,
+            }
+        return carrier
+
+    def record_span(
+        self,
+        name: str,
+        start_unix: float,
+        end_unix: Optional[float] = None,
+        **attributes: Any
+    ) -> None:
+        """
+        Записать уже прошедший участок по unix-времени начала и конца
+        (ожидание в очереди, объединение сообщений) как дочерний к текущему
+        """
+        parent = _current_span.get()
+        if parent is None or not parent.sampled:
+            return
+        span = Span(name, parent.trace_id, parent.span_id, True, attributes)
+        end_unix = time.time() if end_unix is None else end_unix
+        span.start_ns = int(start_unix * 1e9) - _EPOCH_OFFSET_NS
+        span.end_ns = max(int(end_unix * 1e9) - _EPOCH_OFFSET_NS, span.start_ns)
+        self.exporter.export(span)
+
+    def flush(self) -> None:
+        """Записать накопленные участки (при остановке процесса)"""
+        self.exporter.flush()
+
+
+class TracingMiddleware(BaseMiddleware):
+    """
+    Outer middleware aiogram: каждое обновление - корневой участок
+    "telegram.update", внутри которого работают хендлеры
+    """
+
+    async def __call__(self, handler, event, data):
+        user = getattr(event, "from_user", None)
+        chat = getattr(event, "chat", None)
+        with tracer.start_trace(
+            "telegram.update",
+            event=type(event).__name__,
+            user_id=user.id if user else None,
+            chat_id=chat.id if chat else None
+        ):
+            return await handler(event, data)
+
+
+# Глобальный трассировщик процесса
+tracer = Tracer()
+atexit.register(tracer.flush)
@@ -0,0 +1,276 @@
+"""
+Точный поиск по воспоминаниям пользователя: матрицы векторов в памяти процесса
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import metrics
+from config import (
+    EXACT_SEARCH_MAX_USER_VECTORS,
+    EXACT_SEARCH_CACHE_VECTORS,
+    EXACT_SEARCH_TTL
+)
+from vector_store import vector_store
+
+logger = logging.getLogger(__name__)
+
+# Результат поиска: (ID, схожесть, текст, метаданные)
+Match = Tuple[str, float, str, Dict]
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+def _types(metadata: Dict) -> frozenset:
+    """Типы воспоминания из метаданных ChromaDB (основной и memory_types)"""
+    names = set(filter(None, (metadata.get("memory_types") or "").split(",")))
+    names.add(metadata.get("memory_type"))
+    return frozenset(names)
+
+
+class _UserVectors:
+    """Векторы одного пользователя: непрерывная матрица float32 (строки нормированы)"""
+
+    def __init__(self, ids: List[str], matrix: np.ndarray, documents: List[str], metadatas: List[Dict]):
+        self.ids = ids
+        self.matrix = matrix
+        self.documents = documents
+        self.metadatas = metadatas
+        self.types = [_types(metadata) for metadata in metadatas]
+        self.rows = {memory_id: row for row, memory_id in enumerate(ids)}
+        self.loaded = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
+class UserVectorIndex:
+    """
+    Точный косинусный поиск top-k по воспоминаниям одного пользователя.
+
+    У типичного пользователя десятки-сотни воспоминаний: их векторы
+    загружаются из ChromaDB одним запросом и хранятся нормированной
+    матрицей float32, а поиск - одно умножение матрицы на векторы запросов.
+    Это быстрее и точнее HNSW с фильтром по user_id в общей коллекции.
+    Пользователи с числом воспоминаний больше max_user_vectors ищутся
+    через HNSW (search возвращает None).
+
+    Матрицы активных пользователей хранятся в LRU размером не больше
+    max_vectors векторов на процесс. Записи этого процесса (vector_client)
+    обновляют матрицу сразу; записи других процессов становятся видны после
+    перезагрузки матрицы - не позже чем через ttl секунд.
+    """
+
+    def __init__(
+        self,
+        max_user_vectors: int = EXACT_SEARCH_MAX_USER_VECTORS,
+        max_vectors: int = EXACT_SEARCH_CACHE_VECTORS,
+        ttl: float = EXACT_SEARCH_TTL
+    ):
+        self.max_user_vectors = max_user_vectors
+        self.max_vectors = max_vectors
+        self.ttl = ttl
+        self._users: "OrderedDict[int, _UserVectors]" = OrderedDict()
+        self._size = 0
+        # ID воспоминания -> пользователь, чья матрица его содержит
+        self._owners: Dict[str, int] = {}
+        # Пользователи больше max_user_vectors -> до какого времени не проверять снова
+        self._large: Dict[int, float] = {}
+        # Загрузки матриц в процессе (одна на пользователя) и записи этого
+        # процесса, сделанные во время загрузки: снимок из ChromaDB может
+        # их не содержать, они добавляются после загрузки
+        self._loading: Dict[int, asyncio.Future] = {}
+        self._loading_writes: Dict[int, List[Tuple[List[str], np.ndarray, List[str], List[Dict]]]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_user_vectors > 0 and self.max_vectors > 0
+
+    async def search(
+        self,
+        user_id: int,
+        queries: np.ndarray,
+        limit: int,
+        memory_types: Optional[List[str]] = None
+    ) -> Optional[List[List[Match]]]:
+        """
+        Ближайшие воспоминания пользователя для каждой строки queries.
+
+        Возвращает списки (ID, схожесть, текст, метаданные) по убыванию
+        схожести или None, если пользователя нужно искать через HNSW.
+        Метаданные - копии: их можно менять, кэш от этого не изменится.
+        """
+        if not self.enabled:
+            return None
+        vectors = await self._get(user_id)
+        if vectors is None:
+            metrics.VECTOR_SEARCH_MODE.labels("ann").inc()
+            return None
+        metrics.VECTOR_SEARCH_MODE.labels("exact").inc()
+
+        queries = _normalize(np.atleast_2d(queries))
+        if not len(vectors):
+            return [[] for _ in queries]
+        rows = np.arange(len(vectors))
+        matrix = vectors.matrix
+        if memory_types:
+            wanted = set(memory_types)
+            rows = rows[[not wanted.isdisjoint(types) for types in vectors.types]]
+            # Копия строк нужна только при фильтре по типам
+            matrix = matrix[rows]
+        k = min(limit, len(rows))
+        if k == 0:
+            return [[] for _ in queries]
+
+        similarity = queries @ matrix.T
+        results = []
+        for scores in similarity:
+            top = np.argpartition(-scores, k - 1)[:k] if k < len(rows) else np.arange(len(rows))
+            top = top[np.argsort(-scores[top])]
+            results.append([
+                (
+                    vectors.ids[rows[i]],
+                    float(scores[i]),
+                    vectors.documents[rows[i]],
+                    dict(vectors.metadatas[rows[i]])
+                )
+                for i in top
+            ])
+        return results
+
+    async def _get(self, user_id: int) -> Optional[_UserVectors]:
+        """Матрица пользователя из кэша или из ChromaDB (None - большой пользователь)"""
+        now = time.monotonic()
+        if self._large.get(user_id, 0) > now:
+            return None
+        vectors = self._users.get(user_id)
+        if vectors is not None and now - vectors.loaded < self.ttl:
+            self._users.move_to_end(user_id)
+            return vectors
+
+        loading = self._loading.get(user_id)
+        if loading is None:
+            loading = asyncio.ensure_future(self._load(user_id))
+            self._loading[user_id] = loading
+            loading.add_done_callback(lambda _: self._loading.pop(user_id, None))
+        # shield: отмена одного запроса не отменяет общую загрузку
+        return await asyncio.shield(loading)
+
+    async def _load(self, user_id: int) -> Optional[_UserVectors]:
+        self._loading_writes[user_id] = []
+        try:
+            results = await vector_store.get(
+                where={"user_id": user_id},
+                limit=self.max_user_vectors + 1,
+                include=["embeddings", "documents", "metadatas"]
+            )
+        finally:
+            writes = self._loading_writes.pop(user_id)
+        self.discard(user_id)
+        ids = results["ids"]
+        if len(ids) > self.max_user_vectors:
+            now = time.monotonic()
+            # Истекшие отметки больших пользователей не копятся
+            self._large = {uid: until for uid, until in self._large.items() if until > now}
+            self._large[user_id] = now + self.ttl
+            return None
+        self._large.pop(user_id, None)
+
+        embeddings = results["embeddings"]
+        matrix = _normalize(embeddings) if len(ids) else np.empty((0, 0), dtype=np.float32)
+        vectors = _UserVectors(list(ids), matrix, list(results["documents"]), list(results["metadatas"]))
+        self._store(user_id, vectors)
+        for write in writes:
+            self._append(user_id, *write)
+        return self._users.get(user_id)
+
+    def _store(self, user_id: int, vectors: _UserVectors) -> None:
+        self._users[user_id] = vectors
+        self._size += len(vectors)
+        self._owners.update(dict.fromkeys(vectors.ids, user_id))
+        while self._size > self.max_vectors and len(self._users) > 1:
+            self.discard(next(iter(self._users)))
+
+    def add(
+        self,
+        user_id: int,
+        ids: List[str],
+        embeddings: np.ndarray,
+        documents: List[str],
+        metadatas: List[Dict]
+    ) -> None:
+        """Добавить записанные векторы в матрицу пользователя (если она в кэше или загружается)"""
+        if user_id in self._loading_writes:
+            self._loading_writes[user_id].append((list(ids), embeddings, list(documents), list(metadatas)))
+            return
+        self._append(user_id, ids, embeddings, documents, metadatas)
+
+    def _append(
+        self,
+        user_id: int,
+        ids: List[str],
+        embeddings: np.ndarray,
+        documents: List[str],
+        metadatas: List[Dict]
+    ) -> None:
+        vectors = self._users.get(user_id)
+        if vectors is None:
+            return
+        # Запись, сделанная во время загрузки, может уже быть в снимке
+        new = [i for i, memory_id in enumerate(ids) if memory_id not in vectors.rows]
+        if not new:
+            return
+        if len(new) < len(ids):
+            ids = [ids[i] for i in new]
+            embeddings = np.asarray(embeddings)[new]
+            documents = [documents[i] for i in new]
+            metadatas = [metadatas[i] for i in new]
+        if len(vectors) + len(ids) > self.max_user_vectors:
+            self.discard(user_id)
+            return
+        rows = _normalize(embeddings)
+        matrix = np.concatenate([vectors.matrix, rows]) if len(vectors) else rows
+        self.discard(user_id)
+        updated = _UserVectors(
+            vectors.ids + list(ids), matrix, vectors.documents + list(documents),
+            vectors.metadatas + list(metadatas)
+        )
+        updated.loaded = vectors.loaded
+        self._store(user_id, updated)
+
+    def update_metadata(self, memory_id: str, metadata: Dict) -> None:
+        """Обновить метаданные воспоминания в кэше"""
+        vectors = self._users.get(self._owners.get(memory_id))
+        if vectors is None:
+            return
+        row = vectors.rows[memory_id]
+        vectors.metadatas[row] = {**vectors.metadatas[row], **metadata}
+        vectors.types[row] = _types(vectors.metadatas[row])
+
+    def forget(self, memory_ids: List[str]) -> None:
+        """Сбросить матрицы пользователей, у которых изменены или удалены векторы"""
+        for user_id in {self._owners[i] for i in memory_ids if i in self._owners}:
+            self.discard(user_id)
+
+    def discard(self, user_id: int) -> None:
+        """Убрать матрицу пользователя из кэша"""
+        vectors = self._users.pop(user_id, None)
+        if vectors is not None:
+            self._size -= len(vectors)
+            for memory_id in vectors.ids:
+                self._owners.pop(memory_id, None)
+
+    def get_stats(self) -> dict:
+        """Пользователи и векторы в кэше"""
+        return {"users": len(self._users), "vectors": self._size, "large_users": len(self._large)}
+
+
+# Глобальный индекс процесса
+user_vector_index = UserVectorIndex()
@@ -27,6 +27,25 @@ def is_profile_complete(user: User) -> bool:
     ])
 
 
+def has_active_subscription(user: User) -> bool:
+    """Есть ли у пользователя действующая подписка"""
+    if not user.subscription_expires_at:
+        return False
+    now = datetime.now(user.subscription_expires_at.tzinfo)
+    return user.subscription_expires_at > now
+
+
+def get_request_tier(user: User) -> str:
+    """
+    Тариф запроса к LLM для выбора полосы очереди.
+
+    Returns:
+        "premium" для действующей подписки, иначе "free"
+        (см. queue_client.REQUEST_LANES)
+    """
+    return "premium" if has_active_subscription(user) else "free"
+
+
 async def check_message_limit(
     redis,
     user: User,
@@ -55,11 +74,8 @@ async def check_message_limit(
         >>>     await message.reply("Лимит исчерпан!")
     """
     # 1. Проверяем подписку
-    if user.subscription_expires_at:
-        # Проверяем, что подписка ещё активна
-        now = datetime.now(user.subscription_expires_at.tzinfo)
-        if user.subscription_expires_at > now:
-            return (True, -1)  # -1 означает безлимит
+    if has_active_subscription(user):
+        return (True, -1)  # -1 означает безлимит
     
     # 2. Проверяем счётчик в Redis
     today = datetime.utcnow().date().isoformat()  # "2025-10-22"
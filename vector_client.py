@@ -3,12 +3,15 @@
 """
 import logging
 import asyncio
+import time
 from typing import List, Dict, Optional, Tuple
-import chromadb
-from chromadb.config import Settings
-from sentence_transformers import SentenceTransformer
 import numpy as np
 
+import metrics
+from embedding_engine import embedding_engine
+from vector_store import vector_store
+from user_vector_index import user_vector_index, Match
+
 from config import (
     VECTOR_DB_PATH, 
     EMBEDDING_MODEL, 
@@ -25,39 +28,73 @@ class VectorClient:
     def __init__(self):
         self.client = None
         self.collection = None
-        self.embedding_model = None
         self.initialized = False
+        # Модель прогрета пробным расчетом (см. warmup)
+        self.ready = False
+        # Одна инициализация на процесс, сколько бы запросов ее ни ждали
+        self._init_lock = asyncio.Lock()
+    
+    @property
+    def embedding_model(self):
+        """Модель эмбеддингов (кодирование - через embedding_engine)"""
+        return embedding_engine.model
     
     async def initialize(self):
-        """Инициализация векторной базы данных"""
-        try:
-            # Инициализируем ChromaDB
-            self.client = chromadb.PersistentClient(
-                path=VECTOR_DB_PATH,
-                settings=Settings(
-                    anonymized_telemetry=False,
-                    allow_reset=True
+        """
+        Инициализация векторной базы данных.
+
+        Одновременные вызовы ждут одну инициализацию; после ошибки
+        следующий вызов пробует снова.
+        """
+        async with self._init_lock:
+            if self.initialized:
+                return
+            try:
+                # ChromaDB открывается в пуле потоков хранилища, а модель
+                # эмбеддингов (если не загружена заранее) - в пуле цикла
+                # событий, одновременно: чтение с диска не блокирует цикл
+                await asyncio.gather(
+                    vector_store.open(VECTOR_DB_PATH),
+                    asyncio.get_running_loop().run_in_executor(None, self.load_embedding_model)
                 )
-            )
-            
-            # Создаем или получаем коллекцию
-            self.collection = self.client.get_or_create_collection(
-                name="user_memories",
-                metadata={"hnsw:space": "cosine"}
-            )
-            
-            # Загружаем модель для эмбеддингов
-            self.embedding_model = SentenceTransformer(EMBEDDING_MODEL)
-            
-            self.initialized = True
-            logger.info("✅ Векторная база данных ChromaDB инициализирована!")
-            logger.info(f"📁 Путь к векторной БД: {VECTOR_DB_PATH}")
-            logger.info(f"🤖 Модель эмбеддингов: {EMBEDDING_MODEL}")
-            logger.info(f"📊 Коллекция: {self.collection.name}")
-            
-        except Exception as e:
-            logger.error(f"Ошибка инициализации векторной базы: {e}")
-            raise
+                self.client = vector_store.client
+                self.collection = vector_store.collection
+                
+                self.initialized = True
+                logger.info("✅ Векторная база данных ChromaDB инициализирована!")
+                logger.info(f"📁 Путь к векторной БД: {VECTOR_DB_PATH}")
+                logger.info(f"🤖 Модель эмбеддингов: {EMBEDDING_MODEL}")
+                logger.info(f"📊 Коллекция: {self.collection.name}")
+                
+            except Exception as e:
+                logger.error(f"Ошибка инициализации векторной базы: {e}")
+                raise
+    
+    async def warmup(self) -> None:
+        """
+        Подготовить поиск воспоминаний до первого запроса пользователя:
+        инициализация, пробный расчет эмбеддингов и обращение к коллекции.
+        После прогрева self.ready = True.
+        """
+        started = time.perf_counter()
+        await self.initialize()
+        await embedding_engine.warmup()
+        count = await vector_store.count()
+        self.ready = True
+        logger.info(
+            f"🔥 Векторный поиск готов за {time.perf_counter() - started:.1f}с "
+            f"(воспоминаний в коллекции: {count})"
+        )
+    
+    def load_embedding_model(self) -> None:
+        """
+        Загрузить модель эмбеддингов без подключения к ChromaDB.
+
+        Супервизор воркеров (worker_supervisor.py) загружает модель до
+        fork, и дочерние процессы используют ее веса совместно
+        (copy-on-write); клиент ChromaDB каждый процесс открывает сам.
+        """
+        embedding_engine.load_model()
     
     async def add_memory(
         self, 
@@ -75,34 +112,20 @@ class VectorClient:
                 await self.initialize()
             
             # Создаем эмбеддинг для содержимого
-            embedding = self.embedding_model.encode(content).tolist()
-            
-            # Подготавливаем метаданные и удаляем значения None,
-            # так как ChromaDB не принимает None в метаданных
-            base_metadata = {
-                "user_id": user_id,
-                "memory_type": memory_type,
-                "importance": importance,
-                "tags": ",".join(tags) if tags else ""
-            }
-            extra_metadata = {
-                key: value
-                for key, value in (metadata or {}).items()
-                if value is not None
-            }
-            memory_metadata = {
-                key: value
-                for key, value in {**base_metadata, **extra_metadata}.items()
-                if value is not None
-            }
+            embedding = (await embedding_engine.encode_one(content)).tolist()
+            
+            memory_metadata = self._build_metadata(
+                user_id, memory_type, importance, tags, metadata
+            )
             
             # Добавляем в коллекцию
-            self.collection.add(
+            await vector_store.add(
                 ids=[memory_id],
                 embeddings=[embedding],
                 documents=[content],
                 metadatas=[memory_metadata]
             )
+            user_vector_index.add(user_id, [memory_id], [embedding], [content], [memory_metadata])
             
             logger.info(f"Добавлено воспоминание {memory_id} в векторную базу")
             return True
@@ -111,6 +134,97 @@ class VectorClient:
             logger.error(f"Ошибка добавления воспоминания в векторную базу: {e}")
             return False
     
+    @staticmethod
+    def _build_metadata(
+        user_id: int,
+        memory_type: str,
+        importance: str,
+        tags: List[str] = None,
+        metadata: Dict = None,
+        memory_types: List[str] = None
+    ) -> Dict:
+        """
+        Собрать метаданные воспоминания для ChromaDB.
+
+        Списки в метаданных ChromaDB не поддерживаются: все типы хранятся
+        строкой memory_types и флагами type_<тип> для фильтрации.
+        """
+        memory_types = memory_types or [memory_type]
+        # Удаляем значения None, так как ChromaDB не принимает None в метаданных
+        base_metadata = {
+            "user_id": user_id,
+            "memory_type": memory_type,
+            "memory_types": ",".join(memory_types),
+            "importance": importance,
+            "tags": ",".join(tags) if tags else ""
+        }
+        base_metadata.update({f"type_{value}": True for value in memory_types})
+        return {
+            key: value
+            for key, value in {**base_metadata, **(metadata or {})}.items()
+            if value is not None
+        }
+    
+    async def add_memories(self, memories: List[Dict]) -> bool:
+        """
+        Добавить несколько воспоминаний одним вызовом.
+
+        Каждый элемент - словарь с ключами аргументов add_memory
+        (memory_id, user_id, content, memory_type, importance, tags, metadata)
+        и необязательными memory_types и embedding (уже рассчитанный вектор).
+        Недостающие эмбеддинги считаются одним пакетом, запись в коллекцию - одна.
+        """
+        if not memories:
+            return True
+        try:
+            if not self.initialized:
+                await self.initialize()
+            
+            contents = [mem["content"] for mem in memories]
+            if all(mem.get("embedding") is not None for mem in memories):
+                embeddings = [np.asarray(mem["embedding"]).tolist() for mem in memories]
+            else:
+                embeddings = (await embedding_engine.encode(contents)).tolist()
+            
+            ids = [mem["memory_id"] for mem in memories]
+            metadatas = [
+                self._build_metadata(
+                    mem["user_id"],
+                    mem["memory_type"],
+                    mem["importance"],
+                    mem.get("tags"),
+                    mem.get("metadata"),
+                    mem.get("memory_types")
+                )
+                for mem in memories
+            ]
+            await vector_store.add(
+                ids=ids,
+                embeddings=embeddings,
+                documents=contents,
+                metadatas=metadatas
+            )
+            
+            # Матрицы пользователей в кэше точного поиска дополняются сразу
+            by_user: Dict[int, List[int]] = {}
+            for i, mem in enumerate(memories):
+                by_user.setdefault(mem["user_id"], []).append(i)
+            for user_id, rows in by_user.items():
+                user_vector_index.add(
+                    user_id,
+                    [ids[i] for i in rows],
+                    [embeddings[i] for i in rows],
+                    [contents[i] for i in rows],
+                    [metadatas[i] for i in rows]
+                )
+            
+            logger.info(f"Добавлено {len(memories)} воспоминаний в векторную базу")
+            return True
+            
+        except Exception as e:
+            logger.error(f"Ошибка пакетного добавления воспоминаний в векторную базу: {e}")
+            return False
+    
     async def search_similar_memories(
         self, 
         user_id: int, 
@@ -127,40 +241,25 @@ class VectorClient:
                 limit = VECTOR_SEARCH_LIMIT
             
             # Создаем эмбеддинг для запроса
-            query_embedding = self.embedding_model.encode(query).tolist()
-            
-            # Подготавливаем фильтр
-            where_filter = {"user_id": user_id}
-            if memory_types:
-                where_filter["memory_type"] = {"$in": memory_types}
+            with metrics.time_stage(metrics.STAGE_EMBEDDING):
+                query_embedding = (await embedding_engine.encode_one(query)).tolist()
             
             # Выполняем поиск
-            results = self.collection.query(
-                query_embeddings=[query_embedding],
-                n_results=limit,
-                where=where_filter,
-                include=["documents", "metadatas", "distances"]
-            )
-            
-            # Формируем результат
-            similar_memories = []
-            if results["documents"] and results["documents"][0]:
-                for i, (doc, metadata, distance) in enumerate(zip(
-                    results["documents"][0],
-                    results["metadatas"][0],
-                    results["distances"][0]
-                )):
-                    # Преобразуем расстояние в схожесть (1 - distance)
-                    similarity = 1 - distance
-                    
-                    # Фильтруем по порогу схожести
-                    if similarity >= VECTOR_SIMILARITY_THRESHOLD:
-                        similar_memories.append({
-                            "content": doc,
-                            "metadata": metadata,
-                            "similarity": similarity,
-                            "distance": distance
-                        })
+            with metrics.time_stage(metrics.STAGE_VECTOR_SEARCH):
+                matches = (await self._nearest(user_id, [query_embedding], limit, memory_types))[0]
+            
+            # Формируем результат (фильтруем по порогу схожести)
+            similar_memories = [
+                {
+                    "id": memory_id,
+                    "content": doc,
+                    "metadata": metadata,
+                    "similarity": similarity,
+                    "distance": 1 - similarity
+                }
+                for memory_id, similarity, doc, metadata in matches
+                if similarity >= VECTOR_SIMILARITY_THRESHOLD
+            ]
             
             logger.info(f"Найдено {len(similar_memories)} похожих воспоминаний для запроса: {query[:50]}")
             return similar_memories
@@ -169,6 +268,124 @@ class VectorClient:
             logger.error(f"Ошибка поиска похожих воспоминаний: {e}")
             return []
     
+    async def _nearest(
+        self,
+        user_id: int,
+        embeddings: List,
+        limit: int,
+        memory_types: List[str] = None
+    ) -> List[List[Match]]:
+        """
+        Ближайшие воспоминания пользователя для каждого вектора:
+        (ID, схожесть, текст, метаданные) по убыванию схожести.
+
+        Воспоминания пользователя ищутся точно матрицей в памяти
+        (user_vector_index), у очень больших пользователей - через HNSW.
+        """
+        exact = await user_vector_index.search(user_id, np.asarray(embeddings), limit, memory_types)
+        if exact is not None:
+            return exact
+        
+        where_filter = {"user_id": user_id}
+        if memory_types:
+            where_filter = {"$and": [where_filter, self._types_filter(memory_types)]}
+        results = await vector_store.query(
+            query_embeddings=np.asarray(embeddings).tolist(),
+            n_results=limit,
+            where=where_filter,
+            include=["documents", "metadatas", "distances"]
+        )
+        # Преобразуем расстояние в схожесть (1 - distance)
+        return [
+            [
+                (memory_id, 1 - distance, doc, metadata)
+                for memory_id, doc, metadata, distance in zip(ids, docs, metadatas, distances)
+            ]
+            for ids, docs, metadatas, distances in zip(
+                results["ids"], results["documents"], results["metadatas"], results["distances"]
+            )
+        ]
+    
+    @staticmethod
+    def _types_filter(memory_types: List[str]) -> Dict:
+        """Фильтр ChromaDB: воспоминание имеет хотя бы один из типов"""
+        # Записи без флагов type_<тип> (до перехода на несколько типов)
+        # находятся по основному типу
+        conditions = [{"memory_type": {"$in": memory_types}}]
+        conditions.extend({f"type_{value}": True} for value in memory_types)
+        return {"$or": conditions}
+    
+    async def find_duplicates(
+        self,
+        user_id: int,
+        embeddings: np.ndarray,
+        threshold: float
+    ) -> List[Optional[Tuple[str, float]]]:
+        """
+        Ближайшее сохраненное воспоминание пользователя для каждого вектора.
+
+        Возвращает для каждой строки embeddings пару (ID, схожесть), если
+        схожесть не ниже threshold, иначе None. Все векторы ищутся одним
+        запросом.
+        """
+        if not self.initialized:
+            await self.initialize()
+        
+        with metrics.time_stage(metrics.STAGE_DEDUP_SEARCH):
+            nearest = await self._nearest(user_id, embeddings, 1)
+        
+        return [
+            (matches[0][0], matches[0][1]) if matches and matches[0][1] >= threshold else None
+            for matches in nearest
+        ]
+    
+    async def get_embeddings(self, memory_ids: List[str]) -> Dict[str, np.ndarray]:
+        """Сохраненные векторы воспоминаний по ID"""
+        if not memory_ids:
+            return {}
+        if not self.initialized:
+            await self.initialize()
+        
+        results = await vector_store.get(ids=memory_ids, include=["embeddings"])
+        return {
+            memory_id: np.asarray(embedding, dtype=np.float32)
+            for memory_id, embedding in zip(results["ids"], results["embeddings"])
+        }
+    
+    async def update_metadatas(self, memories: List[Dict]) -> bool:
+        """
+        Перезаписать метаданные нескольких воспоминаний одним вызовом.
+
+        Элементы - как в add_memories, без content и embedding.
+        """
+        if not memories:
+            return True
+        try:
+            if not self.initialized:
+                await self.initialize()
+            
+            ids = [mem["memory_id"] for mem in memories]
+            metadatas = [
+                self._build_metadata(
+                    mem["user_id"],
+                    mem["memory_type"],
+                    mem["importance"],
+                    mem.get("tags"),
+                    mem.get("metadata"),
+                    mem.get("memory_types")
+                )
+                for mem in memories
+            ]
+            await vector_store.update(ids=ids, metadatas=metadatas)
+            for memory_id, metadata in zip(ids, metadatas):
+                user_vector_index.update_metadata(memory_id, metadata)
+            logger.info(f"Обновлены метаданные {len(memories)} воспоминаний в векторной базе")
+            return True
+            
+        except Exception as e:
+            logger.error(f"Ошибка обновления метаданных воспоминаний: {e}")
+            return False
+    
     async def get_user_memories_by_type(
         self, 
         user_id: int, 
@@ -184,11 +401,8 @@ class VectorClient:
                 limit = VECTOR_SEARCH_LIMIT
             
             # Получаем все воспоминания пользователя определенного типа
-            results = self.collection.get(
-                where={
-                    "user_id": user_id,
-                    "memory_type": memory_type
-                },
+            results = await vector_store.get(
+                where={"$and": [{"user_id": user_id}, self._types_filter([memory_type])]},
                 limit=limit,
                 include=["documents", "metadatas"]
             )
@@ -226,7 +440,7 @@ class VectorClient:
                 importance_levels = ["high", "critical"]
             
             # Получаем важные воспоминания
-            results = self.collection.get(
+            results = await vector_store.get(
                 where={
                     "user_id": user_id,
                     "importance": {"$in": importance_levels}
@@ -256,7 +470,8 @@ class VectorClient:
             if not self.initialized:
                 await self.initialize()
             
-            self.collection.delete(ids=[memory_id])
+            await vector_store.delete(ids=[memory_id])
+            user_vector_index.forget([memory_id])
             logger.info(f"Удалено воспоминание {memory_id} из векторной базы")
             return True
             
@@ -264,6 +479,23 @@ class VectorClient:
             logger.error(f"Ошибка удаления воспоминания: {e}")
             return False
     
+    async def delete_memories(self, memory_ids: List[str]) -> bool:
+        """Удалить несколько воспоминаний из векторной базы одним вызовом"""
+        if not memory_ids:
+            return True
+        try:
+            if not self.initialized:
+                await self.initialize()
+            
+            await vector_store.delete(ids=memory_ids)
+            user_vector_index.forget(memory_ids)
+            logger.info(f"Удалено {len(memory_ids)} воспоминаний из векторной базы")
+            return True
+            
+        except Exception as e:
+            logger.error(f"Ошибка удаления воспоминаний: {e}")
+            return False
+    
     async def update_memory(
         self, 
         memory_id: str, 
@@ -279,7 +511,7 @@ class VectorClient:
             
             if content:
                 # Обновляем эмбеддинг
-                embedding = self.embedding_model.encode(content).tolist()
+                embedding = (await embedding_engine.encode_one(content)).tolist()
                 update_data["embeddings"] = [embedding]
                 update_data["documents"] = [content]
             
@@ -287,10 +519,11 @@ class VectorClient:
                 update_data["metadatas"] = [metadata]
             
             if update_data:
-                self.collection.update(
+                await vector_store.update(
                     ids=[memory_id],
                     **update_data
                 )
+                user_vector_index.forget([memory_id])
                 logger.info(f"Обновлено воспоминание {memory_id} в векторной базе")
             
             return True
@@ -305,12 +538,13 @@ class VectorClient:
             if not self.initialized:
                 await self.initialize()
             
-            count = self.collection.count()
+            count = await vector_store.count()
             
             stats = {
                 "total_memories": count,
                 "collection_name": self.collection.name,
-                "embedding_model": EMBEDDING_MODEL
+                "embedding_model": EMBEDDING_MODEL,
+                "exact_search": user_vector_index.get_stats()
             }
             
             return stats
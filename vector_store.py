@@ -0,0 +1,199 @@
+"""
+Асинхронный доступ к коллекции ChromaDB через отдельный пул потоков
+"""
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Set
+
+import metrics
+from config import VECTOR_STORE_THREADS, VECTOR_STORE_MAX_PENDING, VECTOR_STORE_BATCH_WAIT_MS
+
+logger = logging.getLogger(__name__)
+
+# Операции записи, объединяемые в один вызов коллекции
+WRITE_OPERATIONS = ("add", "upsert")
+# Больше записей за один вызов коллекции не объединяется
+MAX_WRITE_BATCH = 1000
+
+
+class _Write:
+    """Вызов add/upsert, ожидающий записи"""
+
+    def __init__(self, ids: List[str], columns: Dict[str, List], future: asyncio.Future):
+        self.ids = ids
+        self.columns = columns
+        self.future = future
+
+
+class VectorStore:
+    """
+    Коллекция ChromaDB с асинхронными методами.
+
+    Вызовы ChromaDB (чтение с диска, поиск и перестроение HNSW) блокируют
+    поток, поэтому выполняются в отдельном пуле из threads потоков и не
+    останавливают цикл событий воркера (отправку в Telegram, подтверждения
+    в очереди). Одновременно в пуле ожидает не больше max_pending вызовов,
+    остальные ждут в цикле событий: очередь пула не растет без предела.
+
+    Вызовы add/upsert, пришедшие в течение batch_wait секунд от первого,
+    записываются одним вызовом коллекции. Если общий вызов не удался,
+    каждый вызов повторяется отдельно: ошибка одного (например, повтор ID)
+    не мешает остальным.
+    """
+
+    def __init__(
+        self,
+        threads: int = VECTOR_STORE_THREADS,
+        max_pending: int = VECTOR_STORE_MAX_PENDING,
+        batch_wait: float = VECTOR_STORE_BATCH_WAIT_MS / 1000
+    ):
+        self.threads = threads
+        self.max_pending = max_pending
+        self.batch_wait = batch_wait
+        self.client = None
+        self.collection = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._writes: Dict[str, List[_Write]] = {operation: [] for operation in WRITE_OPERATIONS}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes: Set[asyncio.Task] = set()
+
+    async def open(self, path: str, name: str = "user_memories") -> None:
+        """Открыть базу ChromaDB и коллекцию (косинусное расстояние)"""
+        def connect():
+            import chromadb
+            from chromadb.config import Settings
+
+            client = chromadb.PersistentClient(
+                path=path,
+                settings=Settings(anonymized_telemetry=False, allow_reset=True)
+            )
+            return client, client.get_or_create_collection(
+                name=name, metadata={"hnsw:space": "cosine"}
+            )
+
+        self.client, self.collection = await self._call("open", connect)
+
+    async def _call(self, operation: str, func: Callable, *args, **kwargs) -> Any:
+        """Выполнить вызов в пуле потоков ChromaDB"""
+        if self._executor is None:
+            # Пул создается при первом вызове: после fork в процессах супервизора
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.threads, thread_name_prefix="chromadb"
+            )
+            self._slots = asyncio.Semaphore(self.max_pending)
+        async with self._slots:
+            enqueued = time.perf_counter()
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._timed, operation, enqueued, partial(func, *args, **kwargs)
+            )
+
+    @staticmethod
+    def _timed(operation: str, enqueued: float, call: Callable) -> Any:
+        """Вызов в потоке пула с замером ожидания и выполнения"""
+        started = time.perf_counter()
+        metrics.VECTOR_STORE_QUEUE_WAIT.labels(operation).observe(started - enqueued)
+        try:
+            return call()
+        finally:
+            metrics.VECTOR_STORE_LATENCY.labels(operation).observe(time.perf_counter() - started)
+
+    async def query(self, **kwargs) -> Dict:
+        """collection.query"""
+        return await self._call("query", self.collection.query, **kwargs)
+
+    async def get(self, **kwargs) -> Dict:
+        """collection.get"""
+        return await self._call("get", self.collection.get, **kwargs)
+
+    async def update(self, **kwargs) -> None:
+        """collection.update"""
+        await self._call("update", self.collection.update, **kwargs)
+
+    async def delete(self, **kwargs) -> None:
+        """collection.delete"""
+        await self._call("delete", self.collection.delete, **kwargs)
+
+    async def count(self) -> int:
+        """collection.count"""
+        return await self._call("count", self.collection.count)
+
+    async def add(self, ids: List[str], **columns) -> None:
+        """collection.add (объединяется с одновременными вызовами)"""
+        await self._write("add", ids, columns)
+
+    async def upsert(self, ids: List[str], **columns) -> None:
+        """collection.upsert (объединяется с одновременными вызовами)"""
+        await self._write("upsert", ids, columns)
+
+    async def _write(self, operation: str, ids: List[str], columns: Dict[str, List]) -> None:
+        if not ids:
+            return
+        loop = asyncio.get_running_loop()
+        write = _Write(ids, columns, loop.create_future())
+        self._writes[operation].append(write)
+        if sum(len(w.ids) for w in self._writes[operation]) >= MAX_WRITE_BATCH:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.batch_wait, self._flush)
+        await write.future
+
+    def _flush(self) -> None:
+        """Отправить накопленные записи (по одному вызову на операцию)"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for operation, writes in self._writes.items():
+            if not writes:
+                continue
+            self._writes[operation] = []
+            task = asyncio.create_task(self._write_batch(operation, writes))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _write_batch(self, operation: str, writes: List[_Write]) -> None:
+        metrics.VECTOR_STORE_BATCH.observe(len(writes))
+        method = getattr(self.collection, operation)
+        # Столбец, переданный не во всех вызовах, записывать вместе нельзя
+        names = set.intersection(*(set(w.columns) for w in writes))
+        if len(writes) > 1 and all(set(w.columns) == names for w in writes):
+            try:
+                await self._call(
+                    operation,
+                    method,
+                    ids=[i for w in writes for i in w.ids],
+                    **{name: [v for w in writes for v in w.columns[name]] for name in names}
+                )
+            except Exception as e:
+                logger.warning(f"Общая запись {operation} ({len(writes)} вызовов) не удалась, по одному: {e}")
+            else:
+                for write in writes:
+                    if not write.future.done():
+                        write.future.set_result(None)
+                return
+
+        for write in writes:
+            try:
+                await self._call(operation, method, ids=write.ids, **write.columns)
+            except Exception as e:
+                if not write.future.done():
+                    write.future.set_exception(e)
+            else:
+                if not write.future.done():
+                    write.future.set_result(None)
+
+    async def close(self) -> None:
+        """Дописать ожидающие записи и остановить пул потоков"""
+        self._flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+# Глобальное хранилище векторов процесса
+vector_store = VectorStore()
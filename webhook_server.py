@@ -18,7 +18,9 @@ from config import (
     BOT_TOKEN,
     YOOKASSA_DISABLE_SIGNATURE_CHECK,
     YOOKASSA_WEBHOOK_SECRET,
+    TELEGRAM_MAX_RETRY_AFTER,
 )
+from telegram_sender import telegram_sender, PRIORITY_HIGH
 import aiohttp
 
 # Настройка логирования
@@ -120,7 +122,12 @@ async def activate_subscription(telegram_id: int, days: int) -> Optional[datetim
 
 
 async def send_telegram_message(chat_id: int, text: str) -> None:
-    """Отправить сообщение пользователю в Telegram через Bot API."""
+    """
+    Отправить сообщение пользователю в Telegram через Bot API.
+
+    Отправка проходит через общий планировщик лимитов (telegram_sender),
+    при 429 запрос повторяется после retry_after.
+    """
     if not BOT_TOKEN:
         logger.warning("BOT_TOKEN не задан, уведомление пользователю не отправлено")
         return
@@ -129,12 +136,25 @@ async def send_telegram_message(chat_id: int, text: str) -> None:
     timeout = aiohttp.ClientTimeout(total=10)
     try:
         async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.post(url, json=payload) as resp:
-                if resp.status != 200:
+            while True:
+                await telegram_sender.acquire(chat_id, PRIORITY_HIGH)
+                async with session.post(url, json=payload) as resp:
+                    if resp.status == 200:
+                        return
                     body = await resp.text()
-                    logger.warning(
-                        f"Не удалось отправить Telegram уведомление: {resp.status} {body}"
-                    )
+                    retry_after = None
+                    if resp.status == 429:
+                        try:
+                            retry_after = (await resp.json())["parameters"]["retry_after"]
+                        except Exception:
+                            retry_after = 1
+                        telegram_sender.retry_after(chat_id, retry_after)
+                    if retry_after is None or retry_after > TELEGRAM_MAX_RETRY_AFTER:
+                        logger.warning(
+                            f"Не удалось отправить Telegram уведомление: {resp.status} {body}"
+                        )
+                        return
+                    logger.warning(f"⏳ Telegram flood wait {retry_after}с для чата {chat_id}")
     except Exception as e:
         logger.error(f"Ошибка отправки Telegram уведомления: {e}")
 
@@ -0,0 +1,285 @@
+"""
+Супервизор LLM воркеров: общая модель эмбеддингов и процессы через fork
+"""
+import asyncio
+import gc
+import logging
+import math
+import os
+import signal
+import time
+from typing import Dict, Optional
+
+from config import (
+    QUEUE_BACKEND,
+    WORKER_METRICS_PORT,
+    SUPERVISOR_MIN_WORKERS,
+    SUPERVISOR_MAX_WORKERS,
+    SUPERVISOR_SCALE_BACKLOG,
+    SUPERVISOR_SCALE_INTERVAL,
+    SUPERVISOR_SCALE_DOWN_DELAY,
+    SUPERVISOR_STOP_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+# Как часто проверять завершившиеся процессы (секунды)
+REAP_INTERVAL = 1.0
+# Процесс, проработавший меньше этого (секунды), считается упавшим при
+# запуске: перезапуск откладывается с растущей задержкой (до MAX)
+CRASH_WINDOW = 30.0
+MAX_RESTART_DELAY = 60.0
+
+
+class WorkerProcess:
+    """Процесс воркера в слоте супервизора"""
+
+    def __init__(self, slot: int, pid: int):
+        self.slot = slot
+        self.pid = pid
+        self.started = time.monotonic()
+        self.stopping = False
+
+
+class WorkerSupervisor:
+    """
+    Запускает и перезапускает процессы LLM воркера.
+
+    Модули воркера и модель эмбеддингов загружаются в супервизоре один раз,
+    затем процессы создаются через fork и используют загруженное
+    совместно (copy-on-write). Перед fork объекты переводятся в постоянное
+    поколение (gc.freeze), чтобы сборщик мусора в дочерних процессах не
+    копировал страницы с ними. Клиенты ChromaDB, Redis, очередей и LLM
+    каждый процесс открывает сам после fork.
+
+    Число процессов меняется от min_workers до max_workers по глубине
+    очередей запросов (см. config.py, SUPERVISOR_*). Процесс занимает
+    слот: номер слота задает порт /metrics (WORKER_METRICS_PORT + слот),
+    поэтому адреса для Prometheus не меняются при перезапусках.
+    """
+
+    def __init__(
+        self,
+        min_workers: int = SUPERVISOR_MIN_WORKERS,
+        max_workers: int = SUPERVISOR_MAX_WORKERS
+    ):
+        self.min_workers = min_workers
+        self.max_workers = max(min_workers, max_workers)
+        self.target = min_workers
+        self.workers: Dict[int, WorkerProcess] = {}
+        # Слот -> число падений подряд и время, раньше которого не перезапускать
+        self.crashes: Dict[int, int] = {}
+        self.restart_after: Dict[int, float] = {}
+        self.restarts = 0
+        self._low_since: Optional[float] = None
+        self._stopping = asyncio.Event()
+        self._queue_client = None
+
+    def preload(self) -> None:
+        """Загрузить модули воркера и модель эмбеддингов до fork"""
+        # Токенизаторы HuggingFace создают потоки, которые не переживают fork
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+        # Сборка мусора выключается до загрузки и до первого fork: освобожденные
+        # ею объекты оставляли бы пустоты в страницах, которые дочерний
+        # процесс заполнял бы своими объектами (и копировал страницу)
+        gc.disable()
+        started = time.perf_counter()
+
+        import llm_worker  # noqa: F401 - модули воркера загружаются один раз
+        from vector_client import vector_client
+
+        vector_client.load_embedding_model()
+        logger.info(f"📦 Модель эмбеддингов загружена за {time.perf_counter() - started:.1f}с")
+
+    async def run(self) -> None:
+        """Запустить процессы и следить за ними до сигнала остановки"""
+        if QUEUE_BACKEND == "memory":
+            raise RuntimeError(
+                "Супервизор не работает с QUEUE_BACKEND=memory: очереди в памяти "
+                "не видны другим процессам"
+            )
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self._stopping.set)
+
+        # Отдельный клиент очередей для глубины: глобальный queue_client
+        # дочерние процессы подключают сами
+        from queue_client import QueueClient
+        self._queue_client = QueueClient()
+
+        logger.info(
+            f"🚀 Супервизор воркеров: процессов {self.min_workers}..{self.max_workers}, "
+            f"pid {os.getpid()}"
+        )
+        last_scale = 0.0
+        try:
+            while not self._stopping.is_set():
+                self._reap()
+                if time.monotonic() - last_scale >= SUPERVISOR_SCALE_INTERVAL:
+                    last_scale = time.monotonic()
+                    await self._rescale()
+                self._spawn_missing()
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), REAP_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self._stop_all()
+            await self._queue_client.disconnect()
+            logger.info(f"Супервизор остановлен (перезапусков: {self.restarts})")
+
+    async def _rescale(self) -> None:
+        """Пересчитать число процессов по глубине очередей запросов"""
+        from queue_client import REQUEST_LANES
+
+        try:
+            if not self._queue_client.backend.connected:
+                await self._queue_client.connect()
+            depths = await self._queue_client.get_queue_depths()
+        except Exception as e:
+            # Число процессов не меняется, пока очереди недоступны
+            logger.warning(f"Не удалось получить глубину очередей: {e}")
+            return
+        backlog = sum(depths.get(lane, 0) for lane in REQUEST_LANES.values())
+        wanted = min(
+            self.max_workers,
+            max(self.min_workers, math.ceil(backlog / SUPERVISOR_SCALE_BACKLOG))
+        )
+
+        if wanted > self.target:
+            logger.info(f"📈 Очередь {backlog}: процессов {self.target} -> {wanted}")
+            self.target = wanted
+            self._low_since = None
+        elif wanted < self.target:
+            # Уменьшаем по одному и только после устойчиво малой очереди
+            now = time.monotonic()
+            if self._low_since is None:
+                self._low_since = now
+            elif now - self._low_since >= SUPERVISOR_SCALE_DOWN_DELAY:
+                logger.info(f"📉 Очередь {backlog}: процессов {self.target} -> {self.target - 1}")
+                self.target -= 1
+                self._low_since = now
+                for slot in list(self.workers):
+                    if slot >= self.target:
+                        self._stop_slot(slot)
+        else:
+            self._low_since = None
+
+    def _spawn_missing(self) -> None:
+        """Запустить процессы в свободных слотах до self.target"""
+        now = time.monotonic()
+        for slot in range(self.target):
+            if slot in self.workers or now < self.restart_after.get(slot, 0):
+                continue
+            self._spawn(slot)
+
+    def _spawn(self, slot: int) -> None:
+        # Все загруженное до этого момента - в постоянное поколение: сборщик
+        # мусора дочернего процесса не будет его обходить
+        gc.freeze()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _run_child(slot)
+            except BaseException as e:
+                logger.error(f"Процесс воркера {slot} завершился с ошибкой: {e}")
+                code = 1
+            finally:
+                logging.shutdown()
+                os._exit(code)
+        # В супервизоре сборка мусора снова работает: замороженные объекты
+        # она не трогает
+        gc.enable()
+        self.workers[slot] = WorkerProcess(slot, pid)
+        logger.info(f"👷 Воркер {slot} запущен: pid {pid}")
+
+    def _reap(self) -> None:
+        """Убрать завершившиеся процессы и запланировать перезапуск упавших"""
+        for slot, worker in list(self.workers.items()):
+            try:
+                pid, status = os.waitpid(worker.pid, os.WNOHANG)
+            except ChildProcessError:
+                pid, status = worker.pid, 0
+            if pid == 0:
+                continue
+            del self.workers[slot]
+            code = os.waitstatus_to_exitcode(status)
+            if worker.stopping or slot >= self.target:
+                logger.info(f"Воркер {slot} (pid {worker.pid}) остановлен")
+                continue
+
+            uptime = time.monotonic() - worker.started
+            if uptime < CRASH_WINDOW:
+                # Падение при запуске: 1, 2, 4, ... секунд до перезапуска
+                self.crashes[slot] = self.crashes.get(slot, 0) + 1
+                delay = min(MAX_RESTART_DELAY, 2 ** (self.crashes[slot] - 1))
+            else:
+                self.crashes[slot] = 0
+                delay = 0
+            self.restart_after[slot] = time.monotonic() + delay
+            self.restarts += 1
+            logger.error(
+                f"💥 Воркер {slot} (pid {worker.pid}) завершился с кодом {code} "
+                f"через {uptime:.0f}с, перезапуск через {delay:g}с"
+            )
+
+    def _stop_slot(self, slot: int) -> None:
+        """Попросить процесс слота завершиться (SIGTERM)"""
+        worker = self.workers.get(slot)
+        if worker is None or worker.stopping:
+            return
+        worker.stopping = True
+        try:
+            os.kill(worker.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    async def _stop_all(self) -> None:
+        """Остановить все процессы: SIGTERM, затем SIGKILL по таймауту"""
+        self.target = 0
+        for slot in list(self.workers):
+            self._stop_slot(slot)
+        deadline = time.monotonic() + SUPERVISOR_STOP_TIMEOUT
+        while self.workers and time.monotonic() < deadline:
+            self._reap()
+            await asyncio.sleep(0.2)
+        for worker in self.workers.values():
+            logger.warning(f"Воркер {worker.slot} (pid {worker.pid}) не завершился, SIGKILL")
+            try:
+                os.kill(worker.pid, signal.SIGKILL)
+                os.waitpid(worker.pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        self.workers.clear()
+
+
+def _run_child(slot: int) -> None:
+    """Тело дочернего процесса: LLM воркер со своим циклом событий"""
+    # Обработчики сигналов и wakeup fd унаследованы от цикла супервизора
+    signal.set_wakeup_fd(-1)
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, signal.SIG_DFL)
+    gc.enable()
+
+    from metrics import metrics_server
+    import llm_worker
+
+    if WORKER_METRICS_PORT:
+        metrics_server.port = WORKER_METRICS_PORT + slot
+
+    async def main():
+        task = asyncio.current_task()
+        loop = asyncio.get_running_loop()
+        # SIGTERM - штатная остановка: потребление прекращается, воркер
+        # закрывает соединения (LLMWorker.stop)
+        loop.add_signal_handler(signal.SIGTERM, task.cancel)
+        # Ctrl+C в терминале получает вся группа процессов; останавливает
+        # воркеры супервизор
+        loop.add_signal_handler(signal.SIGINT, lambda: None)
+        try:
+            await llm_worker.main()
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(main())
@@ -0,0 +1,192 @@
+"""
+Фоновый конвейер отложенной записи (write-behind)
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, List, Optional, Sequence
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Обработчик пакета элементов
+Handler = Callable[[List[Any]], Awaitable[None]]
+# Сохранение элемента, который не удалось обработать: (элемент, причина)
+DeadLetter = Callable[[Any, str], Awaitable[None]]
+
+
+class WriteBehindPipeline:
+    """
+    Ограниченная очередь фоновых задач с пакетной обработкой.
+
+    Вызывающий код кладет элементы через submit() и не ждет их обработки.
+    Фоновая задача собирает элементы в пакет и передает его каждому из
+    handlers по порядку, когда пакет набрал batch_size элементов или с
+    момента первого элемента прошло flush_interval секунд.
+
+    Ошибки изолированы: если обработчик не справился с пакетом, он
+    вызывается для каждого элемента отдельно, с max_retries повторами
+    (пауза retry_delay, удваивается). Остальные обработчики пакета при
+    этом не повторяются. Элемент, который так и не удалось обработать,
+    передается в dead_letter.
+
+    Когда очередь заполнена, submit() ждет освобождения места (обратное
+    давление) не дольше put_timeout, после чего элемент отбрасывается и
+    тоже передается в dead_letter. stop() дожидается обработки всего, что
+    уже было принято. Исходы элементов - в метрике write_behind_items.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handlers: Sequence[Handler],
+        max_size: int = 1000,
+        batch_size: int = 20,
+        flush_interval: float = 1.0,
+        put_timeout: float = 5.0,
+        max_retries: int = 2,
+        retry_delay: float = 0.5,
+        dead_letter: Optional[DeadLetter] = None
+    ):
+        self.name = name
+        self.handlers = list(handlers)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.dead_letter = dead_letter
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+        self._task: Optional[asyncio.Task] = None
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    @property
+    def pending(self) -> int:
+        """Количество элементов, ожидающих обработки"""
+        return self._queue.qsize()
+
+    def start(self) -> None:
+        """Запустить фоновую обработку"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"🧵 Конвейер '{self.name}' запущен")
+
+    async def submit(self, item: Any) -> bool:
+        """Поставить элемент в очередь. False - элемент отброшен"""
+        try:
+            await asyncio.wait_for(self._queue.put(item), self.put_timeout)
+        except asyncio.TimeoutError:
+            self.dropped += 1
+            metrics.WRITE_BEHIND_ITEMS.labels(self.name, "dropped").inc()
+            logger.error(
+                f"❌ Конвейер '{self.name}' переполнен "
+                f"({self._queue.qsize()} в очереди), элемент отброшен"
+            )
+            await self._dead_letter(item, "очередь переполнена")
+            return False
+        self.submitted += 1
+        return True
+
+    async def _collect_batch(self) -> List[Any]:
+        """Дождаться первого элемента и добрать пакет до размера или таймера"""
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        """Основной цикл фоновой обработки"""
+        while True:
+            batch = await self._collect_batch()
+            try:
+                failed = set()
+                for handler in self.handlers:
+                    failed.update(await self._handle(handler, batch))
+                self.processed += len(batch) - len(failed)
+                self.failed += len(failed)
+                metrics.WRITE_BEHIND_ITEMS.labels(self.name, "processed").inc(len(batch) - len(failed))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _handle(self, handler: Handler, batch: List[Any]) -> List[int]:
+        """Обработать пакет одним обработчиком. Возвращает индексы неудавшихся элементов"""
+        try:
+            await handler(batch)
+            return []
+        except Exception as e:
+            error = e
+        if len(batch) > 1:
+            logger.warning(
+                f"⚠️ Конвейер '{self.name}': пакет из {len(batch)} элементов не обработан "
+                f"({error}), обрабатываем по одному"
+            )
+        failed = []
+        for index, item in enumerate(batch):
+            # Элемент пакета из одного уже получил первую попытку
+            if not await self._retry(handler, item, attempt=1 if len(batch) == 1 else 0, error=error):
+                failed.append(index)
+        return failed
+
+    async def _retry(self, handler: Handler, item: Any, attempt: int, error: Exception) -> bool:
+        """Обработать один элемент с повторами; при неудаче - в dead_letter"""
+        while attempt <= self.max_retries:
+            if attempt:
+                metrics.WRITE_BEHIND_ITEMS.labels(self.name, "retried").inc()
+                await asyncio.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                await handler([item])
+                return True
+            except Exception as e:
+                error = e
+            attempt += 1
+        metrics.WRITE_BEHIND_ITEMS.labels(self.name, "failed").inc()
+        logger.error(f"❌ Конвейер '{self.name}': элемент не обработан после повторов: {error}")
+        await self._dead_letter(item, f"{type(error).__name__}: {error}")
+        return False
+
+    async def _dead_letter(self, item: Any, reason: str) -> None:
+        if self.dead_letter is None:
+            return
+        try:
+            await self.dead_letter(item, reason)
+        except Exception as e:
+            logger.error(f"❌ Конвейер '{self.name}': не удалось сохранить необработанный элемент: {e}")
+
+    async def stop(self, timeout: float = 30.0) -> None:
+        """Дождаться обработки принятых элементов и остановить конвейер"""
+        if self._task is None:
+            return
+        if self._queue.qsize():
+            logger.info(
+                f"⏳ Конвейер '{self.name}': дообрабатываем "
+                f"{self._queue.qsize()} элементов..."
+            )
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(
+                f"❌ Конвейер '{self.name}' не успел обработать "
+                f"{self._queue.qsize()} элементов за {timeout}с"
+            )
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        logger.info(
+            f"Конвейер '{self.name}' остановлен: обработано {self.processed}, "
+            f"ошибок {self.failed}, отброшено {self.dropped}"
+        )